@@ -16,22 +16,112 @@
 # Code adapted from https://developers.google.com/calendar/quickstart/python
 from __future__ import print_function
 
+import argparse
 from dateutil.relativedelta import relativedelta
+import collections
+import csv
 import datetime
+import heapq
+import io
+import itertools
+import json
+import logging
 import pickle
 import os.path
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import CalendarMetrics
+import CalendarScheduler
+
+# The Google client libraries take a few hundred milliseconds to import, so they are only
+# imported by the functions that build the API object or log the user in. Everything else
+# (the queries on a given API object, the CLI's --help, the local store) starts without them.
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
+# The file the CLI keeps its local event store in (see CalendarCache), next to token.pickle.
+DEFAULT_CACHE_PATH = 'events.sqlite'
+
+# Number of events requested per page when streaming results. The API allows up to 2500.
+DEFAULT_PAGE_SIZE = 250
+
+# Number of requests sent together in one batch. The Calendar API allows up to 50.
+BATCH_SIZE = 50
+
+# Partial response masks, so that only the fields that are shown are downloaded. Listings
+# only show the start, end, summary and reminders of the events, while the detailed view
+# of navigate_calendar shows a few more fields of a single event.
+LIST_FIELDS = 'nextPageToken,nextSyncToken,items(id,status,summary,start,end,reminders)'
+DETAIL_FIELDS = 'kind,id,status,htmlLink,created,updated,summary,creator(email),organizer(email),start,end'
+
+# Number of seconds the event counts of navigate_calendar are trusted for, without a local
+# store, before they are synced again to pick up the events created or deleted since.
+COUNTS_MAX_AGE = 30
+
+# Number of seconds navigate_calendar answers the months and days of a year or month it
+# fetched from its events, before they are fetched again.
+WINDOW_MAX_AGE = 30
+
+# Length of the shards a long time window is split into for concurrent fetching.
+SHARD_LENGTHS = {'month': relativedelta(months=+1), 'quarter': relativedelta(months=+3)}
+
+# Number of shards fetched at the same time.
+DEFAULT_WORKERS = 4
+
+# Formats the event listings can be printed in, and the number of lines written at a time.
+OUTPUT_FORMATS = ('text', 'jsonl', 'csv')
+PRINT_CHUNK_SIZE = 4096
+
+
+# The API object built by get_calendar_api, shared by every caller in the process.
+_calendar_api = None
+_calendar_api_lock = threading.Lock()
+
 
-def get_calendar_api():
+def get_calendar_api(rebuild=False, transport=None):
     """
     Get an object which allows you to consume the Google Calendar API.
     You do not need to worry about what this function exactly does, nor create test cases for it.
+
+    The object is only built on the first call and shared afterwards. It is built from the
+    discovery document bundled with the client library, so no discovery request is made,
+    and its credentials refresh themselves when they expire.
+
+    :param rebuild: Build a new object even if one has already been built
+    :param transport: An optional http object to send the requests through, such as a
+    CalendarTransport.ConnectionPool. The user's credentials are set on it, and a new
+    object is returned for it without replacing the shared one.
+    """
+    if transport is not None:
+        transport.credentials = _load_credentials()
+        return _build_service(http=transport)
+    global _calendar_api
+    with _calendar_api_lock:
+        if _calendar_api is None or rebuild:
+            _calendar_api = _build_service(credentials=_load_credentials())
+        return _calendar_api
+
+
+def _build_service(**kwargs):
+    """
+    Builds a Calendar API object from the discovery document bundled with the client library.
+
+    :param kwargs: The credentials or http object (and other options) of the object
+    """
+    from googleapiclient.discovery import build
+
+    return build('calendar', 'v3', static_discovery=True, cache_discovery=False, **kwargs)
+
+
+def _load_credentials():
+    """
+    Loads the user's credentials from token.pickle, refreshing them only if they have
+    expired, or lets the user log in if there are none.
     """
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
@@ -44,8 +134,12 @@ def get_calendar_api():
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
+
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
@@ -53,10 +147,398 @@ def get_calendar_api():
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
 
-    return build('calendar', 'v3', credentials=creds)
+    return creds
+
 
+def execute_request(request, operation=None, cost=1, idempotent=None):
+    """
+    Sends a request of the API (or a batch of them) and returns its response. Every request
+    of the application goes through here, so that it is paced and retried by the shared
+    CalendarScheduler, and recorded by the sinks registered with CalendarMetrics.
 
-def get_upcoming_events(api, starting_time, number_of_events):
+    :param request: The request to send, e.g. api.events().list(calendarId='primary')
+    :param operation: The name the request is recorded under, its API method by default
+    :param cost: The number of requests it counts as against the rate limit
+    :param idempotent: Whether the request may be sent again after a server error, by
+    default unless it is a POST (e.g. events.insert or events.watch) or a batch
+    """
+    if idempotent is None:
+        idempotent = getattr(request, 'method', 'POST') in CalendarScheduler.IDEMPOTENT_METHODS
+    return CalendarScheduler.get_scheduler().execute(lambda: CalendarMetrics.execute(request, operation), cost,
+                                                     idempotent)
+
+
+def iter_pages(list_method, **kwargs):
+    """
+    Lazily follows the nextPageToken of a paginated list call and yields every page
+    (the raw response dict) one at a time. The next page is only requested once the
+    caller has consumed the current one, so stopping early also stops the network calls.
+
+    :param list_method: The list method of an API collection, e.g. api.events().list
+    :param kwargs: The query parameters passed to every list call
+    """
+    page_token = kwargs.pop('pageToken', None)
+    while True:
+        if page_token:
+            kwargs['pageToken'] = page_token
+        page = execute_request(list_method(**kwargs))
+        yield page
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            break
+
+
+def iter_events(api, calendar_id='primary', page_size=DEFAULT_PAGE_SIZE, **kwargs):
+    """
+    Streams the events matching the given query one at a time, following every page
+    of the result instead of only the first one.
+
+    :param api: API of the Google Calendar
+    :param calendar_id: The calendar to list the events of
+    :param page_size: The number of events requested per page
+    :param kwargs: Any other query parameters of events().list, e.g. timeMin, timeMax, q or
+    fields (LIST_FIELDS to only download what the listings show, the full events by default)
+    """
+    if page_size <= 0:
+        raise ValueError("Page size must be at least 1.")
+    return _iter_items(iter_pages(api.events().list, calendarId=calendar_id, maxResults=page_size, **kwargs))
+
+
+def _iter_items(pages):
+    """
+    Flattens a stream of list responses into a stream of their items.
+    """
+    for page in pages:
+        for item in page.get('items', []):
+            yield item
+
+
+def _split_window(time_min, time_max, shard):
+    """
+    Splits the window between two RFC3339 times into consecutive (timeMin, timeMax) shards
+    of the given length ('month' or 'quarter').
+    """
+    if shard not in SHARD_LENGTHS:
+        raise ValueError("Shard must be one of " + ", ".join(SHARD_LENGTHS) + ".")
+    start = datetime.datetime.fromisoformat(time_min[:-1])
+    end = datetime.datetime.fromisoformat(time_max[:-1])
+    shards = []
+    while start < end:
+        shard_end = min(start + SHARD_LENGTHS[shard], end)
+        shards.append((start.isoformat() + 'Z', shard_end.isoformat() + 'Z'))
+        start = shard_end
+    return shards
+
+
+def iter_events_sharded(api, time_min, time_max, shard='month', workers=DEFAULT_WORKERS,
+                        page_size=DEFAULT_PAGE_SIZE, calendar_id='primary'):
+    """
+    Streams the events between two times in start time order, like iter_events, but splits
+    the window into month or quarter shards that are fetched concurrently on a thread pool.
+    At most two shards per worker are held in memory at once. An event overlapping several
+    shards is only yielded by the shard it starts in.
+
+    The default http object of the API cannot be shared between threads, so the API should
+    be built on a CalendarTransport.ConnectionPool when more than one worker is used.
+
+    :param api: API of the Google Calendar
+    :param time_min: The RFC3339 (UTC, 'Z' suffixed) start of the window
+    :param time_max: The RFC3339 (UTC, 'Z' suffixed) end of the window
+    :param shard: The length of the shards, 'month' or 'quarter'
+    :param workers: The number of shards fetched at the same time. The requests in flight
+    are also capped by the scheduler's max_concurrency (see CalendarScheduler.set_scheduler)
+    :param page_size: The number of events requested per page
+    :param calendar_id: The calendar to list the events of
+    """
+    if workers <= 0:
+        raise ValueError("Number of workers must be at least 1.")
+    shards = _split_window(time_min, time_max, shard)
+    return _iter_shards(api, shards, workers, page_size, calendar_id)
+
+
+def _iter_shards(api, shards, workers, page_size, calendar_id):
+    def fetch(bounds):
+        return list(iter_events(api, calendar_id=calendar_id, page_size=page_size, timeMin=bounds[0],
+                                timeMax=bounds[1], singleEvents=True, orderBy='startTime', fields=LIST_FIELDS))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    in_flight = collections.deque()
+    remaining = iter(enumerate(shards))
+    try:
+        for position, bounds in itertools.islice(remaining, 2 * workers):
+            in_flight.append((position, bounds, executor.submit(fetch, bounds)))
+        while in_flight:
+            position, bounds, future = in_flight.popleft()
+            events = future.result()
+            for next_position, next_bounds in itertools.islice(remaining, 1):
+                in_flight.append((next_position, next_bounds, executor.submit(fetch, next_bounds)))
+            shard_start = get_event_timestamp(bounds[0])
+            for event in events:
+                # Events starting before the shard were already yielded by an earlier shard
+                if position > 0 and get_event_timestamp(event['start']) < shard_start:
+                    continue
+                yield event
+    finally:
+        for position, bounds, future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def iter_calendars_events(api, calendar_ids, per_calendar_limit=None, workers=DEFAULT_WORKERS,
+                          page_size=DEFAULT_PAGE_SIZE, predicate=None, **kwargs):
+    """
+    Streams the events of several calendars merged into one start time ordered stream of
+    (calendar id, event) pairs. Every calendar is read by its own producer thread that
+    stays at most a couple of pages ahead of the merge, and at most `workers` pages are
+    downloaded at the same time. Results are yielded as soon as every calendar has
+    delivered its next event, without collecting any calendar's full list first.
+
+    The default http object of the API cannot be shared between threads, so the API should
+    be built on a CalendarTransport.ConnectionPool.
+
+    :param api: API of the Google Calendar
+    :param calendar_ids: The ids of the calendars to read
+    :param per_calendar_limit: The maximum number of events taken from each calendar
+    :param workers: The maximum number of pages downloaded at the same time, no more than
+    the scheduler's max_concurrency (see CalendarScheduler.set_scheduler)
+    :param page_size: The number of events requested per page
+    :param predicate: An optional function choosing which events are kept (and counted
+    towards the limit)
+    :param kwargs: Any other query parameters of events().list, e.g. timeMin or timeMax
+    """
+    if workers <= 0:
+        raise ValueError("Number of workers must be at least 1.")
+    if per_calendar_limit is not None and per_calendar_limit <= 0:
+        raise ValueError("Number of events must be at least 1.")
+    kwargs.setdefault('singleEvents', True)
+    kwargs.setdefault('orderBy', 'startTime')
+    kwargs.setdefault('fields', LIST_FIELDS)
+    return _merge_calendars(api, list(calendar_ids), per_calendar_limit, workers, page_size, predicate, kwargs)
+
+
+def _merge_calendars(api, calendar_ids, per_calendar_limit, workers, page_size, predicate, kwargs):
+    slots = threading.BoundedSemaphore(workers)
+    stopped = threading.Event()
+    queues = [queue.Queue(maxsize=2) for calendar_id in calendar_ids]
+
+    def put(pages, item):
+        # Waits for room in the queue unless the consumer has stopped reading
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce(calendar_id, pages):
+        try:
+            remaining = per_calendar_limit
+            size = page_size if remaining is None or predicate else min(page_size, remaining)
+            listed = iter_pages(api.events().list, calendarId=calendar_id, maxResults=size, **kwargs)
+            while not stopped.is_set():
+                with slots:
+                    page = next(listed, None)
+                if page is None:
+                    break
+                items = [event for event in page.get('items', []) if predicate is None or predicate(event)]
+                if remaining is not None:
+                    items = items[:remaining]
+                    remaining -= len(items)
+                put(pages, items)
+                if remaining == 0:
+                    break
+        except Exception as error:
+            put(pages, error)
+        put(pages, None)
+
+    def consume(calendar_id, pages):
+        while True:
+            items = pages.get()
+            if items is None:
+                return
+            if isinstance(items, Exception):
+                raise items
+            for event in items:
+                yield calendar_id, event
+
+    threads = [threading.Thread(target=produce, args=(calendar_id, pages), daemon=True)
+               for calendar_id, pages in zip(calendar_ids, queues)]
+    for thread in threads:
+        thread.start()
+    try:
+        streams = [consume(calendar_id, pages) for calendar_id, pages in zip(calendar_ids, queues)]
+        for pair in heapq.merge(*streams, key=lambda pair: get_event_timestamp(pair[1]['start'])):
+            yield pair
+    finally:
+        stopped.set()
+
+
+def get_event_timestamp(event_time):
+    """
+    Converts the start or end field of an event (or a query time string) into a UTC
+    POSIX timestamp. All-day events, which only have a date, are taken to start at
+    midnight UTC, and times without an offset are taken to be UTC.
+
+    :param event_time: The 'start'/'end' dict of an event, or an RFC3339 string
+    """
+    if isinstance(event_time, dict):
+        event_time = event_time.get('dateTime', event_time.get('date'))
+    if event_time.endswith('Z'):
+        event_time = event_time[:-1] + '+00:00'
+    parsed = datetime.datetime.fromisoformat(event_time)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+class Event:
+    """
+    A compact, read-only representation of an event. The start and end are stored as
+    UTC POSIX timestamps (whole seconds) together with the UTC offset they were given in,
+    so that sorting and filtering by time does not parse any strings, and the summary is
+    interned so that repeated titles (e.g. of recurring events) are only stored once.
+    The API's dict is only kept if asked for.
+    """
+    __slots__ = ('id', 'summary', 'start', 'end', 'offset', 'all_day', 'default_reminders', 'reminders', 'raw')
+
+    def __init__(self, id, summary, start, end, offset=0, all_day=False, default_reminders=False, reminders=(),
+                 raw=None):
+        self.id = id
+        self.summary = sys.intern(summary)
+        self.start = start
+        self.end = end
+        self.offset = offset
+        self.all_day = all_day
+        self.default_reminders = default_reminders
+        self.reminders = reminders
+        self.raw = raw
+
+    @classmethod
+    def from_dict(cls, event, keep_raw=False):
+        """
+        Creates an Event from an event returned by the API.
+
+        :param event: The event dict
+        :param keep_raw: Keep the event dict in the raw attribute
+        """
+        start = event['start']
+        all_day = 'dateTime' not in start
+        offset = 0
+        if not all_day:
+            offset = int(datetime.datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00'))
+                         .utcoffset().total_seconds()) // 60
+        reminders = event.get('reminders', {})
+        overrides = tuple((reminder['minutes'], sys.intern(reminder['method']))
+                          for reminder in reminders.get('overrides', ()))
+        return cls(event['id'], event.get('summary', ''), int(get_event_timestamp(start)),
+                   int(get_event_timestamp(event['end'])), offset, all_day, bool(reminders.get('useDefault')),
+                   overrides, event if keep_raw else None)
+
+    def _format_time(self, timestamp):
+        if self.all_day:
+            return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date().isoformat()
+        timezone = datetime.timezone(datetime.timedelta(minutes=self.offset))
+        text = datetime.datetime.fromtimestamp(timestamp, timezone).isoformat()
+        return text[:-6] + 'Z' if text.endswith('+00:00') else text
+
+    @property
+    def start_text(self):
+        """The start of the event the way the API gives it, a date for all-day events."""
+        return self._format_time(self.start)
+
+    @property
+    def end_text(self):
+        """The end of the event the way the API gives it, a date for all-day events."""
+        return self._format_time(self.end)
+
+    @property
+    def duration(self):
+        """The length of the event in seconds."""
+        return self.end - self.start
+
+    def __repr__(self):
+        return 'Event(' + repr(self.id) + ', ' + repr(self.summary) + ', ' + self.start_text + ')'
+
+
+def to_events(events, keep_raw=False):
+    """
+    Converts the API's event dicts into a list of Event objects.
+
+    :param events: The event dicts
+    :param keep_raw: Keep each event dict in the raw attribute of its Event
+    """
+    return [Event.from_dict(event, keep_raw) for event in events]
+
+
+def _as_requested(events, as_events):
+    """
+    Returns the events as Event objects if as_events is set, or as they are otherwise.
+    """
+    return to_events(events) if as_events else events
+
+
+def _past_window(starting_time, number_of_years):
+    """
+    Returns the (timeMin, timeMax) pair covering number_of_years before starting_time.
+    """
+    # Changes the date to the correct format for Google Calendar API
+    new_min = (datetime.datetime.fromisoformat(starting_time[:-1]) -
+               relativedelta(years=+number_of_years)).isoformat() + 'Z'
+
+    if number_of_years <= 4:
+        raise ValueError("Number of years must be at least 5.")
+    return new_min, starting_time
+
+
+def _future_window(starting_time, number_of_years):
+    """
+    Returns the (timeMin, timeMax) pair covering number_of_years after starting_time.
+    """
+    # Changes the date to the correct format for Google Calendar API
+    new_max = (datetime.datetime.fromisoformat(starting_time[:-1]) +
+               relativedelta(years=+number_of_years)).isoformat() + 'Z'
+
+    if number_of_years <= 1:
+        raise ValueError("Number of years must be at least 2.")
+    return starting_time, new_max
+
+
+def get_specific_time_window(year, month=0, day=0):
+    """
+    Returns the (timeMin, timeMax) pair covering the given year, year's month or date,
+    the window that get_specific_time_events queries.
+
+    :param year: The year of the window
+    :param month: The month of the window, 0 for the whole year
+    :param day: The day of the window, 0 for the whole month
+    """
+    if year <= 0:
+        raise ValueError("Invalid year input.")
+    if month < 0 or month > 12:
+        raise ValueError("Invalid month input.")
+    if day < 0 or day > 31:
+        raise ValueError("Invalid day input.")
+
+    # If month and day are not provided, use the whole year
+    if month == 0 and day == 0:
+        start_time = (datetime.datetime.utcnow().replace(year=year, month=1, day=1, hour=0, minute=0, second=0,
+                                                         microsecond=0))
+        end_time = (start_time + relativedelta(years=+1))
+    # If only day is not provided, use the year's month
+    elif day == 0:
+        start_time = (datetime.datetime.utcnow().replace(year=year, month=month, day=1, hour=0, minute=0, second=0,
+                                                         microsecond=0))
+        end_time = (start_time + relativedelta(months=+1))
+    # If all are given, use the specific date
+    else:
+        start_time = (datetime.datetime.utcnow().replace(year=year, month=month, day=day, hour=0, minute=0, second=0,
+                                                         microsecond=0))
+        end_time = (start_time + relativedelta(days=+1))
+
+    return start_time.isoformat() + "Z", end_time.isoformat() + "Z"
+
+
+def get_upcoming_events(api, starting_time, number_of_events, store=None, as_events=False):
     """
     Shows basic usage of the Google Calendar API.
     Prints the start and name of the next n events on the user's calendar.
@@ -64,20 +546,44 @@ def get_upcoming_events(api, starting_time, number_of_events):
     :param api: API of the Google Calendar
     :param starting_time: The starting time to be used to begin querying for events
     :param number_of_events: The number of events we want to look for
+    :param store: An optional CalendarCache.EventStore to answer the query from
+    :param as_events: Return compact Event objects instead of the API's dicts
     """
     if number_of_events <= 0:
         raise ValueError("Number of events must be at least 1.")
 
-    events_result = api.events().list(calendarId='primary', timeMin=starting_time,
-                                      maxResults=number_of_events, singleEvents=True,
-                                      orderBy='startTime').execute()
+    if store is not None:
+        store.sync(api)
+        return _as_requested(store.query(time_min=starting_time, limit=number_of_events), as_events)
 
-    return events_result.get('items', [])
+    events_result = execute_request(api.events().list(calendarId='primary', timeMin=starting_time,
+                                                      maxResults=number_of_events, singleEvents=True,
+                                                      orderBy='startTime', fields=LIST_FIELDS))
+
+    return _as_requested(events_result.get('items', []), as_events)
 
     # Add your methods here.
 
 
-def get_year_past_events(api, starting_time, number_of_years):
+def iter_upcoming_events(api, starting_time, number_of_events, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Streaming variant of get_upcoming_events. Yields the next n events one at a time,
+    following as many pages as needed.
+
+    :param api: API of the Google Calendar
+    :param starting_time: The starting time to be used to begin querying for events
+    :param number_of_events: The number of events we want to look for
+    :param page_size: The number of events requested per page
+    """
+    if number_of_events <= 0:
+        raise ValueError("Number of events must be at least 1.")
+
+    events = iter_events(api, timeMin=starting_time, singleEvents=True, orderBy='startTime',
+                         fields=LIST_FIELDS, page_size=min(page_size, number_of_events))
+    return itertools.islice(events, number_of_events)
+
+
+def get_year_past_events(api, starting_time, number_of_years, store=None, as_events=False):
     """
     (Written for functionality 1)
     Given a fixed number of years, prints the start and name of past events
@@ -88,21 +594,57 @@ def get_year_past_events(api, starting_time, number_of_years):
     :param starting_time: The starting time to be used to begin querying for events
     :param number_of_years: The number of years in the past that we want to search through
     for events
+    :param store: An optional CalendarCache.EventStore to answer the query from
+    :param as_events: Return compact Event objects instead of the API's dicts
     """
-    # Changes the date to the correct format for Google Calendar API
-    new_min = (datetime.datetime.fromisoformat(starting_time[:-1]) -
-               relativedelta(years=+number_of_years)).isoformat() + 'Z'
+    new_min, new_max = _past_window(starting_time, number_of_years)
+
+    if store is not None:
+        store.sync(api)
+        return _as_requested(store.query(time_min=new_min, time_max=new_max), as_events)
+
+    events_result = execute_request(api.events().list(calendarId='primary', timeMin=new_min,
+                                                      timeMax=new_max, singleEvents=True,
+                                                      orderBy='startTime', fields=LIST_FIELDS))
+    return _as_requested(events_result.get('items', []), as_events)
 
-    if number_of_years <= 4:
-        raise ValueError("Number of years must be at least 5.")
 
-    events_result = api.events().list(calendarId='primary', timeMin=new_min,
-                                      timeMax=starting_time, singleEvents=True,
-                                      orderBy='startTime').execute()
-    return events_result.get('items', [])
+def iter_year_past_events(api, starting_time, number_of_years, page_size=DEFAULT_PAGE_SIZE, shard=None,
+                          workers=DEFAULT_WORKERS, calendar_ids=None, per_calendar_limit=None,
+                          expand_locally=False):
+    """
+    Streaming variant of get_year_past_events. Yields every event of the past specified
+    year(s) one at a time instead of only the first page.
+
+    :param api: API of the Google Calendar
+    :param starting_time: The starting time to be used to begin querying for events
+    :param number_of_years: The number of years in the past that we want to search through
+    for events
+    :param page_size: The number of events requested per page
+    :param shard: Optionally 'month' or 'quarter', to fetch the window in shards of that
+    length concurrently (see iter_events_sharded)
+    :param workers: The number of shards (or pages) fetched at the same time
+    :param calendar_ids: Optionally the ids of several calendars to read instead of the
+    primary one, yielding (calendar id, event) pairs (see iter_calendars_events)
+    :param per_calendar_limit: The maximum number of events taken from each calendar
+    :param expand_locally: Download the recurring events once and expand their instances
+    locally (see CalendarRecurrence.iter_expanded_events)
+    """
+    new_min, new_max = _past_window(starting_time, number_of_years)
+    if expand_locally:
+        return _iter_expanded(api, new_min, new_max, page_size, shard, calendar_ids)
+    if calendar_ids is not None:
+        if shard is not None:
+            raise ValueError("Sharding is not supported when reading several calendars.")
+        return iter_calendars_events(api, calendar_ids, per_calendar_limit, workers, page_size,
+                                     timeMin=new_min, timeMax=new_max)
+    if shard is not None:
+        return iter_events_sharded(api, new_min, new_max, shard, workers, page_size)
+    return iter_events(api, timeMin=new_min, timeMax=new_max, singleEvents=True, orderBy='startTime',
+                       fields=LIST_FIELDS, page_size=page_size)
 
 
-def get_year_future_events(api, starting_time, number_of_years):
+def get_year_future_events(api, starting_time, number_of_years, store=None, as_events=False):
     """
     (Written for functionality 2)
     Given a fixed number of years, prints the start and name of upcoming
@@ -113,21 +655,57 @@ def get_year_future_events(api, starting_time, number_of_years):
     :param starting_time: The starting time to be used to begin querying for events
     :param number_of_years: The number of years in the future that we want to search through
     for events
+    :param store: An optional CalendarCache.EventStore to answer the query from
+    :param as_events: Return compact Event objects instead of the API's dicts
     """
-    # Changes the date to the correct format for Google Calendar API
-    new_max = (datetime.datetime.fromisoformat(starting_time[:-1]) +
-               relativedelta(years=+number_of_years)).isoformat() + 'Z'
+    new_min, new_max = _future_window(starting_time, number_of_years)
 
-    if number_of_years <= 1:
-        raise ValueError("Number of years must be at least 2.")
+    if store is not None:
+        store.sync(api)
+        return _as_requested(store.query(time_min=new_min, time_max=new_max), as_events)
 
-    events_result = api.events().list(calendarId='primary', timeMin=starting_time,
-                                      timeMax=new_max, singleEvents=True,
-                                      orderBy='startTime').execute()
-    return events_result.get('items', [])
+    events_result = execute_request(api.events().list(calendarId='primary', timeMin=new_min,
+                                                      timeMax=new_max, singleEvents=True,
+                                                      orderBy='startTime', fields=LIST_FIELDS))
+    return _as_requested(events_result.get('items', []), as_events)
 
 
-def get_specific_time_events(api, year, month=0, day=0):
+def iter_year_future_events(api, starting_time, number_of_years, page_size=DEFAULT_PAGE_SIZE, shard=None,
+                            workers=DEFAULT_WORKERS, calendar_ids=None, per_calendar_limit=None,
+                            expand_locally=False):
+    """
+    Streaming variant of get_year_future_events. Yields every event of the next specified
+    year(s) one at a time instead of only the first page.
+
+    :param api: API of the Google Calendar
+    :param starting_time: The starting time to be used to begin querying for events
+    :param number_of_years: The number of years in the future that we want to search through
+    for events
+    :param page_size: The number of events requested per page
+    :param shard: Optionally 'month' or 'quarter', to fetch the window in shards of that
+    length concurrently (see iter_events_sharded)
+    :param workers: The number of shards (or pages) fetched at the same time
+    :param calendar_ids: Optionally the ids of several calendars to read instead of the
+    primary one, yielding (calendar id, event) pairs (see iter_calendars_events)
+    :param per_calendar_limit: The maximum number of events taken from each calendar
+    :param expand_locally: Download the recurring events once and expand their instances
+    locally (see CalendarRecurrence.iter_expanded_events)
+    """
+    new_min, new_max = _future_window(starting_time, number_of_years)
+    if expand_locally:
+        return _iter_expanded(api, new_min, new_max, page_size, shard, calendar_ids)
+    if calendar_ids is not None:
+        if shard is not None:
+            raise ValueError("Sharding is not supported when reading several calendars.")
+        return iter_calendars_events(api, calendar_ids, per_calendar_limit, workers, page_size,
+                                     timeMin=new_min, timeMax=new_max)
+    if shard is not None:
+        return iter_events_sharded(api, new_min, new_max, shard, workers, page_size)
+    return iter_events(api, timeMin=new_min, timeMax=new_max, singleEvents=True, orderBy='startTime',
+                       fields=LIST_FIELDS, page_size=page_size)
+
+
+def get_specific_time_events(api, year, month=0, day=0, store=None, as_events=False):
     """
     (Written for functionality 3)
     Given a year, month, and day, prints the start and name of the events
@@ -142,40 +720,245 @@ def get_specific_time_events(api, year, month=0, day=0):
     provided, all events in the specified year will be shown
     :param day: The day we want to search through for events, if this param is not
     provided, all events in the specified year's month will be shown
+    :param store: An optional CalendarCache.EventStore to answer the query from
+    :param as_events: Return compact Event objects instead of the API's dicts
     """
-    if year <= 0:
-        raise ValueError("Invalid year input.")
-    if month < 0 or month > 12:
-        raise ValueError("Invalid month input.")
-    if day < 0 or day > 31:
-        raise ValueError("Invalid day input.")
+    start_time, end_time = get_specific_time_window(year, month, day)
 
-    # If month and day are not provided, print all events in the year
-    if month == 0 and day == 0:
-        start_time = (datetime.datetime.utcnow().replace(year=year, month=1, day=1, hour=0, minute=0, second=0,
-                                                         microsecond=0))
-        end_time = (start_time + relativedelta(years=+1))
-    # If only day is not provided, print all events in the year's month
-    elif day == 0:
-        start_time = (datetime.datetime.utcnow().replace(year=year, month=month, day=1, hour=0, minute=0, second=0,
-                                                         microsecond=0))
-        end_time = (start_time + relativedelta(months=+1))
-    # If all are given, print events in specific date
+    if store is not None:
+        store.sync(api)
+        return _as_requested(store.query(time_min=start_time, time_max=end_time), as_events)
+
+    events_result = execute_request(api.events().list(calendarId='primary', timeMin=start_time,
+                                                      timeMax=end_time, singleEvents=True,
+                                                      orderBy='startTime', fields=LIST_FIELDS))
+    return _as_requested(events_result.get('items', []), as_events)
+
+
+def iter_specific_time_events(api, year, month=0, day=0, page_size=DEFAULT_PAGE_SIZE, calendar_ids=None,
+                              per_calendar_limit=None, workers=DEFAULT_WORKERS, expand_locally=False):
+    """
+    Streaming variant of get_specific_time_events. Yields every event of the given
+    year, year's month or date one at a time instead of only the first page.
+
+    :param api: API of the Google Calendar
+    :param year: The year we want to search through for events
+    :param month: The month we want to search through for events (optional)
+    :param day: The day we want to search through for events (optional)
+    :param page_size: The number of events requested per page
+    :param calendar_ids: Optionally the ids of several calendars to read instead of the
+    primary one, yielding (calendar id, event) pairs (see iter_calendars_events)
+    :param per_calendar_limit: The maximum number of events taken from each calendar
+    :param workers: The maximum number of pages downloaded at the same time
+    :param expand_locally: Download the recurring events once and expand their instances
+    locally (see CalendarRecurrence.iter_expanded_events)
+    """
+    start_time, end_time = get_specific_time_window(year, month, day)
+    if expand_locally:
+        return _iter_expanded(api, start_time, end_time, page_size, None, calendar_ids)
+    if calendar_ids is not None:
+        return iter_calendars_events(api, calendar_ids, per_calendar_limit, workers, page_size,
+                                     timeMin=start_time, timeMax=end_time)
+    return iter_events(api, timeMin=start_time, timeMax=end_time, singleEvents=True, orderBy='startTime',
+                       fields=LIST_FIELDS, page_size=page_size)
+
+
+def _iter_expanded(api, time_min, time_max, page_size, shard, calendar_ids):
+    if shard is not None or calendar_ids is not None:
+        raise ValueError("Local expansion only reads the primary calendar without shards.")
+    import CalendarRecurrence
+    return CalendarRecurrence.iter_expanded_events(api, time_min, time_max, page_size=page_size)
+
+
+def get_event_details(api, event_id, calendar_id='primary', fields=DETAIL_FIELDS):
+    """
+    Fetches the fields of a single event shown in its detailed view.
+
+    :param api: API of the Google Calendar
+    :param event_id: The id of the event
+    :param calendar_id: The calendar the event is in
+    :param fields: The fields to fetch, None for the full event
+    """
+    return execute_request(api.events().get(calendarId=calendar_id, eventId=event_id, fields=fields))
+
+
+def _event_fields(event):
+    """
+    Returns the id, start, end, summary and reminders (as (minutes, method) pairs, None
+    for the default reminder) of an event dict or Event.
+    """
+    if isinstance(event, Event):
+        reminders = None if event.default_reminders else event.reminders
+        return event.id, event.start_text, event.end_text, event.summary, reminders
+    start = event['start'].get('dateTime', event['start'].get('date'))
+    end = event['end'].get('dateTime', event['end'].get('date')) if 'end' in event else ''
+    event_reminders = event.get('reminders', {})
+    if event_reminders.get('useDefault'):
+        reminders = None
     else:
-        start_time = (datetime.datetime.utcnow().replace(year=year, month=month, day=day, hour=0, minute=0, second=0,
-                                                         microsecond=0))
-        end_time = (start_time + relativedelta(days=+1))
+        reminders = [(reminder['minutes'], reminder['method']) for reminder in event_reminders.get('overrides', ())]
+    return event['id'], start, end, event.get('summary', ''), reminders
+
 
-    start_time = start_time.isoformat() + "Z"
-    end_time = end_time.isoformat() + "Z"
+def format_reminders(reminders):
+    """
+    Returns the text shown for the reminders of an event in the listings.
 
-    events_result = api.events().list(calendarId='primary', timeMin=start_time,
-                                      timeMax=end_time, singleEvents=True,
-                                      orderBy='startTime').execute()
-    return events_result.get('items', [])
+    :param reminders: (minutes, method) pairs, or None for the default reminder
+    """
+    if reminders is None:
+        return "{Time: 10 minutes before, Method: pop-up}"
+    return "".join(["{Time: " + str(minutes) + " minutes before, Method: " + str(method) + "}"
+                    for minutes, method in reminders])
+
+
+def _format_lines(events, output_format, numbered):
+    """
+    Yields the lines of the listing of the events in the given format.
+    """
+    if output_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='')
+        for event_id, start, end, summary, reminders in map(_event_fields, events):
+            writer.writerow((event_id, start, end, summary, '' if reminders is None else
+                             ';'.join(str(minutes) + ':' + method for minutes, method in reminders),
+                             reminders is None))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    elif output_format == 'jsonl':
+        for event in events:
+            if isinstance(event, Event):
+                event = event.raw or _event_dict(event)
+            yield json.dumps(event)
+    else:
+        for position, (event_id, start, end, summary, reminders) in enumerate(map(_event_fields, events), 1):
+            line = start + " " + summary + " | Reminders ->  " + format_reminders(reminders)
+            yield str(position) + " : " + line if numbered else line
+
+
+def _event_dict(event):
+    """
+    Returns the listed fields of an Event in the API's format.
+    """
+    time_key = 'date' if event.all_day else 'dateTime'
+    return {'id': event.id, 'summary': event.summary, 'start': {time_key: event.start_text},
+            'end': {time_key: event.end_text},
+            'reminders': {'useDefault': event.default_reminders,
+                          'overrides': [{'minutes': minutes, 'method': method} for minutes, method in event.reminders]}}
 
 
-def navigate_calendar(api):
+def format_events(events, output_format='text', numbered=False):
+    """
+    Returns the listing that print_events writes as a string.
+
+    :param events: The events to list, the API's dicts or Event objects
+    :param output_format: 'text', 'jsonl' or 'csv', see print_events
+    :param numbered: Number the events in the text listing, as navigate_calendar does
+    """
+    buffer = io.StringIO()
+    print_events(events, output_format, numbered, buffer)
+    return buffer.getvalue()
+
+
+def print_events(events, output_format='text', numbered=False, stream=None):
+    """
+    Writes the listing of the events to stdout (or the given stream), a few thousand lines
+    at a time instead of one print call per event. The text listing says so when there
+    are no events, and the CSV listing starts with a header row.
+
+    :param events: The events to list, the API's dicts or Event objects (may be a stream)
+    :param output_format: 'text' for the listing shown by main and navigate_calendar,
+    'jsonl' for one JSON object per line or 'csv'
+    :param numbered: Number the events in the text listing, as navigate_calendar does
+    :param stream: The file to write to, sys.stdout by default
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Output format must be one of " + ", ".join(OUTPUT_FORMATS) + ".")
+    stream = stream or sys.stdout
+    if output_format == 'csv':
+        stream.write("id,start,end,summary,reminders,default_reminders\n")
+    lines = _format_lines(events, output_format, numbered)
+    empty = True
+    while True:
+        chunk = list(itertools.islice(lines, PRINT_CHUNK_SIZE))
+        if not chunk:
+            break
+        empty = False
+        chunk.append("")
+        stream.write("\n".join(chunk))
+    if empty and output_format == 'text':
+        stream.write("No events found.\n")
+    stream.flush()
+
+
+def _find_events(api, year, month=0, day=0, store=None, index=None, counts=None, prefetcher=None):
+    """
+    Returns the events of the given year, year's month or date for navigate_calendar,
+    from the index if it covers that window, or from get_specific_time_events otherwise.
+    Windows the counts know to be empty are not fetched at all, and the prefetcher is
+    told about the window so that it fetches the ones around it.
+    """
+    events = None
+    if counts is not None and counts.covers(year, month, day) and counts.count(year, month, day) == 0:
+        CalendarMetrics.record_cache('date_counts', True)
+        events = []
+    if events is None and index is not None:
+        start_time, end_time = get_specific_time_window(year, month, day)
+        covered = index.covers(start_time, end_time)
+        CalendarMetrics.record_cache('interval_index', covered)
+        if covered:
+            events = index.query(start_time, end_time)
+    if events is None and prefetcher is not None:
+        events = prefetcher.get(year, month, day)
+        CalendarMetrics.record_cache('prefetch', events is not None)
+    if events is None:
+        events = get_specific_time_events(api, year, month, day, store=store)
+    if prefetcher is not None:
+        prefetcher.visit(year, month, day, events)
+    return events
+
+
+def _refresh_counts(api, counts, store=None, counted=None, prefetcher=None):
+    """
+    Brings the counts of navigate_calendar up to date before they are shown or used to
+    skip empty windows, and returns the generation of the store they were counted from.
+    With a local store they are counted again whenever it changed (it is synced when it
+    is stale, or by push notifications), otherwise they follow the calendar with an
+    incremental sync once they are older than COUNTS_MAX_AGE, and the prefetched windows
+    of the events it brings are invalidated.
+    """
+    if store is not None:
+        store.sync(api)
+        if counted != store.generation:
+            counted = store.generation
+            counts.reset(store.query())
+    elif time.time() - counts.synced_at >= COUNTS_MAX_AGE:
+        changed = counts.sync(api)
+        if prefetcher is not None:
+            windows = {window for day in changed for window in
+                       ((day.year, 0, 0), (day.year, day.month, 0), (day.year, day.month, day.day))}
+            for window in windows:
+                prefetcher.invalidate(*window)
+    return counted
+
+
+def _print_counts(counts, year=0, month=0):
+    """
+    Prints the number of events of the years, of the months of a year or of the days of
+    a month, for navigate_calendar.
+    """
+    if year == 0:
+        label, keys = "year", "{}"
+    elif month == 0:
+        label, keys = "month", "{}-{{:02d}}".format(year)
+    else:
+        label, keys = "day", "{}-{:02d}-{{:02d}}".format(year, month)
+    buckets = ", ".join(keys.format(key) + " (" + str(count) + ")" for key, count in counts.buckets(year, month))
+    print("Events per " + label + ": " + (buckets or "none"))
+
+
+def navigate_calendar(api, store=None, index=None, counts=None, prefetcher=None):
     """
     (Written for functionality 3)
     This function prints out a menu that simulates the process of navigating
@@ -184,8 +967,24 @@ def navigate_calendar(api):
     is in accordance with user story 3 in the assignment.
 
     :param api: API of the Google Calendar
+    :param store: An optional CalendarCache.EventStore to answer the queries from
+    :param index: An optional CalendarIndex.IntervalIndex of already fetched events, used
+    for the windows it covers. Without a store, the events of the last year or month
+    fetched are indexed as well, so that its months and days are answered without
+    fetching them for WINDOW_MAX_AGE seconds
+    :param counts: An optional CalendarIndex.DateCountIndex, to show how many events the
+    years, months and days have before one is chosen, and skip fetching the empty ones.
+    They are kept up to date with the store, or synced once they are older than
+    COUNTS_MAX_AGE
+    :param prefetcher: An optional CalendarPrefetch.WindowPrefetcher, to fetch the windows
+    next to the one shown in the background while its events are read
     """
     events = None
+    # The generation of the store the counts were last counted from
+    counted = None
+    # An index over the events of the last year or month fetched, and when it was built
+    drilled = None
+    drilled_at = 0
     while True:
         try:
             # Menu for user to choose year/month/date to view events
@@ -198,55 +997,80 @@ def navigate_calendar(api):
                   "------------------------------------")
             user_input = int(input("Enter option: "))
 
+            if counts is not None and user_input in (1, 2, 3):
+                counted = _refresh_counts(api, counts, store, counted, prefetcher)
+                _print_counts(counts)
+
             if user_input == 1:
                 year_input = int(input("Please input year: "))
-                events = get_specific_time_events(api, year_input)
+                window = (year_input, 0, 0)
 
             elif user_input == 2:
                 year_input = int(input("Please input year: "))
+                if counts is not None:
+                    _print_counts(counts, year_input)
                 month_input = int(input("Please input month: "))
-                events = get_specific_time_events(api, year_input, month_input)
+                window = (year_input, month_input, 0)
 
             elif user_input == 3:
                 year_input = int(input("Please input year: "))
+                if counts is not None:
+                    _print_counts(counts, year_input)
                 month_input = int(input("Please input month: "))
+                if counts is not None:
+                    _print_counts(counts, year_input, month_input)
                 day_input = int(input("Please input day: "))
-                events = get_specific_time_events(api, year_input, month_input, day_input)
+                window = (year_input, month_input, day_input)
 
             elif user_input == 4:
+                if prefetcher is not None:
+                    prefetcher.cancel()
                 break
 
+            if user_input in (1, 2, 3):
+                start_time, end_time = get_specific_time_window(*window)
+                if drilled is not None and time.time() - drilled_at >= WINDOW_MAX_AGE:
+                    drilled = None
+                covering = index if index is not None and index.covers(start_time, end_time) else drilled
+                events = _find_events(api, *window, store=store, index=covering, counts=counts,
+                                      prefetcher=prefetcher)
+                # The months and days of a year or month fetched from the API are answered from
+                # its events, drilling down does not fetch them again
+                if store is None and window[2] == 0 and (covering is None or
+                                                         not covering.covers(start_time, end_time)):
+                    import CalendarIndex
+                    drilled = CalendarIndex.IntervalIndex(events, start_time, end_time)
+                    drilled_at = time.time()
+
             # Prints out the list of events that have been queried
             print("\nResults: \n")
-            i = 1
-            if not events:
-                print('No events found.')
-            for event in events:
-                Reminders = ""
-                start = event['start'].get('dateTime', event['start'].get('date'))
-                if event['reminders'].get('useDefault'):
-                    Reminders += "{Time: 10 minutes before, Method: pop-up}"
-                else:
-                    if event['reminders'].get('overrides') is not None:
-                        for reminder in event['reminders'].get('overrides'):
-                            Reminders += "{Time: "
-                            Reminders += str(reminder['minutes'])
-                            Reminders += " minutes before, Method: "
-                            Reminders += str(reminder['method'])
-                            Reminders += "}"
-                print(str(i), ":", start, event['summary'], "| Reminders -> ", Reminders)
-                i += 1
+            print_events(events, numbered=True)
             print("\n")
 
             # Prints out detailed information about a specific event chosen
             if events:
                 idx = int(input("Please input the number associated with the specific event to view detailed "
                                 "information or please input 0 to exit: "))
-                if idx > i:
+                if idx > len(events):
                     raise ValueError
 
                 if idx != 0:
                     specific_event = events[idx - 1]
+                    # The index may hold compact Event objects, with the event dict (if any) kept raw
+                    if isinstance(specific_event, Event):
+                        specific_event = specific_event.raw or {'id': specific_event.id}
+                    # The listing only has a few fields of the events, the rest is fetched when shown
+                    if 'htmlLink' not in specific_event:
+                        listed = specific_event
+                        specific_event = get_event_details(api, specific_event['id'])
+                        # The event changed since the window was fetched, so it is fetched again
+                        # the next time it is shown. Only the fields the listing has are compared,
+                        # an Event of the index may only give its id
+                        if any(listed[key] != specific_event.get(key)
+                               for key in ('status', 'summary', 'start', 'end') if key in listed):
+                            drilled = None
+                            if prefetcher is not None:
+                                prefetcher.invalidate(*window)
                     print("\n")
                     print("Kind: " + specific_event["kind"] + "\n" +
                           "Id: " + specific_event["id"] + "\n" +
@@ -268,26 +1092,55 @@ def navigate_calendar(api):
             print("Invalid input. Please try again.")
 
 
-def search_event(api, keyword):
+def search_event(api, keyword, store=None, as_events=False):
     """
     (Written for functionality 4)
     Searches through the user's calendar for events that contain the specified
-    keyword and returns them.
+    keyword (ignoring case) and returns them. See CalendarSearch.search_events for a
+    search that is filtered by the API instead of listing the whole calendar.
 
     :param api: API of the Google Calendar
     :param keyword: The keyword of the event that we want to search for
+    :param store: An optional CalendarCache.EventStore to answer the query from
+    :param as_events: Return compact Event objects instead of the API's dicts
     """
+    if store is not None:
+        store.sync(api)
+        return _as_requested(store.search(keyword), as_events)
+
     keyword = keyword.lower()
-    events_result = api.events().list(calendarId='primary',
-                                      singleEvents=True,
-                                      orderBy='startTime').execute()
+    events_result = execute_request(api.events().list(calendarId='primary',
+                                                      singleEvents=True,
+                                                      orderBy='startTime', fields=LIST_FIELDS))
     search_res = []
     for event in events_result.get('items', []):
         # If the event's summary contains the keyword that we are looking for,
         # append it to the output list
-        if keyword in event['summary']:
+        if keyword in event.get('summary', '').lower():
             search_res.append(event)
-    return search_res
+    return _as_requested(search_res, as_events)
+
+
+def iter_search_event(api, keyword, page_size=DEFAULT_PAGE_SIZE, calendar_ids=None, per_calendar_limit=None,
+                      workers=DEFAULT_WORKERS):
+    """
+    Streaming variant of search_event. Yields the events whose summary contains the
+    keyword one at a time, going through every page of the calendar.
+
+    :param api: API of the Google Calendar
+    :param keyword: The keyword of the event that we want to search for
+    :param page_size: The number of events requested per page
+    :param calendar_ids: Optionally the ids of several calendars to search instead of the
+    primary one, yielding (calendar id, event) pairs (see iter_calendars_events)
+    :param per_calendar_limit: The maximum number of matching events taken from each calendar
+    :param workers: The maximum number of pages downloaded at the same time
+    """
+    keyword = keyword.lower()
+    if calendar_ids is not None:
+        return iter_calendars_events(api, calendar_ids, per_calendar_limit, workers, page_size,
+                                     predicate=lambda event: keyword in event.get('summary', '').lower())
+    events = iter_events(api, singleEvents=True, orderBy='startTime', fields=LIST_FIELDS, page_size=page_size)
+    return (event for event in events if keyword in event.get('summary', '').lower())
 
 
 def delete_event_by_name(api, event_name):
@@ -299,35 +1152,24 @@ def delete_event_by_name(api, event_name):
     :param event_name: Name of the event that is to be deleted
     """
     found = False
-    res = search_event(api, event_name)
+    # Every page of the calendar is searched, and read before anything is deleted
+    res = list(iter_search_event(api, event_name))
     for item in res:
         found = True
-        api.events().delete(calendarId='primary', eventId=item['id']).execute()
+        execute_request(api.events().delete(calendarId='primary', eventId=item['id']))
     if not found:
         raise ProcessLookupError("No events with that name")
     return True
 
 
-def delete_event_reminder(api, event_name, index, minute=0):
+def _remove_reminder(event, minute=0):
     """
-    (Written for functionality 5)
-    Deletes a specific event's reminder based on the time set for the reminder
-    (In minutes format)
+    Removes the reminder set the given number of minutes before the event, or all of its
+    reminders if minute is 0, by changing the event's reminders in place.
 
-    :param api: API of the Google Calendar
-    :param event_name: Name of the event that is to be deleted
-    :param index: Since it is possible to have more than 1 event with the same name,
-    index specifies the specific event that we are operating on
+    :param event: The event whose reminder is removed
     :param minute: The minutes for the reminder that we want to delete
     """
-    # Searches for events with the specified name
-    res = search_event(api, event_name)
-    # Uses the index provided to obtain the specific event that we are operating on
-    try:
-        event = (list(res)[index])
-    except IndexError:
-        raise IndexError("Invalid event.")
-
     new_reminder = []
 
     # If the value of minute is not 0, this means we are deleting a specific reminder
@@ -360,41 +1202,492 @@ def delete_event_reminder(api, event_name, index, minute=0):
             'useDefault': False
         }
 
-    api.events().update(calendarId='primary', eventId=event['id'], body=event).execute()
+
+def delete_event_reminder(api, event_name, index, minute=0):
+    """
+    (Written for functionality 5)
+    Deletes a specific event's reminder based on the time set for the reminder
+    (In minutes format)
+
+    :param api: API of the Google Calendar
+    :param event_name: Name of the event that is to be deleted
+    :param index: Since it is possible to have more than 1 event with the same name,
+    index specifies the specific event that we are operating on, numbered like the
+    events listed by the search command
+    :param minute: The minutes for the reminder that we want to delete
+    """
+    # Searches every page of the calendar for events with the specified name
+    res = iter_search_event(api, event_name)
+    # Uses the index provided to obtain the specific event that we are operating on
+    try:
+        event = (list(res)[index])
+    except IndexError:
+        raise IndexError("Invalid event.")
+
+    _remove_reminder(event, minute)
+
+    # Only the reminders are sent, since the listed event does not have all of its fields
+    execute_request(api.events().patch(calendarId='primary', eventId=event['id'],
+                                       body={'reminders': event['reminders']}, fields='id'))
     return True
 
 
-def main():
-    api = get_calendar_api()
-    # navigate_calendar(api)
-    time_now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
+def get_error_status(error):
+    """
+    Returns the HTTP status of a failed API request, or None if the error did not come
+    from an HTTP response.
+
+    :param error: The exception raised by the request
+    """
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+
+def execute_batch(api, operations, batch_size=BATCH_SIZE, retries=2):
+    """
+    Sends many requests in batches of up to batch_size requests each, instead of one round
+    trip per request. Requests that are throttled, or that are idempotent and fail with a
+    server error (see CalendarScheduler.is_retryable), are sent again after a backoff, up
+    to the given number of retries, without resending the ones that succeeded.
+
+    Returns a (results, errors) pair of dicts mapping the key of every operation to its
+    response or to the exception it failed with.
+
+    :param api: API of the Google Calendar
+    :param operations: (key, method, kwargs) tuples, e.g. (event id, api.events().delete, {...})
+    :param batch_size: The maximum number of requests per batch
+    :param retries: The number of times failed requests are retried
+    """
+    if batch_size <= 0 or batch_size > BATCH_SIZE:
+        raise ValueError("Batch size must be between 1 and " + str(BATCH_SIZE) + ".")
+
+    scheduler = CalendarScheduler.get_scheduler()
+    results = {}
+    errors = {}
+    pending = list(operations)
+    for attempt in range(retries + 1):
+        if attempt:
+            scheduler.wait(attempt - 1, any(CalendarScheduler.is_throttled(errors[key]) for key, _, _ in pending))
+        failed = []
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+
+            requests = [method(**kwargs) for key, method, kwargs in chunk]
+            idempotent = [request.method in CalendarScheduler.IDEMPOTENT_METHODS for request in requests]
+
+            def callback(request_id, response, exception, chunk=chunk, idempotent=idempotent):
+                key = chunk[int(request_id)][0]
+                if exception is None:
+                    results[key] = response
+                    errors.pop(key, None)
+                else:
+                    errors[key] = exception
+                    if CalendarScheduler.is_retryable(exception, idempotent[int(request_id)]):
+                        failed.append(chunk[int(request_id)])
+
+            batch = api.new_batch_http_request(callback=callback)
+            for position, request in enumerate(requests):
+                batch.add(CalendarMetrics.track(request), request_id=str(position))
+            # Every request of a batch counts against the quota, and the batch is only sent
+            # again after a server error if every request in it may be
+            execute_request(batch, 'batch', cost=len(chunk), idempotent=all(idempotent))
+        if not failed:
+            break
+        pending = failed
+    return results, errors
+
+
+def delete_events_by_name(api, event_name, batch_size=BATCH_SIZE):
+    """
+    Bulk version of delete_event_by_name. Deletes every event matching the given name
+    using batched requests instead of one round trip per event.
+
+    Returns a (results, errors) pair of dicts keyed by event id, see execute_batch.
+
+    :param api: API of the Google Calendar
+    :param event_name: Name of the events that are to be deleted
+    :param batch_size: The maximum number of deletes per batch
+    """
+    # Every page of the calendar is searched, not only the first one
+    res = list(iter_search_event(api, event_name))
+    if not res:
+        raise ProcessLookupError("No events with that name")
+
+    operations = [(item['id'], api.events().delete, {'calendarId': 'primary', 'eventId': item['id']})
+                  for item in res]
+    return execute_batch(api, operations, batch_size)
+
+
+def delete_events_reminder(api, event_name, minute=0, batch_size=BATCH_SIZE):
+    """
+    Bulk version of delete_event_reminder. Deletes the reminder set the given number of
+    minutes before every event matching the given name (or all of their reminders if
+    minute is 0), sending the updates in batches. Events that do not have the reminder
+    are reported in the errors instead of stopping the others from being updated.
+
+    Returns a (results, errors) pair of dicts keyed by event id, see execute_batch.
+
+    :param api: API of the Google Calendar
+    :param event_name: Name of the events whose reminder is to be deleted
+    :param minute: The minutes for the reminder that we want to delete
+    :param batch_size: The maximum number of updates per batch
+    """
+    res = list(iter_search_event(api, event_name))
+    if not res:
+        raise ProcessLookupError("No events with that name")
+
+    operations = []
+    skipped = {}
+    for event in res:
+        try:
+            _remove_reminder(event, minute)
+        except ProcessLookupError as error:
+            skipped[event['id']] = error
+            continue
+        operations.append((event['id'], api.events().patch,
+                           {'calendarId': 'primary', 'eventId': event['id'], 'body': {'reminders': event['reminders']},
+                            'fields': 'id'}))
+
+    results, errors = execute_batch(api, operations, batch_size)
+    errors.update(skipped)
+    return results, errors
+
+
+class _LazyApi:
+    """
+    Stands in for the API object and only builds it (see get_calendar_api) when it is
+    first used, so that commands answered from the local store do not pay for it.
+    """
+
+    def __init__(self, transport=None):
+        self._api = None
+        self._transport = transport
+        self._lock = threading.Lock()
 
-    events = []
-    # events = get_upcoming_events(api, time_now, 10)
-    # events = get_year_past_events(api, time_now, 5)
-    # events = get_year_future_events(api, time_now, 2)
-    # events = get_specific_time_events(api, 2020, 8, 17)
-    events = search_event(api, 'john')
-    # delete_event_reminder(api, 'testing', 0, 22)
-    # delete_event(api,'test1')
-    if not events:
-        print('No events found.')
-    for event in events:
-        Reminders = ""
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        if event['reminders'].get('useDefault'):
-            Reminders += "{Time: 10 minutes before, Method: pop-up}"
+    def __getattr__(self, name):
+        with self._lock:
+            if self._api is None:
+                self._api = get_calendar_api(transport=self._transport() if self._transport else None)
+        return getattr(self._api, name)
+
+
+def _build_parser():
+    """
+    Returns the parser of the command line interface.
+    """
+    parser = argparse.ArgumentParser(prog='Calendar.py', description="Query and edit your Google Calendar.")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='text', help="how the events are printed")
+    parser.add_argument('--cache', action='store_true', help="answer queries from a local event store")
+    parser.add_argument('--cache-file', default=DEFAULT_CACHE_PATH, metavar='PATH',
+                        help="the file of the local event store (default: %(default)s)")
+    parser.add_argument('--max-age', type=float, metavar='SECONDS',
+                        help="how old the local event store may be before it is synced again")
+    parser.add_argument('--rate', type=float, metavar='REQUESTS',
+                        help="the maximum number of API requests per second, unlimited by default")
+    parser.add_argument('--concurrency', type=int, metavar='REQUESTS',
+                        help="the maximum number of API requests in flight at the same time (default: %d, or "
+                             "--workers if more)" % CalendarScheduler.DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument('--stats', action='store_true', help="print the API calls made and the cache hits to stderr")
+    parser.add_argument('--trace', action='store_true', help="log every API call to stderr")
+    parser.add_argument('--metrics-file', metavar='PATH', help="write the metrics to a Prometheus text file")
+    parser.add_argument('--profile', action='store_true', help="print the hottest functions of the run to stderr")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    upcoming = commands.add_parser('upcoming', help="the next events")
+    upcoming.add_argument('-n', '--number', type=int, default=10, help="the number of events")
+
+    for name, years, description in (('past', 5, "the events of the past years"),
+                                      ('future', 2, "the events of the next years")):
+        command = commands.add_parser(name, help=description)
+        command.add_argument('--years', type=int, default=years, help="the number of years")
+        command.add_argument('--shard', choices=sorted(SHARD_LENGTHS), help="fetch the years in concurrent shards")
+        command.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="the number of concurrent shards")
+        command.add_argument('--expand-locally', action='store_true',
+                             help="download recurring events once and expand their instances locally")
+
+    date = commands.add_parser('date', help="the events of a year, month or day")
+    date.add_argument('year', type=int)
+    date.add_argument('month', type=int, nargs='?', default=0)
+    date.add_argument('day', type=int, nargs='?', default=0)
+    date.add_argument('--expand-locally', action='store_true',
+                      help="download recurring events once and expand their instances locally")
+
+    search = commands.add_parser('search', help="the events whose name contains a keyword")
+    search.add_argument('keyword')
+
+    delete = commands.add_parser('delete', help="delete the events with a name")
+    delete.add_argument('name')
+
+    delete_reminder = commands.add_parser('delete-reminder', help="delete a reminder of the events with a name")
+    delete_reminder.add_argument('name')
+    delete_reminder.add_argument('--minute', type=int, default=0,
+                                 help="the minutes of the reminder to delete, all reminders by default")
+    delete_reminder.add_argument('--index', type=int,
+                                 help="only change the event with this index, all of them by default")
+
+    reminders = commands.add_parser('reminders', help="add, remove or replace the reminders of many events",
+                                    description="Applies the reminder changes, in the order given, to every "
+                                                "event matching the conditions.")
+    reminders.add_argument('--keyword', help="only change the events whose name contains this keyword")
+    reminders.add_argument('--from', dest='time_min', metavar='TIME', help="only change the events ending after "
+                                                                         "this RFC3339 time")
+    reminders.add_argument('--to', dest='time_max', metavar='TIME', help="only change the events starting before "
+                                                                       "this RFC3339 time")
+    reminders.add_argument('--calendar', dest='calendar_ids', action='append', metavar='ID',
+                           help="change the events of this calendar (repeatable), the primary one by default")
+    reminders.add_argument('--add', dest='operations', action='append', type=_reminder_argument('add'),
+                           metavar='[METHOD:]MINUTES', help="add a reminder, a popup by default")
+    reminders.add_argument('--remove', dest='operations', action='append', type=_reminder_argument('remove'),
+                           metavar='[METHOD:]MINUTES', help="remove a reminder, or every reminder with 'all'")
+    reminders.add_argument('--replace', dest='operations', action='append', type=_reminder_argument('replace'),
+                           metavar='[METHOD:]MINUTES,...', help="replace every reminder, with none if empty")
+    reminders.add_argument('--default', dest='operations', action='append_const', const=('default',),
+                           help="use the calendar's default reminders")
+
+    free = commands.add_parser('free', help="the times a group of calendars is free")
+    free.add_argument('calendar_ids', nargs='*', metavar='calendar',
+                      help="the calendars (or email addresses) to check, the primary one by default")
+    free.add_argument('--from', dest='time_min', metavar='TIME', help="the RFC3339 start of the window, now by default")
+    free.add_argument('--to', dest='time_max', metavar='TIME',
+                      help="the RFC3339 end of the window, a week after its start by default")
+    free.add_argument('--minutes', type=int, default=30, help="the shortest free time wanted")
+    free.add_argument('--max-busy', type=int, default=0, help="the number of calendars allowed to be busy")
+
+    navigate = commands.add_parser('navigate', help="browse the calendar interactively")
+    navigate.add_argument('--counts', action='store_true',
+                          help="count the events of every year, month and day first, and show the counts")
+    navigate.add_argument('--prefetch', action='store_true',
+                          help="fetch the windows next to the one shown in the background")
+    navigate.add_argument('--watch', metavar='ADDRESS',
+                          help="keep the local event store up to date from push notifications sent to this "
+                               "HTTPS address, which must forward them to --watch-port, instead of polling")
+    navigate.add_argument('--watch-port', type=int, default=8081, metavar='PORT',
+                          help="the local port receiving the notifications (default: %(default)s)")
+    return parser
+
+
+def _reminder_argument(kind):
+    """
+    Returns the argparse type of a reminder option, which parses it into a (kind, value)
+    pair, where the value is a (method, minutes) pair, None for every reminder, or a list
+    of pairs for 'replace'.
+    """
+    def parse_reminder(text):
+        method, _, minutes = text.rpartition(':')
+        return method or None, int(minutes)
+
+    def parse(text):
+        try:
+            if kind == 'replace':
+                return kind, [parse_reminder(item) for item in text.split(',') if item.strip()]
+            if kind == 'remove' and text == 'all':
+                return kind, None
+            return kind, parse_reminder(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid reminder " + repr(text))
+    return parse
+
+
+def _run_command(api, store, args):
+    """
+    Runs a parsed command and returns the events to print, or None if there are none.
+    """
+    time_now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
+    if args.command == 'upcoming':
+        if store is not None:
+            return get_upcoming_events(api, time_now, args.number, store=store)
+        return iter_upcoming_events(api, time_now, args.number)
+    if args.command in ('past', 'future'):
+        if store is not None:
+            get_events = get_year_past_events if args.command == 'past' else get_year_future_events
+            return get_events(api, time_now, args.years, store=store)
+        iter_range = iter_year_past_events if args.command == 'past' else iter_year_future_events
+        return iter_range(api, time_now, args.years, shard=args.shard, workers=args.workers,
+                          expand_locally=args.expand_locally)
+    if args.command == 'date':
+        if store is not None:
+            return get_specific_time_events(api, args.year, args.month, args.day, store=store)
+        return iter_specific_time_events(api, args.year, args.month, args.day, expand_locally=args.expand_locally)
+    if args.command == 'search':
+        if store is not None:
+            return search_event(api, args.keyword, store=store)
+        # The API's q parameter only matches whole words, so the names are matched locally
+        # to find any part of them, as search_event does
+        return iter_search_event(api, args.keyword)
+    if args.command == 'delete':
+        results, errors = delete_events_by_name(api, args.name)
+        _report(results, errors, "Deleted")
+    elif args.command == 'delete-reminder':
+        if args.index is not None:
+            delete_event_reminder(api, args.name, args.index, args.minute)
+            _report([args.index], {}, "Updated")
         else:
-            if event['reminders'].get('overrides') is not None:
-                for reminder in event['reminders'].get('overrides'):
-                    Reminders += "{Time: "
-                    Reminders += str(reminder['minutes'])
-                    Reminders += " minutes before, Method: "
-                    Reminders += str(reminder['method'])
-                    Reminders += "}"
-        print(start, event['summary'], "| Reminders -> ", Reminders)
-    # print(delete_event_by_name(api, "testing"))
+            results, errors = delete_events_reminder(api, args.name, args.minute)
+            _report(results, errors, "Updated")
+    elif args.command == 'reminders':
+        import CalendarReminders
+        if not args.operations:
+            raise ValueError("At least one of --add, --remove, --replace or --default is needed.")
+        operations = []
+        for kind, value in args.operations:
+            if kind == 'add':
+                operations.append(CalendarReminders.AddReminder(value[1], value[0] or 'popup'))
+            elif kind == 'remove':
+                method, minutes = value or (None, None)
+                operations.append(CalendarReminders.RemoveReminder(minutes, method))
+            elif kind == 'replace':
+                operations.append(CalendarReminders.ReplaceReminders([(method or 'popup', minutes)
+                                                                      for method, minutes in value]))
+            else:
+                operations.append(CalendarReminders.UseDefaultReminders())
+        results, errors = CalendarReminders.edit_reminders(api, operations, args.keyword, args.time_min,
+                                                           args.time_max, args.calendar_ids)
+        _report(results, {'/'.join(key): error for key, error in errors.items()}, "Updated")
+    elif args.command == 'free':
+        import CalendarAvailability
+        time_min = args.time_min or time_now
+        time_max = args.time_max or (datetime.datetime.fromisoformat(time_min[:-1]) +
+                                     datetime.timedelta(days=7)).isoformat() + 'Z'
+        slots, errors = CalendarAvailability.find_free_slots(api, args.calendar_ids or ['primary'], time_min,
+                                                             time_max, args.minutes, args.max_busy)
+        for start, end in slots:
+            print(start, '-', end)
+        for calendar_id, error in errors.items():
+            print("Failed", calendar_id + ":", error, file=sys.stderr)
+    elif args.command == 'navigate':
+        # The windows are only prefetched from the API, the local store answers right away
+        prefetch = args.prefetch and store is None
+        if args.watch and store is None:
+            raise ValueError("--watch needs the local event store (--cache).")
+        counts = None
+        if args.counts:
+            import CalendarIndex
+            if store is not None:
+                # navigate_calendar counts the events of the store, and again whenever it changes
+                counts = CalendarIndex.DateCountIndex()
+            else:
+                counts = CalendarIndex.DateCountIndex.build(api)
+        if prefetch:
+            import CalendarPrefetch
+            with CalendarPrefetch.WindowPrefetcher(api) as prefetcher:
+                navigate_calendar(api, counts=counts, prefetcher=prefetcher)
+        elif args.watch:
+            import CalendarWatch
+            with CalendarWatch.WatchManager(api, args.watch, port=args.watch_port) as manager:
+                manager.keep_synced(store)
+                navigate_calendar(api, store=store, counts=counts)
+        else:
+            navigate_calendar(api, store=store, counts=counts)
+    return None
+
+
+def _report(results, errors, action):
+    """
+    Prints how many events a mutation changed, and why the others failed.
+    """
+    print(action, len(results), "event(s).")
+    for event_id, error in errors.items():
+        print("Failed", event_id + ":", error, file=sys.stderr)
+
+
+def main(argv=None):
+    """
+    Runs the command line interface, e.g. `python Calendar.py --format csv past --years 5`,
+    and returns its exit status. See `python Calendar.py --help` for the commands. The
+    events go to stdout and the errors to stderr, so the output can be piped or used from
+    cron. With --cache the queries are answered from a local event store, and the API is
+    only built when the store needs to be synced. --stats, --trace, --metrics-file and
+    --profile report on the API calls the command made (see CalendarMetrics).
+
+    :param argv: The command line arguments, sys.argv[1:] by default
+    """
+    args = _build_parser().parse_args(argv)
+    if args.rate is not None and args.rate <= 0:
+        print("Error: Rate must be positive.", file=sys.stderr)
+        return 1
+    if args.concurrency is not None and args.concurrency < 1:
+        print("Error: Concurrency must be at least 1.", file=sys.stderr)
+        return 1
+    # The scheduler lets every worker of the command have a request in flight
+    concurrency = args.concurrency or max(CalendarScheduler.DEFAULT_MAX_CONCURRENCY, getattr(args, 'workers', 0))
+    if args.rate is not None or concurrency != CalendarScheduler.DEFAULT_MAX_CONCURRENCY:
+        CalendarScheduler.set_scheduler(CalendarScheduler.RequestScheduler(rate=args.rate,
+                                                                           max_concurrency=concurrency))
+    sinks = _metrics_sinks(args)
+    for sink in sinks:
+        CalendarMetrics.add_sink(sink)
+    try:
+        if args.profile:
+            with CalendarMetrics.profile():
+                return _run(args)
+        return _run(args)
+    finally:
+        for sink in sinks:
+            CalendarMetrics.remove_sink(sink)
+            if isinstance(sink, CalendarMetrics.PrometheusFileSink):
+                sink.write()
+            elif isinstance(sink, CalendarMetrics.Stats):
+                print(sink.format(), file=sys.stderr)
+
+
+def _metrics_sinks(args):
+    """
+    Returns the CalendarMetrics sinks asked for on the command line.
+    """
+    sinks = []
+    if args.stats:
+        sinks.append(CalendarMetrics.Stats())
+    if args.metrics_file:
+        sinks.append(CalendarMetrics.PrometheusFileSink(args.metrics_file))
+    if args.trace:
+        logger = logging.getLogger('Calendar')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.StreamHandler(sys.stderr))
+        sinks.append(CalendarMetrics.LogSink(logger))
+    return sinks
+
+
+def _sends_in_parallel(args):
+    """
+    Returns whether a parsed command may send requests from several threads, in which
+    case the API has to be built on a CalendarTransport.ConnectionPool.
+    """
+    if args.command in ('past', 'future'):
+        return not args.cache and args.shard is not None and args.workers > 1
+    if args.command == 'reminders':
+        return args.calendar_ids is not None and len(args.calendar_ids) > 1
+    if args.command == 'navigate':
+        # The prefetcher and the notifications send their requests from other threads
+        return (args.prefetch and not args.cache) or args.watch is not None
+    return args.command == 'free'
+
+
+def _run(args):
+    """
+    Runs the parsed command line and returns its exit status.
+    """
+    if _sends_in_parallel(args):
+        import CalendarTransport
+        api = _LazyApi(CalendarTransport.ConnectionPool)
+    else:
+        api = _LazyApi()
+    store = None
+    if args.cache:
+        import CalendarCache
+        options = {'sync_interval': args.max_age} if args.max_age is not None else {}
+        store = CalendarCache.EventStore(args.cache_file, **options)
+    try:
+        events = _run_command(api, store, args)
+        if events is not None:
+            print_events(events, args.format)
+    except (ValueError, LookupError) as error:
+        print("Error:", error, file=sys.stderr)
+        return 1
+    finally:
+        if store is not None:
+            store.close()
+    return 0
 
 
 if __name__ == "__main__":  # Prevents the main() function from being called by the test suite runner
-    main()
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# Usage reports over the events of the Calendar application.
+# An EventTable holds a stream of events (e.g. from Calendar.iter_year_past_events) as
+# NumPy columns instead of a list of dicts, so that reports over years of history are
+# computed with vectorized operations rather than Python loops.
+
+import numpy as np
+
+import Calendar
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class EventTable:
+    """
+    A columnar table of events. The start and end columns are datetime64[s] arrays (UTC),
+    duration is an int64 array of seconds, and the reminder minutes of every event are
+    stored as one ragged array: the minutes of event i are
+    reminder_minutes[reminder_offsets[i]:reminder_offsets[i + 1]].
+    """
+
+    def __init__(self, ids, summaries, start, end, default_reminders, reminder_minutes, reminder_offsets):
+        self.ids = ids
+        self.summaries = summaries
+        self.start = start
+        self.end = end
+        self.duration = (end - start).astype(np.int64)
+        self.default_reminders = default_reminders
+        self.reminder_minutes = reminder_minutes
+        self.reminder_offsets = reminder_offsets
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_events(cls, events):
+        """
+        Builds a table from a stream of events, either the API's dicts or Calendar.Event
+        objects. The stream is only read once.
+
+        :param events: The events to put in the table
+        """
+        ids, summaries, starts, ends, defaults, minutes, offsets = [], [], [], [], [], [], [0]
+        for event in events:
+            if not isinstance(event, Calendar.Event):
+                event = Calendar.Event.from_dict(event)
+            ids.append(event.id)
+            summaries.append(event.summary)
+            starts.append(event.start)
+            ends.append(event.end)
+            defaults.append(event.default_reminders)
+            minutes.extend(reminder[0] for reminder in event.reminders)
+            offsets.append(len(minutes))
+        return cls(np.array(ids, dtype=object), np.array(summaries, dtype=object),
+                   np.array(starts, dtype='datetime64[s]'), np.array(ends, dtype='datetime64[s]'),
+                   np.array(defaults, dtype=bool), np.array(minutes, dtype=np.int64),
+                   np.array(offsets, dtype=np.int64))
+
+    def _busy_blocks(self):
+        """
+        Returns the start and end (in seconds) of the blocks of time covered by at least
+        one event, i.e. the union of the events' intervals.
+        """
+        order = np.argsort(self.start, kind='stable')
+        starts = self.start[order].astype(np.int64)
+        ends = self.end[order].astype(np.int64)
+        if len(starts) == 0:
+            return starts, ends
+        reach = np.maximum.accumulate(ends)
+        # A new block begins wherever an event starts after everything before it has ended
+        new_block = np.empty(len(starts), dtype=bool)
+        new_block[0] = True
+        new_block[1:] = starts[1:] > reach[:-1]
+        block_ids = np.cumsum(new_block) - 1
+        block_starts = starts[new_block]
+        block_ends = np.full(len(block_starts), np.iinfo(np.int64).min)
+        np.maximum.at(block_ends, block_ids, ends)
+        return block_starts, block_ends
+
+    def busy_hours(self, period='day'):
+        """
+        Returns the hours of every day (or week, starting on Monday) that are covered by at
+        least one event, as a pair of arrays: the first day of each period (datetime64[D])
+        and the busy hours in it. Overlapping events are only counted once, and events
+        spanning several days are split between them.
+
+        :param period: 'day' or 'week'
+        """
+        if period not in ('day', 'week'):
+            raise ValueError("Period must be 'day' or 'week'.")
+        block_starts, block_ends = self._busy_blocks()
+        if len(block_starts) == 0:
+            return np.array([], dtype='datetime64[D]'), np.array([], dtype=float)
+
+        # Split the blocks at midnight, one segment per day they cover
+        first_day = block_starts // _SECONDS_PER_DAY
+        last_day = (block_ends - 1) // _SECONDS_PER_DAY
+        days_covered = np.maximum(last_day - first_day + 1, 1)
+        block_ids = np.repeat(np.arange(len(block_starts)), days_covered)
+        segment_offsets = np.arange(len(block_ids)) - np.repeat(np.cumsum(days_covered) - days_covered, days_covered)
+        days = first_day[block_ids] + segment_offsets
+        segment_starts = np.maximum(block_starts[block_ids], days * _SECONDS_PER_DAY)
+        segment_ends = np.minimum(block_ends[block_ids], (days + 1) * _SECONDS_PER_DAY)
+        seconds = segment_ends - segment_starts
+
+        if period == 'week':
+            # Day 0 (1970-01-01) is a Thursday, so weeks starting on Monday begin 3 days earlier
+            days = (days + 3) // 7 * 7 - 3
+        periods, positions = np.unique(days, return_inverse=True)
+        hours = np.bincount(positions.ravel(), weights=seconds) / 3600
+        return periods.astype('datetime64[D]'), hours
+
+    def overlaps(self):
+        """
+        Returns the pairs of events that overlap in time, as an (n, 2) array of row indexes
+        of the table, the earlier starting event first.
+        """
+        order = np.argsort(self.start, kind='stable')
+        starts = self.start[order]
+        ends = self.end[order]
+        # Every event overlaps the later starting events that start before it ends
+        last = np.searchsorted(starts, ends, side='left')
+        counts = np.maximum(last - np.arange(1, len(starts) + 1), 0)
+        firsts = np.repeat(np.arange(len(starts)), counts)
+        seconds = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + firsts + 1
+        return np.column_stack((order[firsts], order[seconds]))
+
+    def reminder_stats(self):
+        """
+        Returns a dict of statistics about the reminders of the events.
+        """
+        counts = np.diff(self.reminder_offsets)
+        stats = {
+            'events': len(self),
+            'events_with_reminders': int(np.count_nonzero(counts)),
+            'events_with_default_reminders': int(np.count_nonzero(self.default_reminders)),
+            'reminders': int(len(self.reminder_minutes)),
+        }
+        if len(self.reminder_minutes):
+            stats.update({
+                'mean_minutes': float(self.reminder_minutes.mean()),
+                'median_minutes': float(np.median(self.reminder_minutes)),
+                'min_minutes': int(self.reminder_minutes.min()),
+                'max_minutes': int(self.reminder_minutes.max()),
+            })
+        return stats
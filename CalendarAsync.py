@@ -0,0 +1,82 @@
+# Asyncio counterpart of the Calendar application.
+# The Google API client only makes blocking calls, so every operation of Calendar.py is
+# run on a worker thread and exposed here as a coroutine. A semaphore bounds how many of
+# them are in flight at once, so one event loop can run many range queries concurrently
+# without flooding the API.
+#
+# The default http object of the API cannot be shared between threads, so the API should
+# be built on a CalendarTransport.ConnectionPool, e.g.
+#     calendar = AsyncCalendar(Calendar.get_calendar_api(transport=ConnectionPool()))
+
+import asyncio
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import Calendar
+
+# Maximum number of operations running at the same time.
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncCalendar:
+    """
+    Exposes the operations of Calendar.py as coroutines on the given API object.
+
+    :param api: API of the Google Calendar
+    :param max_concurrency: The maximum number of operations running at the same time. Their
+    requests in flight are also capped by the scheduler's max_concurrency (see
+    CalendarScheduler.set_scheduler)
+    :param executor: The executor to run the operations on, a thread pool of
+    max_concurrency threads by default
+    """
+
+    def __init__(self, api, max_concurrency=DEFAULT_CONCURRENCY, executor=None):
+        if max_concurrency <= 0:
+            raise ValueError("Concurrency must be at least 1.")
+        self.api = api
+        self.max_concurrency = max_concurrency
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_concurrency)
+        self._own_executor = executor is None
+        # One semaphore per event loop, as a semaphore is bound to the loop it is first used
+        # on, e.g. when the calendar is used by successive asyncio.run calls
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        async with semaphore:
+            return await loop.run_in_executor(self._executor, functools.partial(function, self.api, *args, **kwargs))
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    async def get_upcoming_events(self, starting_time, number_of_events, **kwargs):
+        return await self._run(Calendar.get_upcoming_events, starting_time, number_of_events, **kwargs)
+
+    async def get_year_past_events(self, starting_time, number_of_years, **kwargs):
+        return await self._run(Calendar.get_year_past_events, starting_time, number_of_years, **kwargs)
+
+    async def get_year_future_events(self, starting_time, number_of_years, **kwargs):
+        return await self._run(Calendar.get_year_future_events, starting_time, number_of_years, **kwargs)
+
+    async def get_specific_time_events(self, year, month=0, day=0, **kwargs):
+        return await self._run(Calendar.get_specific_time_events, year, month, day, **kwargs)
+
+    async def search_event(self, keyword, **kwargs):
+        return await self._run(Calendar.search_event, keyword, **kwargs)
+
+    async def delete_event_by_name(self, event_name):
+        return await self._run(Calendar.delete_event_by_name, event_name)
+
+    async def delete_event_reminder(self, event_name, index, minute=0):
+        return await self._run(Calendar.delete_event_reminder, event_name, index, minute)
+
+    async def delete_events_by_name(self, event_name, **kwargs):
+        return await self._run(Calendar.delete_events_by_name, event_name, **kwargs)
+
+    async def delete_events_reminder(self, event_name, minute=0, **kwargs):
+        return await self._run(Calendar.delete_events_reminder, event_name, minute, **kwargs)
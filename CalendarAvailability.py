@@ -0,0 +1,200 @@
+# Free/busy availability for the Calendar application.
+# Instead of downloading the events of every attendee, query_busy asks the API's
+# freebusy.query for the busy times of up to 50 calendars per request, splitting longer
+# lists of calendars and longer windows into chunks that are sent concurrently.
+# merge_busy combines the busy times of many calendars with a sweep line, and
+# find_free_slots returns the gaps long enough for a meeting, e.g.
+#     slots, errors = find_free_slots(api, attendees, '2024-05-06T08:00:00Z', '2024-05-10T18:00:00Z', 30)
+
+import datetime
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import Calendar
+
+# The most calendars a freebusy.query request may ask for.
+MAX_CALENDARS_PER_QUERY = 50
+
+# The longest window (in days) asked for in one request, longer ones are split.
+MAX_QUERY_DAYS = 60
+
+
+def _rfc3339(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _chunks(items, size):
+    """
+    Splits a list into lists of at most size items.
+    """
+    return [items[position:position + size] for position in range(0, len(items), size)]
+
+
+def _split_range(lower, upper, max_days):
+    """
+    Splits the window between two timestamps into consecutive windows of at most
+    max_days days.
+    """
+    step = max_days * 86400
+    return [(start, min(start + step, upper)) for start in itertools.takewhile(lambda start: start < upper,
+                                                                                itertools.count(lower, step))]
+
+
+def merge_busy(busy_lists, min_busy=1):
+    """
+    Merges the busy times of several calendars with a sweep line over their start and end
+    points, returning the sorted, non-overlapping (start, end) periods during which at
+    least min_busy of the calendars are busy. Takes O(n log n) for n periods.
+
+    :param busy_lists: One list of (start, end) POSIX timestamps per calendar, in any order
+    :param min_busy: The number of calendars that must be busy at the same time
+    """
+    if min_busy < 1:
+        raise ValueError("Number of busy calendars must be at least 1.")
+    points = []
+    for periods in busy_lists:
+        for start, end in periods:
+            if end > start:
+                points.append((start, 1))
+                points.append((end, -1))
+    # Periods starting when others end are joined, since starts are counted first
+    points.sort(key=lambda point: (point[0], -point[1]))
+
+    merged = []
+    busy = 0
+    opened = None
+    for moment, change in points:
+        busy += change
+        if opened is None and busy >= min_busy:
+            opened = moment
+        elif opened is not None and busy < min_busy:
+            if merged and merged[-1][1] == opened:
+                merged[-1] = (merged[-1][0], moment)
+            elif moment > opened:
+                merged.append((opened, moment))
+            opened = None
+    return merged
+
+
+def free_slots(busy, lower, upper, min_length=0):
+    """
+    Returns the (start, end) gaps between sorted, non-overlapping busy periods that lie
+    inside a window and last at least min_length seconds.
+
+    :param busy: The busy periods, as returned by merge_busy
+    :param lower: The POSIX timestamp of the start of the window
+    :param upper: The POSIX timestamp of the end of the window
+    :param min_length: The shortest gap kept, in seconds
+    """
+    slots = []
+    free_from = lower
+    for start, end in busy:
+        if end <= free_from:
+            continue
+        if start >= upper:
+            break
+        if start > free_from and start - free_from >= min_length:
+            slots.append((free_from, start))
+        free_from = max(free_from, end)
+    if upper > free_from and upper - free_from >= min_length:
+        slots.append((free_from, upper))
+    return slots
+
+
+def query_busy(api, calendar_ids, time_min, time_max, workers=Calendar.DEFAULT_WORKERS,
+               chunk_size=MAX_CALENDARS_PER_QUERY, max_days=MAX_QUERY_DAYS):
+    """
+    Returns the busy times of calendars within a window, from freebusy.query. The calendars
+    are asked for in chunks of chunk_size and the window in parts of max_days, and the
+    requests are sent concurrently on up to `workers` threads, so that 50 calendars over
+    a few weeks take a single request.
+
+    The default http object of the API cannot be shared between threads, so the API should
+    be built on a CalendarTransport.ConnectionPool when more than one request is sent.
+
+    Returns a (busy, errors) pair of dicts keyed by calendar id: the busy (start, end)
+    POSIX timestamps of every calendar, sorted and merged, and why the calendars that
+    could not be read (e.g. 'notFound', or the error their request failed with) have none.
+
+    :param api: API of the Google Calendar
+    :param calendar_ids: The ids (or email addresses) of the calendars
+    :param time_min: The RFC3339 start of the window
+    :param time_max: The RFC3339 end of the window
+    :param workers: The maximum number of requests sent at the same time, no more than the
+    scheduler's max_concurrency (see CalendarScheduler.set_scheduler)
+    :param chunk_size: The most calendars asked for per request
+    :param max_days: The longest window asked for per request, in days
+    """
+    if workers <= 0:
+        raise ValueError("Number of workers must be at least 1.")
+    if not 0 < chunk_size <= MAX_CALENDARS_PER_QUERY:
+        raise ValueError("Chunk size must be between 1 and " + str(MAX_CALENDARS_PER_QUERY) + ".")
+    lower = Calendar.get_event_timestamp(time_min)
+    upper = Calendar.get_event_timestamp(time_max)
+    if upper <= lower:
+        raise ValueError("The end of the window must be after its start.")
+    calendar_ids = list(dict.fromkeys(calendar_ids))
+    windows = [(time_min, time_max)] if upper - lower <= max_days * 86400 else \
+        [(_rfc3339(start), _rfc3339(end)) for start, end in _split_range(lower, upper, max_days)]
+    queries = [(chunk, window) for chunk in _chunks(calendar_ids, chunk_size) for window in windows]
+
+    def query(chunk_window):
+        chunk, (window_min, window_max) = chunk_window
+        body = {'timeMin': window_min, 'timeMax': window_max, 'items': [{'id': calendar_id} for calendar_id in chunk]}
+        try:
+            # A POST that only reads, so it may be sent again
+            return chunk, Calendar.execute_request(api.freebusy().query(body=body, fields='calendars'),
+                                                   idempotent=True)
+        except Exception as error:
+            return chunk, error
+
+    if len(queries) == 1 or workers == 1:
+        responses = [query(chunk_window) for chunk_window in queries]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(queries))) as executor:
+            responses = list(executor.map(query, queries))
+
+    busy = {calendar_id: [] for calendar_id in calendar_ids}
+    errors = {}
+    for chunk, response in responses:
+        if isinstance(response, Exception):
+            errors.update((calendar_id, response) for calendar_id in chunk)
+            continue
+        calendars = response.get('calendars', {})
+        for calendar_id in chunk:
+            found = calendars.get(calendar_id, {})
+            if found.get('errors'):
+                errors[calendar_id] = found['errors'][0].get('reason', 'unknown')
+            busy[calendar_id].extend((Calendar.get_event_timestamp(period['start']),
+                                      Calendar.get_event_timestamp(period['end'])) for period in found.get('busy', []))
+    for calendar_id in errors:
+        busy.pop(calendar_id, None)
+    # The parts of a split window may cut a busy period in two
+    return {calendar_id: merge_busy([periods]) for calendar_id, periods in busy.items()}, errors
+
+
+def find_free_slots(api, calendar_ids, time_min, time_max, minutes=30, max_busy=0, workers=Calendar.DEFAULT_WORKERS):
+    """
+    Finds the times within a window when every calendar is free (or at most max_busy of
+    them are busy) for at least the given number of minutes.
+
+    Returns a (slots, errors) pair: the free (start, end) RFC3339 times in order, and the
+    calendars that could not be read (see query_busy), which are left out of the search.
+
+    :param api: API of the Google Calendar
+    :param calendar_ids: The ids (or email addresses) of the calendars
+    :param time_min: The RFC3339 start of the window
+    :param time_max: The RFC3339 end of the window
+    :param minutes: The shortest slot wanted
+    :param max_busy: The number of calendars allowed to be busy during a slot
+    :param workers: The maximum number of requests sent at the same time
+    """
+    if minutes <= 0:
+        raise ValueError("Number of minutes must be at least 1.")
+    if max_busy < 0:
+        raise ValueError("Number of busy calendars must be at least 0.")
+    busy, errors = query_busy(api, calendar_ids, time_min, time_max, workers)
+    merged = merge_busy(busy.values(), max_busy + 1)
+    slots = free_slots(merged, Calendar.get_event_timestamp(time_min), Calendar.get_event_timestamp(time_max),
+                       minutes * 60)
+    return [(_rfc3339(start), _rfc3339(end)) for start, end in slots], errors
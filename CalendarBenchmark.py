@@ -0,0 +1,359 @@
+# Benchmarks of the Calendar application.
+# The import benchmark runs `python -X importtime -c "import Calendar"` in fresh processes
+# and fails if importing the module loads one of the Google client libraries again (they
+# are only imported once the API object is built), or if it takes longer than a budget.
+#
+# The run benchmark starts CalendarFakeServer.py with a generated calendar in another
+# process and times every query and mutation function of the application against it,
+# reporting latency percentiles, throughput and the peak memory allocated by the call.
+# The results can be saved and compared with a baseline to catch regressions offline.
+#
+#     python CalendarBenchmark.py imports --runs 10 --budget 100
+#     python CalendarBenchmark.py run --events 100000 --output before.json
+#     python CalendarBenchmark.py run --events 100000 --baseline before.json
+
+import argparse
+import datetime
+import json
+import os.path
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import Calendar
+import CalendarCache
+import CalendarScheduler
+import CalendarSearch
+import CalendarTransport
+from CalendarFakeServer import LocalTransport
+
+# The modules Calendar.py only imports when they are needed, and must not load on import.
+LAZY_MODULES = ('googleapiclient.discovery', 'google_auth_oauthlib.flow', 'google.auth.transport.requests')
+
+# Maximum median time in milliseconds that importing Calendar.py may take.
+DEFAULT_IMPORT_BUDGET = 100
+
+# Number of fresh processes the import time is measured in.
+DEFAULT_IMPORT_RUNS = 5
+
+# Default size of the generated calendar and number of times every function is timed.
+DEFAULT_EVENTS = 10000
+DEFAULT_RUNS = 5
+
+# How much slower than the baseline the median latency of a function may get.
+DEFAULT_TOLERANCE = 0.25
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(output):
+    """
+    Parses the report printed by `python -X importtime` into a dict from the name of every
+    imported module to its own and cumulative import time in microseconds.
+
+    :param output: The text printed to stderr by the interpreter
+    """
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        # The header line has no numbers
+        if not self_time.strip().isdigit():
+            continue
+        modules[name.strip()] = (int(self_time), int(cumulative))
+    return modules
+
+
+def measure_import(module='Calendar', runs=DEFAULT_IMPORT_RUNS):
+    """
+    Imports a module of the application in fresh interpreters and returns the median of its
+    cumulative import times in milliseconds, with the modules loaded by the last run.
+
+    :param module: The name of the module to import
+    :param runs: The number of interpreters to measure the import in
+    """
+    if runs <= 0:
+        raise ValueError("Number of runs must be at least 1.")
+    times = []
+    modules = {}
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                cwd=_DIRECTORY, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        modules = parse_importtime(result.stderr)
+        times.append(modules[module][1] / 1000)
+    return statistics.median(times), modules
+
+
+def check_imports(module='Calendar', runs=DEFAULT_IMPORT_RUNS, budget=DEFAULT_IMPORT_BUDGET):
+    """
+    Returns the median import time of a module in milliseconds and the list of regressions
+    found: lazy modules that were loaded on import, and going over the time budget.
+
+    :param module: The name of the module to import
+    :param runs: The number of interpreters to measure the import in
+    :param budget: The maximum median import time in milliseconds, None for no limit
+    """
+    median, modules = measure_import(module, runs)
+    problems = [name + " is imported eagerly." for name in LAZY_MODULES if name in modules]
+    if budget is not None and median > budget:
+        problems.append("Importing {} took {:.1f} ms, over the budget of {} ms.".format(module, median, budget))
+    return median, problems
+
+
+def start_server(events=DEFAULT_EVENTS, seed=0, latency=0.0, quota=None):
+    """
+    Starts CalendarFakeServer.py with a generated calendar in another process, so that the
+    server's work is not measured along with the client's, and returns the process and the
+    URL it serves on.
+
+    :param events: The number of events of the generated calendar
+    :param seed: The seed of the generated events
+    :param latency: Seconds the server delays every request by
+    :param quota: The requests per second the server answers, None for no quota
+    """
+    command = [sys.executable, 'CalendarFakeServer.py', '--events', str(events), '--seed', str(seed),
+               '--latency', str(latency)]
+    if quota is not None:
+        command += ['--quota', str(quota)]
+    process = subprocess.Popen(command, cwd=_DIRECTORY, stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise RuntimeError("The fake server did not start.")
+    return process, line.split()[-1]
+
+
+def _percentile(values, fraction):
+    """
+    Returns the value below which the given fraction of the sorted values lie (nearest rank).
+    """
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+def _count(result):
+    """
+    Returns the number of events a benchmarked call returned or changed.
+    """
+    if isinstance(result, tuple):
+        # The (results, errors) pair of the bulk functions
+        return len(result[0])
+    if isinstance(result, bool):
+        return 1
+    if isinstance(result, dict):
+        return 1
+    return sum(1 for _ in result)
+
+
+def measure(name, function, runs=DEFAULT_RUNS, setup=None):
+    """
+    Times a function and returns a dict of its latency percentiles in milliseconds, its
+    throughput in calls and events per second, and the peak memory allocated by one call
+    in KiB (measured in a separate call, since tracing allocations slows it down).
+
+    :param name: The name of the benchmark
+    :param function: The function to call
+    :param runs: The number of timed calls
+    :param setup: An optional function called before every call (and not timed), whose
+    return value is passed to the function
+    """
+    if runs <= 0:
+        raise ValueError("Number of runs must be at least 1.")
+    latencies = []
+    events = 0
+    for _ in range(runs):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        events += _count(function(*args))
+        latencies.append(time.perf_counter() - start)
+
+    args = (setup(),) if setup is not None else ()
+    tracemalloc.start()
+    try:
+        _count(function(*args))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'name': name,
+        'runs': runs,
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p90_ms': _percentile(latencies, 0.9) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'calls_per_s': runs / total if total else float('inf'),
+        'events_per_s': events / total if total else float('inf'),
+        'peak_kib': peak / 1024,
+    }
+
+
+def _fixtures(api, count):
+    """
+    Returns a setup function adding count events with a new name and two reminders (10 and
+    30 minutes) to the calendar, and returning that name.
+    """
+    batches = [0]
+
+    def setup():
+        batches[0] += 1
+        name = '__benchmark{}__'.format(batches[0])
+        start = datetime.datetime(2000, 1, 1)
+        body = {'summary': name,
+                'start': {'dateTime': start.isoformat() + 'Z'},
+                'end': {'dateTime': (start + datetime.timedelta(hours=1)).isoformat() + 'Z'},
+                'reminders': {'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 10},
+                                                                 {'method': 'email', 'minutes': 30}]}}
+        operations = [(position, api.events().insert, {'calendarId': 'primary', 'body': body})
+                      for position in range(count)]
+        Calendar.execute_batch(api, operations)
+        return name
+    return setup
+
+
+def _store():
+    return CalendarCache.EventStore(':memory:', sync_interval=0)
+
+
+def run_benchmarks(api, runs=DEFAULT_RUNS, only=None):
+    """
+    Benchmarks the query and mutation functions of the application on the given API, which
+    should be one of a fake calendar, and returns the result of measure for each of them.
+
+    :param api: API of a FakeCalendarServer
+    :param runs: The number of timed calls of every function
+    :param only: An optional regular expression the names of the benchmarks must match
+    """
+    now = datetime.datetime.utcnow().isoformat() + 'Z'
+    today = datetime.date.today()
+
+    def first_event_id():
+        return api.events().list(calendarId='primary', maxResults=1, singleEvents=True).execute()['items'][0]['id']
+
+    benchmarks = [
+        ('get_upcoming_events', lambda: Calendar.get_upcoming_events(api, now, 10), None),
+        ('iter_upcoming_events', lambda: Calendar.iter_upcoming_events(api, now, 1000), None),
+        ('get_year_past_events', lambda: Calendar.get_year_past_events(api, now, 5), None),
+        ('iter_year_past_events', lambda: Calendar.iter_year_past_events(api, now, 5), None),
+        ('iter_year_past_events[shard=month]',
+         lambda: Calendar.iter_year_past_events(api, now, 5, shard='month'), None),
+        ('iter_year_past_events[expand_locally]',
+         lambda: Calendar.iter_year_past_events(api, now, 5, expand_locally=True), None),
+        ('get_year_future_events', lambda: Calendar.get_year_future_events(api, now, 2), None),
+        ('iter_year_future_events', lambda: Calendar.iter_year_future_events(api, now, 2), None),
+        ('get_specific_time_events', lambda: Calendar.get_specific_time_events(api, today.year, today.month), None),
+        ('iter_specific_time_events', lambda: Calendar.iter_specific_time_events(api, today.year), None),
+        ('get_event_details', lambda event_id: Calendar.get_event_details(api, event_id), first_event_id),
+        ('search_event', lambda: Calendar.search_event(api, 'john'), None),
+        ('iter_search_event', lambda: Calendar.iter_search_event(api, 'john'), None),
+        ('search_events', lambda: CalendarSearch.search_events(api, 'john'), None),
+        ('EventStore.sync', lambda store: (store.sync(api), store.query())[1], _store),
+        ('delete_event_by_name', lambda name: [Calendar.delete_event_by_name(api, name)], _fixtures(api, 5)),
+        ('delete_events_by_name', lambda name: Calendar.delete_events_by_name(api, name), _fixtures(api, 50)),
+        ('delete_event_reminder', lambda name: [Calendar.delete_event_reminder(api, name, 0, 10)], _fixtures(api, 1)),
+        ('delete_events_reminder', lambda name: Calendar.delete_events_reminder(api, name, 30), _fixtures(api, 50)),
+    ]
+    pattern = re.compile(only) if only else None
+    return [measure(name, function, runs, setup) for name, function, setup in benchmarks
+            if pattern is None or pattern.search(name)]
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns the list of regressions of the results against a baseline: the functions whose
+    median latency grew by more than the tolerance.
+
+    :param results: The results of run_benchmarks
+    :param baseline: Earlier results of run_benchmarks
+    :param tolerance: The allowed relative slowdown, e.g. 0.25 for 25%
+    """
+    before = {result['name']: result for result in baseline}
+    problems = []
+    for result in results:
+        previous = before.get(result['name'])
+        if previous is not None and result['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+            problems.append("{} took {:.1f} ms, {:.1f} ms before.".format(result['name'], result['p50_ms'],
+                                                                          previous['p50_ms']))
+    return problems
+
+
+def format_results(results):
+    """
+    Returns the results of run_benchmarks as a text table.
+    """
+    lines = ['{:<40} {:>9} {:>9} {:>9} {:>9} {:>11} {:>10}'.format(
+        'benchmark', 'p50 ms', 'p90 ms', 'p99 ms', 'calls/s', 'events/s', 'peak KiB')]
+    for result in results:
+        lines.append('{name:<40} {p50_ms:>9.2f} {p90_ms:>9.2f} {p99_ms:>9.2f} {calls_per_s:>9.1f} '
+                     '{events_per_s:>11.0f} {peak_kib:>10.0f}'.format(**result))
+    return '\n'.join(lines)
+
+
+def _run(args):
+    process, url = start_server(args.events, args.seed, args.latency, args.quota)
+    if args.rate is not None:
+        CalendarScheduler.set_scheduler(CalendarScheduler.RequestScheduler(rate=args.rate))
+    pool = CalendarTransport.ConnectionPool(size=args.connections)
+    try:
+        api = CalendarTransport.build_api(LocalTransport(url, pool))
+        results = run_benchmarks(api, args.runs, args.only)
+    finally:
+        pool.close()
+        process.terminate()
+        process.wait()
+
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'events': args.events, 'results': results}, output, indent=2)
+    problems = []
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            problems = compare(results, json.load(baseline)['results'], args.tolerance)
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='CalendarBenchmark.py', description="Benchmarks of the Calendar application.")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    imports = commands.add_parser('imports', help="the time it takes to import a module")
+    imports.add_argument('--module', default='Calendar', help="the module to import (default: %(default)s)")
+    imports.add_argument('--runs', type=int, default=DEFAULT_IMPORT_RUNS, help="the number of fresh interpreters")
+    imports.add_argument('--budget', type=float, default=DEFAULT_IMPORT_BUDGET,
+                         help="the maximum median import time in milliseconds (default: %(default)s)")
+
+    run = commands.add_parser('run', help="the query and mutation functions against a fake calendar")
+    run.add_argument('--events', type=int, default=DEFAULT_EVENTS,
+                     help="the number of events of the generated calendar (default: %(default)s)")
+    run.add_argument('--seed', type=int, default=0, help="the seed of the generated events")
+    run.add_argument('--runs', type=int, default=DEFAULT_RUNS, help="the number of timed calls of every function")
+    run.add_argument('--latency', type=float, default=0.0, help="seconds the server delays every request by")
+    run.add_argument('--quota', type=float, help="the requests per second the server answers, unlimited by default")
+    run.add_argument('--rate', type=float, help="the requests per second the client sends, unlimited by default")
+    run.add_argument('--connections', type=int, default=CalendarTransport.DEFAULT_POOL_SIZE,
+                     help="the size of the connection pool")
+    run.add_argument('--only', metavar='REGEX', help="only run the benchmarks whose name matches")
+    run.add_argument('--output', metavar='FILE', help="save the results as JSON")
+    run.add_argument('--baseline', metavar='FILE', help="compare the results with ones saved earlier")
+    run.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                     help="the allowed relative slowdown against the baseline (default: %(default)s)")
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        problems = _run(args)
+    else:
+        median, problems = check_imports(args.module, args.runs, args.budget)
+        print("import {}: {:.1f} ms (median of {} runs)".format(args.module, median, args.runs))
+    for problem in problems:
+        print("Regression:", problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# Local event store for the Calendar application.
+# Events are kept in a SQLite file next to token.pickle and kept up to date with the
+# incremental sync (syncToken) of the Google Calendar API, so that repeated queries are
+# answered locally and only the changes since the last sync go over the network.
+# https://developers.google.com/calendar/v3/sync
+
+import json
+import sqlite3
+import threading
+import time
+
+import Calendar
+import CalendarMetrics
+
+# The file the event store is saved to, next to token.pickle.
+DEFAULT_CACHE_PATH = Calendar.DEFAULT_CACHE_PATH
+
+# Number of seconds after a sync during which the store is considered fresh and queries
+# do not contact the API at all.
+DEFAULT_SYNC_INTERVAL = 30
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    calendar_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    summary TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (calendar_id, id)
+);
+CREATE INDEX IF NOT EXISTS events_by_start ON events (calendar_id, start);
+CREATE TABLE IF NOT EXISTS sync_state (
+    calendar_id TEXT PRIMARY KEY,
+    sync_token TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_times (
+    calendar_id TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+'''
+
+
+def _is_gone(error):
+    """
+    Checks whether an API error is the 410 Gone response that the API sends when a
+    sync token has expired and a full sync is needed.
+    """
+    return Calendar.get_error_status(error) == 410
+
+
+class EventStore:
+    """
+    A persistent local copy of the events of one or more calendars.
+
+    :param path: The SQLite file to keep the events in, ':memory:' for a throwaway store
+    :param sync_interval: Seconds after a sync during which queries skip the API
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        # The calendars kept up to date by push notifications (see CalendarWatch), which
+        # are only synced when forced to, however long ago their last sync was
+        self.watched = set()
+        # Incremented whenever a sync changes the stored events, so that what was computed
+        # from them (e.g. the counts of navigate_calendar) knows when to start over
+        self.generation = 0
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+
+    def close(self):
+        self._connection.close()
+
+    def get_sync_token(self, calendar_id='primary'):
+        with self._lock:
+            row = self._connection.execute('SELECT sync_token FROM sync_state WHERE calendar_id = ?',
+                                           (calendar_id,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, api, calendar_id='primary', force=False):
+        """
+        Brings the store up to date with the calendar. The first sync downloads every
+        event, after that only the events changed since the last sync are requested.
+        Returns the number of events that were added, changed or removed.
+
+        :param api: API of the Google Calendar
+        :param calendar_id: The calendar to synchronise
+        :param force: Contact the API even if the last sync is within sync_interval, or the
+        calendar is watched
+        """
+        # The time of the last sync is kept in the file, so that it is shared between processes
+        with self._lock:
+            row = self._connection.execute('SELECT synced_at FROM sync_times WHERE calendar_id = ?',
+                                           (calendar_id,)).fetchone()
+        if not force and row is not None and (calendar_id in self.watched or
+                                              0 <= time.time() - row[0] < self.sync_interval):
+            CalendarMetrics.record_cache('event_store', True)
+            return 0
+        CalendarMetrics.record_cache('event_store', False)
+
+        with self._lock:
+            sync_token = self.get_sync_token(calendar_id)
+            try:
+                changed = self._apply_changes(api, calendar_id, sync_token)
+            except Exception as error:
+                self._connection.rollback()
+                # The sync token has expired, start over with a full sync
+                if sync_token is None or not _is_gone(error):
+                    raise
+                changed = self._apply_changes(api, calendar_id, None)
+            self._connection.execute('INSERT OR REPLACE INTO sync_times (calendar_id, synced_at) VALUES (?, ?)',
+                                     (calendar_id, time.time()))
+            self._connection.commit()
+            if changed:
+                self.generation += 1
+        return changed
+
+    def _apply_changes(self, api, calendar_id, sync_token):
+        """
+        Downloads the changes since sync_token (or everything if there is none) and
+        stores them together with the new sync token in one transaction.
+        """
+        kwargs = {'calendarId': calendar_id, 'singleEvents': True, 'maxResults': Calendar.DEFAULT_PAGE_SIZE}
+        if sync_token:
+            kwargs['syncToken'] = sync_token
+        else:
+            self._connection.execute('DELETE FROM events WHERE calendar_id = ?', (calendar_id,))
+
+        changed = 0
+        next_sync_token = None
+        for page in Calendar.iter_pages(api.events().list, **kwargs):
+            for event in page.get('items', []):
+                changed += 1
+                # Deleted events and cancelled instances are reported with a cancelled status
+                if event.get('status') == 'cancelled' or 'start' not in event:
+                    self._connection.execute('DELETE FROM events WHERE calendar_id = ? AND id = ?',
+                                             (calendar_id, event['id']))
+                    continue
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO events (calendar_id, id, start, end, summary, body) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (calendar_id, event['id'], Calendar.get_event_timestamp(event['start']),
+                     Calendar.get_event_timestamp(event['end']), event.get('summary', ''), json.dumps(event)))
+            next_sync_token = page.get('nextSyncToken', next_sync_token)
+
+        if next_sync_token:
+            self._connection.execute('INSERT OR REPLACE INTO sync_state (calendar_id, sync_token) VALUES (?, ?)',
+                                     (calendar_id, next_sync_token))
+        self._connection.commit()
+        return changed
+
+    def query(self, time_min=None, time_max=None, calendar_id='primary', limit=None):
+        """
+        Returns the stored events that overlap the given window, ordered by start time,
+        the same way events().list(timeMin=..., timeMax=..., orderBy='startTime') would.
+
+        :param time_min: RFC3339 lower bound (exclusive) for the event's end time
+        :param time_max: RFC3339 upper bound (exclusive) for the event's start time
+        :param calendar_id: The calendar to read the events of
+        :param limit: The maximum number of events to return
+        """
+        sql = 'SELECT body FROM events WHERE calendar_id = ?'
+        params = [calendar_id]
+        if time_min is not None:
+            sql += ' AND end > ?'
+            params.append(Calendar.get_event_timestamp(time_min))
+        if time_max is not None:
+            sql += ' AND start < ?'
+            params.append(Calendar.get_event_timestamp(time_max))
+        sql += ' ORDER BY start, id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def search(self, keyword, calendar_id='primary'):
+        """
+        Returns the stored events whose summary contains the keyword (ignoring case),
+        ordered by start time.
+
+        :param keyword: The keyword of the event that we want to search for
+        :param calendar_id: The calendar to read the events of
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT body FROM events WHERE calendar_id = ? AND instr(lower(summary), ?) > 0 '
+                'ORDER BY start, id', (calendar_id, keyword.lower())).fetchall()
+        return [json.loads(row[0]) for row in rows]
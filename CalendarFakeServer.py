@@ -0,0 +1,969 @@
+# A local stand-in for the Google Calendar API (v3), for benchmarks and tests that should
+# not depend on the network or on a real account.
+# A FakeCalendar keeps the events of one calendar in memory, either generated (from a few
+# thousand to millions of events, with recurring series and reminders) or inserted
+# through the API. A FakeCalendarServer serves any number of them over HTTP, answering the
+# events methods the application uses: list (with paging, time bounds, q, syncToken and
+# field masks), get, insert, update, patch and delete, as well as calendarList get (for
+# the default reminders), freeBusy query and batch requests. It can also enforce a quota
+# or fail chosen requests, to exercise retries and throttling. events.watch opens
+# notification channels, and the server posts a notification to them (from a background
+# thread, like the API's push notifications) after every change made through it, or when
+# notify is called after changing a FakeCalendar directly.
+#
+# The API object sends batch requests to Google's root URL whatever its endpoint is, so it
+# is pointed at the server by wrapping its transport in a LocalTransport, e.g.
+#     server = FakeCalendarServer(FakeCalendar.generate(10000)).start()
+#     api = CalendarTransport.build_api(LocalTransport(server.url, ConnectionPool()))
+#
+# It can also be run on its own: python CalendarFakeServer.py --events 100000 --port 8080
+
+import argparse
+import bisect
+import collections
+import datetime
+import email.parser
+import http
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Calendar
+import CalendarScheduler
+import CalendarSearch
+
+# The root URL the API object sends its requests to.
+GOOGLE_ROOT_URL = 'https://www.googleapis.com/'
+
+# The email address of the owner of the fake calendars.
+OWNER_EMAIL = 'owner@example.com'
+
+# Default and largest number of events per page of a list, like the real API.
+DEFAULT_MAX_RESULTS = 250
+MAX_RESULTS = 2500
+
+# The most calendars and the longest time range (in days) a freeBusy query may ask for.
+FREEBUSY_MAX_CALENDARS = 50
+FREEBUSY_MAX_DAYS = 60
+
+# Seconds a notification channel lives for when its ttl is not given.
+CHANNEL_DEFAULT_TTL = 604800
+
+# The names and reminders of the generated events.
+_SUMMARIES = ('Standup', 'Review', 'Lunch with john', 'Planning', 'Dentist', 'Gym', 'Retro', 'Call with John',
+              'Workshop', 'Team sync', 'Interview', 'Reading group', 'Focus time', '1:1', 'Demo')
+_REMINDERS = ((('popup', 10),), (('email', 30),), (('popup', 10), ('email', 60)), (('email', 1440),))
+_DURATIONS = (15, 30, 45, 60, 90, 120)
+
+# The fields of an event that are set by the server rather than by its body.
+_READ_ONLY = {'kind', 'etag', 'id', 'status', 'htmlLink', 'created', 'updated', 'creator', 'organizer',
+              'iCalUID', 'sequence', 'recurringEventId', 'originalStartTime'}
+_STORED = {'summary', 'description', 'start', 'end', 'reminders', 'recurrence'}
+
+
+class ApiError(Exception):
+    """
+    An error answered by the fake API, with the status and reason the real one would use.
+    """
+
+    def __init__(self, status, reason, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+    def to_dict(self):
+        return {'error': {'code': self.status, 'message': str(self),
+                          'errors': [{'domain': 'global', 'reason': self.reason, 'message': str(self)}]}}
+
+
+class _Row:
+    """
+    One stored event. Timed events keep their start and end as POSIX timestamps, all-day
+    events as the timestamps of midnight UTC. reminders is None for the default reminders,
+    otherwise a tuple of (method, minutes) pairs. A recurring series has a master row,
+    whose start and end are those of its first instance and whose span_end is the end of
+    its last one, and a row per instance; only modified instances are listed along with
+    the masters when singleEvents is false.
+    """
+
+    __slots__ = ('id', 'summary', 'description', 'start', 'end', 'span_end', 'all_day', 'reminders',
+                 'recurrence', 'recurring_id', 'original_start', 'modified', 'status', 'updated', 'seq', 'extra')
+
+    def __init__(self, event_id, summary, start, end, all_day=False, reminders=None, description=None,
+                 recurrence=None, recurring_id=None, original_start=None, modified=False, updated=0.0, extra=None):
+        self.id = event_id
+        self.summary = summary
+        self.description = description
+        self.start = start
+        self.end = end
+        self.span_end = end
+        self.all_day = all_day
+        self.reminders = reminders
+        self.recurrence = recurrence
+        self.recurring_id = recurring_id
+        self.original_start = original_start
+        self.modified = modified
+        self.status = 'confirmed'
+        self.updated = updated
+        self.seq = 0
+        self.extra = extra
+
+    @property
+    def key(self):
+        return self.start, self.id
+
+    def listed(self, single_events):
+        """
+        Checks whether the row is listed when singleEvents has the given value.
+        """
+        if single_events:
+            return self.recurrence is None
+        return self.recurring_id is None or self.modified
+
+
+def _time_dict(timestamp, all_day):
+    moment = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    if all_day:
+        return {'date': moment.strftime('%Y-%m-%d')}
+    return {'dateTime': moment.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+def _rfc3339(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def _rrule_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def parse_fields(fields):
+    """
+    Parses a field mask such as 'nextPageToken,items(id,start)' into a tree of dicts, where
+    a field that is kept whole maps to None.
+
+    :param fields: The value of the fields parameter
+    """
+    tree = {}
+    stack = [tree]
+    name = ''
+    for char in fields:
+        if char == '(':
+            stack.append(stack[-1].setdefault(name.strip(), {}))
+            name = ''
+        elif char in ',)':
+            if name.strip():
+                stack[-1][name.strip()] = None
+            name = ''
+            if char == ')':
+                if len(stack) == 1:
+                    raise ApiError(400, 'invalidParameter', "Invalid field selection " + fields)
+                stack.pop()
+        else:
+            name += char
+    if name.strip():
+        stack[-1][name.strip()] = None
+    return tree
+
+
+def project(value, tree):
+    """
+    Returns the parts of a response selected by a field mask parsed by parse_fields.
+    """
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {name: project(value[name], subtree) for name, subtree in tree.items() if name in value}
+    return value
+
+
+class FakeCalendar:
+    """
+    The events of one calendar, kept in memory and sorted by start time. Every change is
+    numbered, so that a list with a syncToken returns the events changed since the list
+    that gave out the token.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._keys = []
+        # The id of the event changed by every change since the calendar was created
+        self._changes = []
+        # Sync tokens are the number of changes seen and the generation they were given
+        # out in, the tokens of earlier generations have expired
+        self._sync_generation = 0
+        # The longest time an event, or a series when singleEvents is false, lasts
+        self._max_duration = 0.0
+        self._max_span = 0.0
+        self._ids = itertools.count()
+        self._lock = threading.RLock()
+        # The reminders of the events that use the calendar's default reminders
+        self.default_reminders = (('popup', 10),)
+
+    def __len__(self):
+        """
+        The number of events listed with singleEvents set, i.e. single events and instances.
+        """
+        with self._lock:
+            return sum(1 for key in self._keys if self._rows[key[1]].recurrence is None)
+
+    @classmethod
+    def generate(cls, count, time_min=None, time_max=None, seed=0, recurring=0.3, all_day=0.05):
+        """
+        Returns a calendar of synthetic events starting evenly between two times. About the
+        given share of them are instances of weekly series (whose later instances may fall
+        after the end time), some of which skip (EXDATE) or move an instance, the others
+        are single events. About half of the events use the default reminders, the rest one
+        or two reminders or none.
+
+        :param count: The number of events (counting every instance of a series)
+        :param time_min: The RFC3339 time the events start after, 6 years ago by default
+        :param time_max: The RFC3339 time the events start before, 3 years from now by default
+        :param seed: The seed of the random generator, the same seed gives the same calendar
+        :param recurring: The share of the events that belong to a series
+        :param all_day: The share of the single events that last the whole day
+        """
+        if count < 0:
+            raise ValueError("Number of events must be at least 0.")
+        now = time.time()
+        lower = Calendar.get_event_timestamp(time_min) if time_min else now - 6 * 365 * 86400
+        upper = Calendar.get_event_timestamp(time_max) if time_max else now + 3 * 365 * 86400
+        if upper <= lower:
+            raise ValueError("The end of the range must be after its start.")
+
+        rng = random.Random(seed)
+        calendar = cls()
+        rows = []
+        generated = 0
+        series = 0
+        while generated < count:
+            summary = rng.choice(_SUMMARIES)
+            reminders = cls._random_reminders(rng)
+            start = (lower + rng.random() * (upper - lower)) // 900 * 900
+            duration = rng.choice(_DURATIONS) * 60
+            if rng.random() < recurring and count - generated >= 2:
+                instances = min(rng.randint(4, 52), count - generated)
+                rows.extend(cls._generate_series('series' + str(series), summary, start, duration, instances,
+                                                 reminders, rng, now))
+                series += 1
+                generated += instances
+                continue
+            if rng.random() < all_day:
+                start = start // 86400 * 86400
+                rows.append(_Row('event' + str(generated), summary, start, start + 86400, True, reminders, updated=now))
+            else:
+                rows.append(_Row('event' + str(generated), summary, start, start + duration, False, reminders,
+                                 updated=now))
+            generated += 1
+
+        for row in rows:
+            calendar._rows[row.id] = row
+            calendar._track(row)
+        calendar._keys = sorted(row.key for row in rows if row.status != 'cancelled')
+        return calendar
+
+    @staticmethod
+    def _random_reminders(rng):
+        draw = rng.random()
+        if draw < 0.5:
+            return None
+        if draw < 0.9:
+            return rng.choice(_REMINDERS)
+        return ()
+
+    @staticmethod
+    def _generate_series(master_id, summary, start, duration, instances, reminders, rng, now):
+        """
+        Returns the rows of a weekly series: the master, then its instances.
+        """
+        master = _Row(master_id, summary, start, start + duration, reminders=reminders, updated=now)
+        rows = [master]
+        excluded = []
+        listed = 0
+        week = 0
+        while listed < instances:
+            original = start + week * 7 * 86400
+            week += 1
+            # Some instances are skipped, but never the first one
+            if listed and rng.random() < 0.05:
+                excluded.append(original)
+                continue
+            instance_id = master_id + '_' + _rrule_time(original)
+            instance = _Row(instance_id, summary, original, original + duration, reminders=reminders,
+                            recurring_id=master_id, original_start=original, updated=now)
+            # Some instances are moved by an hour and renamed, i.e. they are exceptions
+            if listed and rng.random() < 0.05:
+                instance.start += 3600
+                instance.end += 3600
+                instance.summary = summary + ' (moved)'
+                instance.modified = True
+            rows.append(instance)
+            listed += 1
+        master.recurrence = ['RRULE:FREQ=WEEKLY;COUNT=' + str(week)]
+        if excluded:
+            master.recurrence.append('EXDATE:' + ','.join(_rrule_time(moment) for moment in excluded))
+        master.span_end = max(row.end for row in rows)
+        return rows
+
+    def _track(self, row):
+        """
+        Takes note of the duration of a row that was added or changed.
+        """
+        if row.recurrence is None:
+            self._max_duration = max(self._max_duration, row.end - row.start)
+        self._max_span = max(self._max_span, row.span_end - row.start)
+
+    def _changed(self, row):
+        """
+        Numbers the change of a row, for the next incremental syncs.
+        """
+        self._changes.append(row.id)
+        row.seq = len(self._changes)
+        row.updated = time.time()
+
+    def expire_sync_tokens(self):
+        """
+        Makes every sync token given out so far invalid, like the real API does after a
+        while, so that the next incremental sync fails with 410 Gone.
+        """
+        with self._lock:
+            self._sync_generation += 1
+
+    def _sync_token(self, position):
+        return str(position) + ':' + str(self._sync_generation)
+
+    def to_dict(self, row):
+        """
+        Returns the event resource of a row.
+        """
+        if row.status == 'cancelled':
+            event = {'kind': 'calendar#event', 'id': row.id, 'status': 'cancelled'}
+        else:
+            event = {
+                'kind': 'calendar#event',
+                'id': row.id,
+                'status': row.status,
+                'htmlLink': 'https://www.google.com/calendar/event?eid=' + row.id,
+                'updated': _rfc3339(row.updated),
+                'summary': row.summary,
+                'creator': {'email': OWNER_EMAIL, 'self': True},
+                'organizer': {'email': OWNER_EMAIL, 'self': True},
+                'start': _time_dict(row.start, row.all_day),
+                'end': _time_dict(row.end, row.all_day),
+                'reminders': {'useDefault': True} if row.reminders is None else {
+                    'useDefault': False,
+                    'overrides': [{'method': method, 'minutes': minutes} for method, minutes in row.reminders]},
+            }
+            if row.description is not None:
+                event['description'] = row.description
+            if row.recurrence is not None:
+                event['recurrence'] = list(row.recurrence)
+            if row.extra:
+                event.update(row.extra)
+        if row.recurring_id is not None:
+            event['recurringEventId'] = row.recurring_id
+            event['originalStartTime'] = _time_dict(row.original_start, row.all_day)
+        return event
+
+    def _row_from_body(self, event_id, body):
+        """
+        Builds a row from an event resource sent by a client.
+        """
+        try:
+            start_time = body['start']
+            end_time = body['end']
+            all_day = 'date' in start_time
+            start = Calendar.get_event_timestamp(start_time)
+            end = Calendar.get_event_timestamp(end_time)
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, 'required', "Missing or invalid start or end time.")
+        if end < start:
+            raise ApiError(400, 'timeRangeEmpty', "The specified time range is empty.")
+        reminders = body.get('reminders') or {'useDefault': True}
+        if reminders.get('useDefault'):
+            reminders = None
+        else:
+            reminders = tuple((reminder['method'], reminder['minutes']) for reminder in reminders.get('overrides', ()))
+        extra = {name: value for name, value in body.items() if name not in _READ_ONLY and name not in _STORED}
+        return _Row(event_id, body.get('summary', ''), start, end, all_day, reminders, body.get('description'),
+                    body.get('recurrence'), extra=extra or None)
+
+    def _live_row(self, event_id):
+        row = self._rows.get(event_id)
+        if row is None:
+            raise ApiError(404, 'notFound', "Not Found")
+        if row.status == 'cancelled':
+            raise ApiError(410, 'deleted', "Resource has been deleted")
+        return row
+
+    def _store(self, row, previous=None):
+        """
+        Saves a new or changed row, keeping the start time index sorted.
+        """
+        if previous is not None:
+            del self._keys[bisect.bisect_left(self._keys, previous.key)]
+            row.recurring_id = previous.recurring_id
+            row.original_start = previous.original_start
+            row.modified = previous.recurring_id is not None
+        if row.recurrence is not None:
+            row.span_end = max(row.end, previous.span_end if previous is not None else row.end)
+        self._rows[row.id] = row
+        bisect.insort(self._keys, row.key)
+        self._track(row)
+        self._changed(row)
+
+    def calendar_entry(self, calendar_id):
+        """
+        Returns the calendar list entry of the calendar, as calendarList().get would.
+        """
+        return {'kind': 'calendar#calendarListEntry', 'id': calendar_id, 'accessRole': 'owner',
+                'defaultReminders': [{'method': method, 'minutes': minutes}
+                                     for method, minutes in self.default_reminders]}
+
+    def get(self, event_id):
+        with self._lock:
+            row = self._rows.get(event_id)
+            if row is None:
+                raise ApiError(404, 'notFound', "Not Found")
+            return self.to_dict(row)
+
+    def insert(self, body):
+        with self._lock:
+            event_id = body.get('id') or 'new' + str(next(self._ids))
+            if event_id in self._rows:
+                raise ApiError(409, 'duplicate', "The requested identifier already exists.")
+            row = self._row_from_body(event_id, body)
+            self._store(row)
+            return self.to_dict(row)
+
+    def update(self, event_id, body):
+        with self._lock:
+            previous = self._live_row(event_id)
+            row = self._row_from_body(event_id, body)
+            self._store(row, previous)
+            return self.to_dict(row)
+
+    def patch(self, event_id, body):
+        with self._lock:
+            event = self.to_dict(self._live_row(event_id))
+            event.update(body)
+            return self.update(event_id, event)
+
+    def delete(self, event_id):
+        with self._lock:
+            row = self._live_row(event_id)
+            del self._keys[bisect.bisect_left(self._keys, row.key)]
+            row.status = 'cancelled'
+            self._changed(row)
+
+    def list(self, params):
+        """
+        Answers a list request, given its query parameters (as strings, like in the URL).
+        """
+        try:
+            max_results = min(int(params.get('maxResults', DEFAULT_MAX_RESULTS)), MAX_RESULTS)
+        except ValueError:
+            raise ApiError(400, 'invalid', "Invalid value for maxResults.")
+        if max_results <= 0:
+            raise ApiError(400, 'invalid', "Invalid value for maxResults.")
+        single_events = params.get('singleEvents') == 'true'
+        if params.get('orderBy') == 'startTime' and not single_events:
+            raise ApiError(400, 'invalid', "The requested ordering is not available for the particular query.")
+
+        with self._lock:
+            if 'syncToken' in params:
+                if any(name in params for name in ('timeMin', 'timeMax', 'q', 'orderBy')):
+                    raise ApiError(400, 'invalid', "Sync token cannot be used with other filters.")
+                return self._list_changes(params['syncToken'], params.get('pageToken'), max_results, single_events)
+            return self._list_range(params, max_results, single_events)
+
+    def _list_range(self, params, max_results, single_events):
+        lower = Calendar.get_event_timestamp(params['timeMin']) if 'timeMin' in params else float('-inf')
+        upper = Calendar.get_event_timestamp(params['timeMax']) if 'timeMax' in params else float('inf')
+        words = set(CalendarSearch.tokenize(params.get('q')))
+        if 'pageToken' in params:
+            start, _, event_id = params['pageToken'].partition('|')
+            position = bisect.bisect_left(self._keys, (float(start), event_id))
+        else:
+            # Events starting earlier than this cannot end after lower
+            reach = self._max_duration if single_events else self._max_span
+            position = bisect.bisect_left(self._keys, (lower - reach,))
+
+        items = []
+        while position < len(self._keys) and len(items) < max_results:
+            start, event_id = self._keys[position]
+            if start >= upper:
+                break
+            position += 1
+            row = self._rows[event_id]
+            if not row.listed(single_events):
+                continue
+            if (row.end if single_events else row.span_end) <= lower:
+                continue
+            if words and not words <= set(CalendarSearch.tokenize(row.summary + '\n' + (row.description or ''))):
+                continue
+            items.append(self.to_dict(row))
+
+        page = {'kind': 'calendar#events', 'summary': OWNER_EMAIL, 'items': items}
+        if position < len(self._keys) and self._keys[position][0] < upper:
+            start, event_id = self._keys[position]
+            page['nextPageToken'] = repr(start) + '|' + event_id
+        else:
+            page['nextSyncToken'] = self._sync_token(len(self._changes))
+        return page
+
+    def busy(self, lower, upper):
+        """
+        Returns the times the calendar is busy between two timestamps, as the sorted and
+        merged (start, end) timestamps of its events (but the transparent ones), cut to the
+        window.
+        """
+        periods = []
+        with self._lock:
+            position = bisect.bisect_left(self._keys, (lower - self._max_duration,))
+            while position < len(self._keys) and self._keys[position][0] < upper:
+                row = self._rows[self._keys[position][1]]
+                position += 1
+                if not row.listed(True) or row.end <= lower or (row.extra or {}).get('transparency') == 'transparent':
+                    continue
+                start, end = max(row.start, lower), min(row.end, upper)
+                if periods and start <= periods[-1][1]:
+                    periods[-1][1] = max(periods[-1][1], end)
+                else:
+                    periods.append([start, end])
+        return [tuple(period) for period in periods]
+
+    def _list_changes(self, sync_token, page_token, max_results, single_events):
+        try:
+            oldest, _, generation = sync_token.partition(':')
+            oldest, generation = int(oldest), int(generation)
+            position = int(page_token) if page_token else oldest
+        except ValueError:
+            raise ApiError(400, 'invalid', "Invalid sync token value.")
+        if generation != self._sync_generation or oldest > len(self._changes):
+            raise ApiError(410, 'fullSyncRequired', "Sync token is no longer valid, a full sync is required.")
+
+        items = []
+        last = len(self._changes)
+        while position < last and len(items) < max_results:
+            row = self._rows[self._changes[position]]
+            position += 1
+            # Only the latest change of an event is returned
+            if row.seq != position or (row.status != 'cancelled' and not row.listed(single_events)):
+                continue
+            items.append(self.to_dict(row))
+
+        page = {'kind': 'calendar#events', 'summary': OWNER_EMAIL, 'items': items}
+        if position < last:
+            page['nextPageToken'] = str(position)
+        else:
+            page['nextSyncToken'] = self._sync_token(last)
+        return page
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, which Nagle's algorithm would delay
+    disable_nagle_algorithm = True
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, headers, content = self.server.fake.handle_http(self.command, self.path, self.headers, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeCalendarServer:
+    """
+    Serves fake calendars over HTTP on a local port, as the Calendar API would.
+
+    :param calendars: A FakeCalendar to serve as the primary calendar, or a dict from
+    calendar ids to FakeCalendars, an empty primary calendar by default
+    :param host: The address to listen on
+    :param port: The port to listen on, 0 for any free port
+    :param latency: Seconds every HTTP request is delayed by, to simulate the network
+    :param quota: The requests per second answered before the others are refused with
+    403 rateLimitExceeded (every request of a batch counts), None for no quota
+    """
+
+    def __init__(self, calendars=None, host='127.0.0.1', port=0, latency=0.0, quota=None):
+        if isinstance(calendars, FakeCalendar):
+            calendars = {'primary': calendars}
+        self.calendars = calendars if calendars is not None else {'primary': FakeCalendar()}
+        self.latency = latency
+        self.quota = CalendarScheduler.TokenBucket(quota, quota) if quota is not None else None
+        # The number of requests answered per method, counting every request of a batch
+        self.calls = collections.Counter()
+        self._calls_lock = threading.Lock()
+        self._errors = collections.deque()
+        # The open notification channels by id, and the notifications waiting to be posted
+        self.channels = {}
+        self._notifications = queue.Queue()
+        self._notifier = None
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://' + host + ':' + str(port) + '/'
+
+    def start(self):
+        """
+        Starts serving on a background thread and returns the server.
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._notifier is not None:
+            self._notifications.put(None)
+            self._notifier.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, method):
+        with self._calls_lock:
+            self.calls[method] += 1
+
+    def inject_errors(self, errors):
+        """
+        Makes the next requests fail, one per error, before they are answered.
+
+        :param errors: (status, reason) pairs, e.g. [(429, 'rateLimitExceeded'), (503, 'backendError')]
+        """
+        with self._calls_lock:
+            self._errors.extend(errors)
+
+    def _refused(self):
+        """
+        Returns the error the next request is refused with, or None if it is answered.
+        """
+        with self._calls_lock:
+            if self._errors:
+                status, reason = self._errors.popleft()
+                self.calls['refused'] += 1
+                return ApiError(status, reason, http.HTTPStatus(status).phrase)
+            if self.quota is not None and not self.quota.try_acquire():
+                self.calls['refused'] += 1
+                return ApiError(403, 'rateLimitExceeded', "Rate Limit Exceeded")
+        return None
+
+    def _calendar(self, calendar_id):
+        calendar = self.calendars.get(calendar_id)
+        if calendar is None:
+            raise ApiError(404, 'notFound', "Not Found")
+        return calendar
+
+    def handle_http(self, method, target, headers, body):
+        """
+        Answers an HTTP request, returning its status, headers and body.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        path = urllib.parse.urlsplit(target).path
+        if method == 'POST' and path.startswith('/batch'):
+            self._count('batch')
+            return self._handle_batch(headers.get('Content-Type', ''), body)
+        status, payload = self.handle(method, target, body)
+        if payload is None:
+            return status, {}, b''
+        return status, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(payload).encode()
+
+    def handle(self, method, target, body=b''):
+        """
+        Answers one API request, returning its status and JSON payload (None if it has none).
+
+        :param method: The HTTP method
+        :param target: The path and query of the request, e.g. '/calendar/v3/calendars/primary/events?maxResults=5'
+        :param body: The body of the request
+        """
+        parts = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(parts.query))
+        segments = [urllib.parse.unquote(segment) for segment in parts.path.strip('/').split('/')]
+        refused = self._refused()
+        if refused is not None:
+            return refused.status, refused.to_dict()
+        try:
+            if segments[:5] == ['calendar', 'v3', 'users', 'me', 'calendarList'] and len(segments) == 6:
+                if method != 'GET':
+                    raise ApiError(405, 'httpMethodNotAllowed', "Method not allowed")
+                self._count('calendarList.get')
+                return self._project(self._calendar(segments[5]).calendar_entry(segments[5]), params)
+            if segments == ['calendar', 'v3', 'freeBusy']:
+                if method != 'POST':
+                    raise ApiError(405, 'httpMethodNotAllowed', "Method not allowed")
+                self._count('freebusy')
+                data = json.loads(body.decode() if isinstance(body, bytes) else body) if body else {}
+                return self._project(self._free_busy(data), params)
+            if segments == ['calendar', 'v3', 'channels', 'stop']:
+                if method != 'POST':
+                    raise ApiError(405, 'httpMethodNotAllowed', "Method not allowed")
+                self._count('channels.stop')
+                self._stop_channel(json.loads(body.decode() if isinstance(body, bytes) else body) if body else {})
+                return 204, None
+            if segments[:3] != ['calendar', 'v3', 'calendars'] or len(segments) not in (5, 6) or \
+                    segments[4] != 'events':
+                raise ApiError(404, 'notFound', "Not Found")
+            calendar = self._calendar(segments[3])
+            data = json.loads(body.decode() if isinstance(body, bytes) else body) if body else {}
+            if len(segments) == 5 and method == 'GET':
+                self._count('list')
+                payload, status = calendar.list(params), 200
+            elif len(segments) == 5 and method == 'POST':
+                self._count('insert')
+                payload, status = calendar.insert(data), 200
+                self.notify(segments[3])
+            elif len(segments) == 6 and segments[5] == 'watch' and method == 'POST':
+                self._count('watch')
+                payload, status = self._watch(segments[3], data), 200
+            elif len(segments) == 6 and method in ('GET', 'PUT', 'PATCH', 'DELETE'):
+                name = {'GET': 'get', 'PUT': 'update', 'PATCH': 'patch', 'DELETE': 'delete'}[method]
+                self._count(name)
+                if method == 'DELETE':
+                    calendar.delete(segments[5])
+                    self.notify(segments[3])
+                    return 204, None
+                if method == 'GET':
+                    payload = calendar.get(segments[5])
+                else:
+                    payload = getattr(calendar, name)(segments[5], data)
+                    self.notify(segments[3])
+                status = 200
+            else:
+                raise ApiError(405, 'httpMethodNotAllowed', "Method not allowed")
+        except ApiError as error:
+            return error.status, error.to_dict()
+        return self._project(payload, params, status)
+
+    def _free_busy(self, query):
+        """
+        Answers a freeBusy query with the busy times of every calendar asked for, or the
+        reason it has none for the unknown ones.
+        """
+        try:
+            lower = Calendar.get_event_timestamp(query['timeMin'])
+            upper = Calendar.get_event_timestamp(query['timeMax'])
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, 'required', "Missing or invalid time range.")
+        if upper <= lower:
+            raise ApiError(400, 'timeRangeEmpty', "The specified time range is empty.")
+        if upper - lower > FREEBUSY_MAX_DAYS * 86400:
+            raise ApiError(400, 'timeRangeTooLong', "The requested time range is too long.")
+        items = query.get('items', [])
+        if len(items) > FREEBUSY_MAX_CALENDARS:
+            raise ApiError(400, 'tooManyCalendarsRequested', "Too many calendars requested.")
+        calendars = {}
+        for item in items:
+            calendar = self.calendars.get(item['id'])
+            if calendar is None:
+                calendars[item['id']] = {'busy': [], 'errors': [{'domain': 'global', 'reason': 'notFound'}]}
+            else:
+                calendars[item['id']] = {'busy': [{'start': _rfc3339(start), 'end': _rfc3339(end)}
+                                                  for start, end in calendar.busy(lower, upper)]}
+        return {'kind': 'calendar#freeBusy', 'timeMin': query['timeMin'], 'timeMax': query['timeMax'],
+                'calendars': calendars}
+
+    def _watch(self, calendar_id, body):
+        """
+        Opens a notification channel on the events of a calendar, and posts the 'sync'
+        notification confirming it.
+        """
+        if body.get('type') not in ('web_hook', 'webhook') or not body.get('id') or not body.get('address'):
+            raise ApiError(400, 'invalid', "A channel needs an id, the web_hook type and an address.")
+        ttl = float((body.get('params') or {}).get('ttl', CHANNEL_DEFAULT_TTL))
+        channel = {'id': body['id'], 'calendarId': calendar_id, 'address': body['address'],
+                   'token': body.get('token'), 'expiration': time.time() + ttl, 'messages': itertools.count(),
+                   'resourceId': uuid.uuid5(uuid.NAMESPACE_URL, calendar_id).hex}
+        with self._calls_lock:
+            if body['id'] in self.channels:
+                raise ApiError(400, 'channelIdNotUnique', "Channel id not unique.")
+            self.channels[body['id']] = channel
+        self._post(channel, 'sync')
+        response = {'kind': 'api#channel', 'id': channel['id'], 'resourceId': channel['resourceId'],
+                    'resourceUri': GOOGLE_ROOT_URL + 'calendar/v3/calendars/' + urllib.parse.quote(calendar_id) +
+                    '/events', 'expiration': str(int(channel['expiration'] * 1000))}
+        if channel['token'] is not None:
+            response['token'] = channel['token']
+        return response
+
+    def _stop_channel(self, body):
+        with self._calls_lock:
+            channel = self.channels.get(body.get('id'))
+            if channel is None or channel['resourceId'] != body.get('resourceId'):
+                raise ApiError(404, 'notFound', "Channel not found.")
+            del self.channels[body['id']]
+
+    def notify(self, calendar_id, state='exists'):
+        """
+        Posts a notification to every open channel of a calendar, e.g. after changing its
+        FakeCalendar directly. Expired channels are closed instead.
+
+        :param calendar_id: The calendar whose events changed
+        :param state: The X-Goog-Resource-State of the notification
+        """
+        now = time.time()
+        with self._calls_lock:
+            channels = [channel for channel in self.channels.values() if channel['calendarId'] == calendar_id]
+            for channel in channels:
+                if channel['expiration'] <= now:
+                    del self.channels[channel['id']]
+        for channel in channels:
+            if channel['expiration'] > now:
+                self._post(channel, state)
+
+    def _post(self, channel, state):
+        """
+        Queues a notification for the background thread posting them in order.
+        """
+        headers = {'X-Goog-Channel-ID': channel['id'], 'X-Goog-Resource-ID': channel['resourceId'],
+                   'X-Goog-Resource-State': state, 'X-Goog-Message-Number': str(next(channel['messages'])),
+                   'X-Goog-Channel-Expiration': time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                                              time.gmtime(channel['expiration']))}
+        if channel['token'] is not None:
+            headers['X-Goog-Channel-Token'] = channel['token']
+        with self._calls_lock:
+            if self._notifier is None:
+                self._notifier = threading.Thread(target=self._post_notifications, daemon=True)
+                self._notifier.start()
+        self._notifications.put((channel['address'], headers))
+
+    def _post_notifications(self):
+        while True:
+            notification = self._notifications.get()
+            if notification is None:
+                return
+            address, headers = notification
+            request = urllib.request.Request(address, data=b'', headers=headers, method='POST')
+            try:
+                with urllib.request.urlopen(request, timeout=5):
+                    self._count('notification')
+            except (OSError, urllib.error.URLError):
+                # Like the API, the notification is not posted again
+                self._count('notification.failed')
+
+    @staticmethod
+    def _project(payload, params, status=200):
+        """
+        Applies the fields parameter of a request to its payload, returning the status and
+        the payload.
+        """
+        if 'fields' in params:
+            try:
+                payload = project(payload, parse_fields(params['fields']))
+            except ApiError as error:
+                return error.status, error.to_dict()
+        return status, payload
+
+    def _handle_batch(self, content_type, body):
+        """
+        Answers a multipart/mixed batch request, one application/http part per request.
+        """
+        message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        if not message.is_multipart():
+            error = ApiError(400, 'badRequest', "Batch requests must be multipart/mixed.")
+            return 400, {'Content-Type': 'application/json'}, json.dumps(error.to_dict()).encode()
+
+        boundary = 'batch_' + uuid.uuid4().hex
+        chunks = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            head, _, request_body = request.replace('\r\n', '\n').partition('\n\n')
+            method, target = head.split('\n', 1)[0].split(' ')[:2]
+            status, payload = self.handle(method, target, request_body.strip())
+            content = json.dumps(payload) if payload is not None else ''
+            content_id = (part['Content-ID'] or '<' + str(len(chunks)) + '>').strip()
+            chunks.append('--' + boundary + '\r\n'
+                          'Content-Type: application/http\r\n'
+                          'Content-ID: <response-' + content_id[1:-1] + '>\r\n\r\n'
+                          'HTTP/1.1 ' + str(status) + ' ' + http.HTTPStatus(status).phrase + '\r\n'
+                          'Content-Type: application/json; charset=UTF-8\r\n'
+                          'Content-Length: ' + str(len(content.encode())) + '\r\n\r\n' + content + '\r\n')
+        content = ''.join(chunks) + '--' + boundary + '--\r\n'
+        return 200, {'Content-Type': 'multipart/mixed; boundary=' + boundary}, content.encode()
+
+
+class LocalTransport:
+    """
+    Wraps the transport of an API object (e.g. a CalendarTransport.ConnectionPool) so that
+    the requests it sends to Google go to a local server instead, batch requests included.
+
+    :param server_url: The root URL of the server, e.g. FakeCalendarServer.url
+    :param transport: The http object to send the requests through
+    """
+
+    def __init__(self, server_url, transport):
+        self.server_url = server_url.rstrip('/') + '/'
+        self.transport = transport
+
+    @property
+    def credentials(self):
+        return getattr(self.transport, 'credentials', None)
+
+    @credentials.setter
+    def credentials(self, credentials):
+        self.transport.credentials = credentials
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if uri.startswith(GOOGLE_ROOT_URL):
+            uri = self.server_url + uri[len(GOOGLE_ROOT_URL):]
+        return self.transport.request(uri, method=method, body=body, headers=headers, **kwargs)
+
+    def close(self):
+        self.transport.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='CalendarFakeServer.py', description="A local stand-in for the Calendar API.")
+    parser.add_argument('--events', type=int, default=10000, help="the number of events to generate")
+    parser.add_argument('--seed', type=int, default=0, help="the seed of the generated events")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help="the port to listen on, any free port by default")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds to delay every request by")
+    parser.add_argument('--quota', type=float, help="the requests per second answered, unlimited by default")
+    args = parser.parse_args(argv)
+
+    server = FakeCalendarServer(FakeCalendar.generate(args.events, seed=args.seed), args.host, args.port, args.latency,
+                                args.quota)
+    # The first line tells a parent process where to send its requests
+    print("Serving", args.events, "events at", server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+# In-memory indexes over events that have already been fetched.
+# An IntervalIndex answers "which events overlap this window" for any year, month, date or
+# time slot inside the range it was built from, without going back to the API.
+# A DateCountIndex knows how many events every year, month and day has, so that
+# navigate_calendar can show where the events are before fetching any of them.
+
+import collections
+import datetime
+import time
+
+import Calendar
+
+# The fields the DateCountIndex needs from a listing.
+COUNT_FIELDS = 'nextPageToken,nextSyncToken,items(id,status,start,end)'
+
+
+class IntervalIndex:
+    """
+    A static interval tree over events. The events are sorted by start time and viewed as
+    an implicit balanced binary tree (the middle event of every range is the root of that
+    range), where every node also knows the latest end time of its subtree. A query only
+    descends into the subtrees that can hold an overlapping event, which takes
+    O(log n + k) for k results.
+
+    :param events: The events to index, the API's dicts or Calendar.Event objects
+    :param time_min: The RFC3339 start of the range the events were fetched for
+    :param time_max: The RFC3339 end of the range the events were fetched for
+    """
+
+    def __init__(self, events, time_min, time_max):
+        self.time_min = Calendar.get_event_timestamp(time_min)
+        self.time_max = Calendar.get_event_timestamp(time_max)
+        entries = []
+        for event in events:
+            if isinstance(event, Calendar.Event):
+                entries.append((event.start, event.end, event))
+            else:
+                entries.append((Calendar.get_event_timestamp(event['start']),
+                                Calendar.get_event_timestamp(event['end']), event))
+        entries.sort(key=lambda entry: entry[0])
+        self._starts = [entry[0] for entry in entries]
+        self._ends = [entry[1] for entry in entries]
+        self._events = [entry[2] for entry in entries]
+        self._max_ends = list(self._ends)
+        self._build(0, len(entries))
+
+    def __len__(self):
+        return len(self._events)
+
+    def _build(self, low, high):
+        """
+        Computes the latest end time of the subtree over the events in [low, high).
+        """
+        if low >= high:
+            return float('-inf')
+        middle = (low + high) // 2
+        latest = max(self._ends[middle], self._build(low, middle), self._build(middle + 1, high))
+        self._max_ends[middle] = latest
+        return latest
+
+    def covers(self, time_min, time_max):
+        """
+        Checks whether the window lies inside the range the index was built from, so that
+        the index has every event of it.
+
+        :param time_min: The RFC3339 start of the window
+        :param time_max: The RFC3339 end of the window
+        """
+        return (self.time_min <= Calendar.get_event_timestamp(time_min) and
+                Calendar.get_event_timestamp(time_max) <= self.time_max)
+
+    def query(self, time_min, time_max):
+        """
+        Returns the events overlapping the window, i.e. ending after time_min and starting
+        before time_max, ordered by start time.
+
+        :param time_min: The RFC3339 start of the window
+        :param time_max: The RFC3339 end of the window
+        """
+        return self.overlapping(Calendar.get_event_timestamp(time_min), Calendar.get_event_timestamp(time_max))
+
+    def overlapping(self, start, end):
+        """
+        Returns the events overlapping the slot between two timestamps, ordered by start
+        time, e.g. to find the conflicts of a new event.
+
+        :param start: The POSIX timestamp of the start of the slot
+        :param end: The POSIX timestamp of the end of the slot
+        """
+        found = []
+        # The ranges are visited in order (left subtree, node, right subtree), so the
+        # results come out sorted by start time
+        stack = [(0, len(self._events), False)]
+        while stack:
+            low, high, visit_node = stack.pop()
+            middle = (low + high) // 2
+            if visit_node:
+                if self._ends[middle] > start:
+                    found.append(self._events[middle])
+                continue
+            # Nothing in this subtree ends after the slot starts
+            if low >= high or self._max_ends[middle] <= start:
+                continue
+            # The node and its right subtree only start later than the node itself
+            if self._starts[middle] < end:
+                stack.append((middle + 1, high, False))
+                stack.append((middle, middle + 1, True))
+            stack.append((low, middle, False))
+        return found
+
+    def query_date(self, year, month=0, day=0):
+        """
+        Returns the events of the given year, year's month or date, ordered by start time.
+
+        :param year: The year we want to search through for events
+        :param month: The month we want to search through for events (optional)
+        :param day: The day we want to search through for events (optional)
+        """
+        return self.query(*Calendar.get_specific_time_window(year, month, day))
+
+
+def _days(start, end):
+    """
+    Returns the UTC dates whose window (see Calendar.get_specific_time_window) an event
+    between two timestamps is listed in, i.e. the days it overlaps.
+    """
+    first = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).date()
+    if end <= start:
+        # An event without length is listed in the day it starts in, unless it is midnight
+        return [first] if start % 86400 else []
+    last = datetime.datetime.fromtimestamp(end, datetime.timezone.utc).date()
+    if end % 86400 == 0:
+        last -= datetime.timedelta(days=1)
+    return [first + datetime.timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+
+class DateCountIndex:
+    """
+    The number of events of every year, month and day, kept in three counters. An event
+    counts once in every bucket it overlaps, so that every count matches the number of
+    events get_specific_time_events would list for that year, month or date. Events can
+    be added, changed and removed one at a time, and the index can follow the calendar
+    with incremental syncs.
+
+    :param events: The events to count, the API's dicts or Calendar.Event objects
+    :param time_min: The RFC3339 start of the range the events were fetched for, None if
+    they are all the events of the calendar
+    :param time_max: The RFC3339 end of the range the events were fetched for
+    """
+
+    def __init__(self, events=(), time_min=None, time_max=None):
+        self.time_min = Calendar.get_event_timestamp(time_min) if time_min is not None else float('-inf')
+        self.time_max = Calendar.get_event_timestamp(time_max) if time_max is not None else float('inf')
+        # The query parameters of the scan the index is built from
+        self._window = {name: value for name, value in (('timeMin', time_min), ('timeMax', time_max))
+                        if value is not None}
+        self.sync_token = None
+        # The time the counts were last known to match the calendar
+        self.synced_at = time.time()
+        self._clear()
+        for event in events:
+            self.add(event)
+
+    def reset(self, events=()):
+        """
+        Counts the given events instead of the ones counted so far, e.g. after the local
+        store they were read from changed.
+
+        :param events: The events to count, the API's dicts or Calendar.Event objects
+        """
+        self._clear()
+        self.sync_token = None
+        for event in events:
+            self.add(event)
+        self.synced_at = time.time()
+
+    def _clear(self):
+        self._years = collections.Counter()
+        self._months = collections.Counter()
+        self._days = collections.Counter()
+        # The days every event is counted in, to take it out again when it changes
+        self._events = {}
+
+    def __len__(self):
+        return len(self._events)
+
+    @classmethod
+    def build(cls, api, time_min=None, time_max=None, calendar_id='primary', page_size=Calendar.DEFAULT_PAGE_SIZE):
+        """
+        Builds the index from one scan of the calendar, downloading only the times of the
+        events. Without a window the scan covers the whole calendar and keeps its sync
+        token, so that sync only has to fetch the changes.
+
+        :param api: API of the Google Calendar
+        :param time_min: The RFC3339 start of the range to count, None for no limit
+        :param time_max: The RFC3339 end of the range to count, None for no limit
+        :param calendar_id: The calendar to count the events of
+        :param page_size: The number of events requested per page
+        """
+        index = cls(time_min=time_min, time_max=time_max)
+        index._rebuild(api, calendar_id, page_size)
+        return index
+
+    def _rebuild(self, api, calendar_id, page_size):
+        self._clear()
+        self.sync_token = None
+        self._scan(api, calendar_id, page_size, self._window)
+        # The changes since a scan of a window would include events outside of it
+        if self._window:
+            self.sync_token = None
+        self.synced_at = time.time()
+
+    def _scan(self, api, calendar_id, page_size, kwargs, changed=None):
+        """
+        Applies every event of a listing to the index and keeps its sync token.
+        """
+        for page in Calendar.iter_pages(api.events().list, calendarId=calendar_id, maxResults=page_size,
+                                        singleEvents=True, fields=COUNT_FIELDS, **kwargs):
+            self.update(page.get('items', []), changed)
+            self.sync_token = page.get('nextSyncToken', self.sync_token)
+
+    def sync(self, api, calendar_id='primary', page_size=Calendar.DEFAULT_PAGE_SIZE):
+        """
+        Brings the index up to date with the calendar: only the events changed since the
+        last scan are downloaded, unless the index has no sync token (it was built for a
+        window) or the token has expired, in which case it is rebuilt. Returns the days
+        (datetime.date) the changed events were or are now in, every day counted when the
+        index was rebuilt.
+
+        :param api: API of the Google Calendar
+        :param calendar_id: The calendar the index counts the events of
+        :param page_size: The number of events requested per page
+        """
+        changed = set()
+        if self.sync_token is not None:
+            try:
+                self._scan(api, calendar_id, page_size, {'syncToken': self.sync_token}, changed)
+                self.synced_at = time.time()
+                return changed
+            except Exception as error:
+                if Calendar.get_error_status(error) != 410:
+                    raise
+        # Any event may have changed
+        changed.update(day for days in self._events.values() for day in days)
+        self._rebuild(api, calendar_id, page_size)
+        changed.update(day for days in self._events.values() for day in days)
+        return changed
+
+    def add(self, event):
+        """
+        Counts an event, replacing any earlier version of it.
+
+        :param event: The event, the API's dict or a Calendar.Event
+        """
+        if isinstance(event, Calendar.Event):
+            event_id, start, end = event.id, event.start, event.end
+        else:
+            event_id = event['id']
+            start = Calendar.get_event_timestamp(event['start'])
+            end = Calendar.get_event_timestamp(event['end'])
+        self.remove(event_id)
+        if start < self.time_max and end > self.time_min:
+            days = _days(max(start, self.time_min), min(end, self.time_max))
+        else:
+            days = []
+        self._count(days, 1)
+        self._events[event_id] = days
+
+    def remove(self, event_id):
+        """
+        Stops counting an event, if it was counted.
+
+        :param event_id: The id of the event
+        """
+        days = self._events.pop(event_id, None)
+        if days is not None:
+            self._count(days, -1)
+
+    def update(self, events, changed=None):
+        """
+        Applies a list of new, changed and cancelled events, e.g. the result of an
+        incremental sync.
+
+        :param events: The events, as listed by the API
+        :param changed: An optional set the days the events were and are now in are added to
+        """
+        for event in events:
+            if changed is not None:
+                changed.update(self._events.get(event['id'], ()))
+            if event.get('status') == 'cancelled' or 'start' not in event:
+                self.remove(event['id'])
+            else:
+                self.add(event)
+                if changed is not None:
+                    changed.update(self._events[event['id']])
+
+    def _count(self, days, change):
+        months = set()
+        years = set()
+        for day in days:
+            self._days[day.year, day.month, day.day] += change
+            months.add((day.year, day.month))
+            years.add(day.year)
+        for month in months:
+            self._months[month] += change
+        for year in years:
+            self._years[year] += change
+
+    def covers(self, year, month=0, day=0):
+        """
+        Checks whether the window of the year, month or date lies inside the range the
+        index was built for, so that its count is known.
+        """
+        start_time, end_time = Calendar.get_specific_time_window(year, month, day)
+        return (self.time_min <= Calendar.get_event_timestamp(start_time) and
+                Calendar.get_event_timestamp(end_time) <= self.time_max)
+
+    def count(self, year=0, month=0, day=0):
+        """
+        Returns the number of events of the given year, year's month or date, or of every
+        event counted if no year is given.
+
+        :param year: The year of the bucket, 0 for all of them
+        :param month: The month of the bucket, 0 for the whole year
+        :param day: The day of the bucket, 0 for the whole month
+        """
+        if year == 0:
+            return len(self._events)
+        if month == 0:
+            return self._years[year]
+        if day == 0:
+            return self._months[year, month]
+        return self._days[year, month, day]
+
+    def buckets(self, year=0, month=0):
+        """
+        Returns the (key, count) pairs of the buckets one level down that have events, in
+        order: the years if no year is given, otherwise the months of the year, or the
+        days of the year's month.
+
+        :param year: The year to list the months of, 0 to list the years
+        :param month: The month to list the days of, 0 to list the months
+        """
+        if year == 0:
+            found = ((key, count) for key, count in self._years.items())
+        elif month == 0:
+            found = ((key[1], count) for key, count in self._months.items() if key[0] == year)
+        else:
+            found = ((key[2], count) for key, count in self._days.items() if key[:2] == (year, month))
+        return sorted((key, count) for key, count in found if count > 0)
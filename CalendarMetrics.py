@@ -0,0 +1,380 @@
+# Instrumentation of the API calls of the Calendar application.
+# Every request Calendar.py sends goes through execute() below, which times it, measures
+# the size of its response and passes them on to the registered sinks, together with the
+# hits and misses of the local caches (the event store and the interval index). Sinks are
+# any objects with record_call and record_cache methods; the ones provided here keep the
+# numbers in memory (Stats), log every call (LogSink) or write them to a Prometheus text
+# file (PrometheusFileSink). With no sink registered, requests are sent as is.
+#
+#     with CalendarMetrics.collect() as stats:
+#         Calendar.delete_event_by_name(api, 'test')
+#     print(stats.format())
+#
+# profile() runs a block of code under cProfile, for finding hot paths.
+
+import collections
+import contextlib
+import io
+import logging
+import os
+import sys
+import threading
+import time
+
+# Upper bounds in seconds of the buckets of the latency histograms.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Minimum number of seconds between two writes of a PrometheusFileSink.
+DEFAULT_WRITE_INTERVAL = 10
+
+_sinks = ()
+_sinks_lock = threading.Lock()
+
+
+def add_sink(sink):
+    """
+    Registers a sink, which is then told about every request and cache lookup.
+
+    :param sink: An object with record_call(operation, seconds, size, status) and
+    record_cache(cache, hit) methods
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = _sinks + (sink,)
+
+
+def remove_sink(sink):
+    """
+    Unregisters a sink added with add_sink.
+
+    :param sink: The sink to remove
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = tuple(registered for registered in _sinks if registered is not sink)
+
+
+@contextlib.contextmanager
+def collect(buckets=DEFAULT_BUCKETS):
+    """
+    Collects the metrics of the requests sent during the with block in a Stats object.
+
+    :param buckets: The upper bounds in seconds of the latency histogram buckets
+    """
+    stats = Stats(buckets)
+    add_sink(stats)
+    try:
+        yield stats
+    finally:
+        remove_sink(stats)
+
+
+def _operation(request):
+    """
+    Returns the name of the API method of a request, e.g. 'events.list'.
+    """
+    method_id = getattr(request, 'methodId', None)
+    if isinstance(method_id, str):
+        return method_id[len('calendar.'):] if method_id.startswith('calendar.') else method_id
+    return 'request'
+
+
+def _status(error):
+    """
+    Returns the HTTP status of a failed request, or 0 if it failed before getting a response.
+    """
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return int(status) if status is not None else 0
+
+
+def _on_response(request, callback):
+    """
+    Calls callback(status, size) when the response of a request is received, before it is
+    parsed, whether the request is sent on its own or as part of a batch. Returns the
+    request's own response handler, to put back once the request is done.
+    """
+    postproc = request.postproc
+
+    def measured(resp, content):
+        callback(int(resp.status), len(content) if content else 0)
+        return postproc(resp, content)
+
+    request.postproc = measured
+    return postproc
+
+
+def track(request, sinks=None):
+    """
+    Records the status and response size of a request that is sent as part of a batch, as
+    a call without a duration (the batch is timed as a whole), and returns the request.
+
+    :param request: The request that is added to a batch
+    :param sinks: The sinks to record to, the registered ones by default
+    """
+    sinks = _sinks if sinks is None else sinks
+    if sinks:
+        operation = _operation(request)
+
+        def record(status, size):
+            for sink in sinks:
+                sink.record_call(operation, None, size, status)
+
+        _on_response(request, record)
+    return request
+
+
+def execute(request, operation=None):
+    """
+    Sends a request (or a batch of requests) and returns its response, recording its
+    duration, status and response size in the registered sinks.
+
+    :param request: The request of the API, e.g. api.events().list(...)
+    :param operation: The name the request is recorded under, the API method by default
+    """
+    sinks = _sinks
+    if not sinks:
+        return request.execute()
+
+    operation = operation or _operation(request)
+    received = [200, 0]
+
+    def record(status, size):
+        received[0] = status
+        received[1] += size
+
+    # A batch's own response is not measured, its requests are (see track)
+    postproc = _on_response(request, record) if hasattr(request, 'postproc') else None
+    start = time.perf_counter()
+    try:
+        response = request.execute()
+    except Exception as error:
+        seconds = time.perf_counter() - start
+        for sink in sinks:
+            sink.record_call(operation, seconds, received[1], _status(error) or received[0])
+        raise
+    finally:
+        # The request may be sent again, e.g. when it is retried
+        if postproc is not None:
+            request.postproc = postproc
+    seconds = time.perf_counter() - start
+    for sink in sinks:
+        sink.record_call(operation, seconds, received[1], received[0])
+    return response
+
+
+def record_cache(cache, hit):
+    """
+    Records a lookup in a local cache, e.g. whether the event store was fresh enough to
+    answer a query without syncing.
+
+    :param cache: The name of the cache, e.g. 'event_store'
+    :param hit: Whether the cache could answer the lookup
+    """
+    for sink in _sinks:
+        sink.record_cache(cache, hit)
+
+
+class Stats:
+    """
+    A sink keeping the metrics in memory: the number of calls, failures and response bytes
+    of every operation, a histogram of their durations, and the hits and misses of every
+    cache.
+
+    :param buckets: The upper bounds in seconds of the latency histogram buckets
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes = collections.Counter()
+        self.seconds = collections.Counter()
+        self.statuses = collections.Counter()
+        # The number of timed calls of every operation per bucket, the last one for the
+        # calls slower than every bound
+        self.histograms = {}
+        self.cache_hits = collections.Counter()
+        self.cache_misses = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record_call(self, operation, seconds, size, status):
+        with self._lock:
+            self.calls[operation] += 1
+            self.bytes[operation] += size
+            self.statuses[operation, status] += 1
+            if status >= 400 or status == 0:
+                self.errors[operation] += 1
+            if seconds is not None:
+                self.seconds[operation] += seconds
+                histogram = self.histograms.setdefault(operation, [0] * (len(self.buckets) + 1))
+                position = 0
+                while position < len(self.buckets) and seconds > self.buckets[position]:
+                    position += 1
+                histogram[position] += 1
+
+    def record_cache(self, cache, hit):
+        with self._lock:
+            if hit:
+                self.cache_hits[cache] += 1
+            else:
+                self.cache_misses[cache] += 1
+
+    def hit_rate(self, cache):
+        """
+        Returns the share of the lookups in a cache that were hits, None if there were none.
+
+        :param cache: The name of the cache
+        """
+        lookups = self.cache_hits[cache] + self.cache_misses[cache]
+        return self.cache_hits[cache] / lookups if lookups else None
+
+    def percentile(self, operation, fraction):
+        """
+        Returns an upper bound of the given percentile of the durations of an operation, i.e.
+        the bound of the histogram bucket it falls in (inf if it is above every bound), or
+        None if the operation was never timed.
+
+        :param operation: The name of the operation
+        :param fraction: The percentile as a fraction, e.g. 0.99
+        """
+        histogram = self.histograms.get(operation)
+        if not histogram:
+            return None
+        rank = fraction * sum(histogram)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), histogram):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return float('inf')
+
+    def format(self):
+        """
+        Returns a text summary of the metrics, one line per operation and per cache.
+        """
+        lines = []
+        with self._lock:
+            for operation in sorted(self.calls):
+                timed = sum(self.histograms.get(operation, ()))
+                mean = self.seconds[operation] / timed * 1000 if timed else 0.0
+                lines.append('{}: {} calls, {} errors, {} bytes, mean {:.1f} ms, p99 <= {} s'.format(
+                    operation, self.calls[operation], self.errors[operation], self.bytes[operation], mean,
+                    self.percentile(operation, 0.99)))
+            for cache in sorted(set(self.cache_hits) | set(self.cache_misses)):
+                lines.append('{} cache: {} hits, {} misses ({:.0%} hit rate)'.format(
+                    cache, self.cache_hits[cache], self.cache_misses[cache], self.hit_rate(cache)))
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = ['# TYPE calendar_api_requests_total counter']
+        with self._lock:
+            for (operation, status), count in sorted(self.statuses.items()):
+                lines.append('calendar_api_requests_total{{operation="{}",status="{}"}} {}'.format(
+                    operation, status, count))
+            lines.append('# TYPE calendar_api_response_bytes_total counter')
+            for operation, size in sorted(self.bytes.items()):
+                lines.append('calendar_api_response_bytes_total{{operation="{}"}} {}'.format(operation, size))
+            lines.append('# TYPE calendar_api_request_seconds histogram')
+            for operation, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram):
+                    cumulative += count
+                    label = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('calendar_api_request_seconds_bucket{{operation="{}",le="{}"}} {}'.format(
+                        operation, label, cumulative))
+                lines.append('calendar_api_request_seconds_sum{{operation="{}"}} {}'.format(
+                    operation, self.seconds[operation]))
+                lines.append('calendar_api_request_seconds_count{{operation="{}"}} {}'.format(operation, cumulative))
+            lines.append('# TYPE calendar_cache_lookups_total counter')
+            for cache in sorted(set(self.cache_hits) | set(self.cache_misses)):
+                lines.append('calendar_cache_lookups_total{{cache="{}",result="hit"}} {}'.format(
+                    cache, self.cache_hits[cache]))
+                lines.append('calendar_cache_lookups_total{{cache="{}",result="miss"}} {}'.format(
+                    cache, self.cache_misses[cache]))
+        return '\n'.join(lines) + '\n'
+
+
+class LogSink:
+    """
+    A sink logging every request and cache lookup, e.g. to trace what a session does.
+
+    :param logger: The logger to log to, the 'Calendar' logger by default
+    :param level: The level the records are logged at
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('Calendar')
+        self.level = level
+
+    def record_call(self, operation, seconds, size, status):
+        if seconds is None:
+            self.logger.log(self.level, '%s -> %s, %d bytes (batched)', operation, status, size)
+        else:
+            self.logger.log(self.level, '%s -> %s, %d bytes in %.1f ms', operation, status, size, seconds * 1000)
+
+    def record_cache(self, cache, hit):
+        self.logger.log(self.level, '%s cache %s', cache, 'hit' if hit else 'miss')
+
+
+class PrometheusFileSink(Stats):
+    """
+    A sink writing the metrics to a file in the Prometheus text format, e.g. for the
+    textfile collector of the node exporter. The file is rewritten at most once every
+    interval seconds while requests are recorded, and when write() is called.
+
+    :param path: The file to write the metrics to
+    :param interval: The minimum number of seconds between two writes
+    :param buckets: The upper bounds in seconds of the latency histogram buckets
+    """
+
+    def __init__(self, path, interval=DEFAULT_WRITE_INTERVAL, buckets=DEFAULT_BUCKETS):
+        super().__init__(buckets)
+        self.path = path
+        self.interval = interval
+        self._written_at = time.monotonic()
+
+    def record_call(self, operation, seconds, size, status):
+        super().record_call(operation, seconds, size, status)
+        if time.monotonic() - self._written_at >= self.interval:
+            self.write()
+
+    def write(self):
+        """
+        Writes the metrics to the file, replacing it at once so that it is never read half written.
+        """
+        self._written_at = time.monotonic()
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as output:
+            output.write(self.to_prometheus())
+        os.replace(temporary, self.path)
+
+
+@contextlib.contextmanager
+def profile(path=None, sort='cumulative', limit=30, stream=None):
+    """
+    Runs the with block under cProfile, then saves the profile to a file (to be read with
+    pstats or a viewer such as snakeviz) or prints its hottest functions.
+
+    :param path: The file to save the profile to, None to print it
+    :param sort: The column the printed functions are sorted by
+    :param limit: The number of printed functions
+    :param stream: Where the profile is printed, sys.stderr by default
+    """
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        else:
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+            (stream or sys.stderr).write(output.getvalue())
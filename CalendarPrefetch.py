@@ -0,0 +1,261 @@
+# Background prefetching for navigate_calendar.
+# After a year, month or day is shown, the next one asked for is usually the one before
+# or after it. A WindowPrefetcher fetches those neighbouring windows on a background
+# thread while the user is reading, so that moving to them is answered from memory.
+# Windows that are no longer next to the one shown are dropped from the queue, the queue
+# only holds a few windows, and the fetched windows are evicted (least recently used
+# first) once they hold more events than the memory cap. A window whose events changed is
+# invalidated, and the windows expire after a while, so that they are fetched again the
+# next time they are shown.
+#
+# The default http object of the API cannot be shared between threads, so the API should
+# be built on a CalendarTransport.ConnectionPool.
+
+import collections
+import datetime
+import threading
+import time
+
+from dateutil.relativedelta import relativedelta
+
+import Calendar
+
+# Number of windows waiting to be fetched, the oldest predictions are dropped first.
+DEFAULT_MAX_PENDING = 4
+
+# Number of events kept in the fetched windows before the least recently used are evicted.
+DEFAULT_MAX_EVENTS = 5000
+
+# Number of seconds a window is kept before it is fetched again, to pick up the changes
+# made to its events since.
+DEFAULT_MAX_AGE = 30
+
+
+def neighbours(year, month=0, day=0, depth=1):
+    """
+    Returns the windows of the same length around a year, month or date, the closest
+    first and the later one before the earlier one, e.g. the next and previous months.
+
+    :param year: The year of the window
+    :param month: The month of the window, 0 for the whole year
+    :param day: The day of the window, 0 for the whole month
+    :param depth: The number of windows on each side
+    """
+    if month == 0:
+        step, start = relativedelta(years=1), datetime.date(year, 1, 1)
+    elif day == 0:
+        step, start = relativedelta(months=1), datetime.date(year, month, 1)
+    else:
+        step, start = relativedelta(days=1), datetime.date(year, month, day)
+    found = []
+    for distance in range(1, depth + 1):
+        for sign in (1, -1):
+            try:
+                moment = start + sign * distance * step
+            except (OverflowError, ValueError):
+                continue
+            found.append((moment.year, moment.month if month else 0, moment.day if day else 0))
+    return found
+
+
+class WindowPrefetcher:
+    """
+    Fetches the windows around the one being viewed on a background thread and keeps them
+    for get to answer.
+
+    :param api: API of the Google Calendar, built on a CalendarTransport.ConnectionPool
+    :param fetch: The function fetching the events of a (year, month, day) window,
+    Calendar.get_specific_time_events by default
+    :param depth: The number of windows prefetched on each side of the one viewed
+    :param max_pending: The most windows waiting to be fetched
+    :param max_events: The most events kept in the fetched windows
+    :param max_age: The number of seconds a window is kept for, whether it was fetched in
+    the background or given to visit
+    """
+
+    def __init__(self, api, fetch=None, depth=1, max_pending=DEFAULT_MAX_PENDING, max_events=DEFAULT_MAX_EVENTS,
+                 max_age=DEFAULT_MAX_AGE):
+        if max_pending < 1 or max_events < 1:
+            raise ValueError("Queue size and memory cap must be at least 1.")
+        self._fetch = fetch or (lambda year, month, day: Calendar.get_specific_time_events(api, year, month, day))
+        self.depth = depth
+        self.max_pending = max_pending
+        self.max_events = max_events
+        self.max_age = max_age
+        self._pending = collections.deque()
+        self._in_flight = None
+        # Whether the window being fetched was invalidated, its events are then dropped
+        self._in_flight_stale = False
+        # The fetched windows, least recently used first, and how many events they hold
+        self._windows = collections.OrderedDict()
+        self._size = 0
+        # The time every window was stored at
+        self._stored_at = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.cancelled = 0
+        self.evicted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._condition:
+            return self._size
+
+    def get(self, year, month=0, day=0):
+        """
+        Returns the events of a window if they were prefetched, waiting for them if they
+        are being fetched, or None if they have to be fetched by the caller.
+
+        :param year: The year of the window
+        :param month: The month of the window, 0 for the whole year
+        :param day: The day of the window, 0 for the whole month
+        """
+        window = (year, month, day)
+        with self._condition:
+            while self._in_flight == window:
+                self._condition.wait()
+            self._expire(window)
+            events = self._windows.get(window)
+            if events is None:
+                # The caller fetches it now, there is no need to fetch it again
+                if window in self._pending:
+                    self._pending.remove(window)
+                self.misses += 1
+                return None
+            self._windows.move_to_end(window)
+            self.hits += 1
+            return events
+
+    def visit(self, year, month=0, day=0, events=None):
+        """
+        Takes note that a window is being viewed: the windows waiting to be fetched that
+        are not next to it are cancelled, and its neighbours are queued.
+
+        :param year: The year of the window
+        :param month: The month of the window, 0 for the whole year
+        :param day: The day of the window, 0 for the whole month
+        :param events: The events of the window, if they were fetched by the caller, to keep
+        them for when the user comes back to it
+        """
+        wanted = neighbours(year, month, day, self.depth)
+        with self._condition:
+            if self._closed:
+                return
+            if events is not None:
+                self._store((year, month, day), events)
+            kept = [window for window in self._pending if window in wanted]
+            self.cancelled += len(self._pending) - len(kept)
+            self._pending = collections.deque(kept)
+            for window in wanted:
+                self._expire(window)
+                if window in self._windows or window in self._pending or window == self._in_flight:
+                    continue
+                if len(self._pending) >= self.max_pending:
+                    break
+                self._pending.append(window)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def invalidate(self, year, month=0, day=0):
+        """
+        Drops the events kept for a window, e.g. after one of its events changed, so that
+        get does not answer with them anymore. If the window is being fetched, the events
+        fetched are dropped as well.
+
+        :param year: The year of the window
+        :param month: The month of the window, 0 for the whole year
+        :param day: The day of the window, 0 for the whole month
+        """
+        window = (year, month, day)
+        with self._condition:
+            self._drop(window)
+            if window == self._in_flight:
+                self._in_flight_stale = True
+
+    def cancel(self):
+        """
+        Drops every window waiting to be fetched, e.g. when the user leaves the calendar.
+        """
+        with self._condition:
+            self.cancelled += len(self._pending)
+            self._pending.clear()
+
+    def close(self):
+        """
+        Cancels the pending windows and stops the background thread once the window being
+        fetched, if any, is done.
+        """
+        with self._condition:
+            self._closed = True
+            self.cancelled += len(self._pending)
+            self._pending.clear()
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _store(self, window, events):
+        """
+        Keeps the events of a window, evicting the least recently used windows to stay
+        under the memory cap. Windows larger than the cap are not kept.
+        """
+        events = list(events)
+        self._drop(window)
+        if len(events) > self.max_events:
+            return
+        self._windows[window] = events
+        self._stored_at[window] = time.monotonic()
+        self._size += len(events)
+        while self._size > self.max_events:
+            self._drop(next(iter(self._windows)))
+            self.evicted += 1
+
+    def _drop(self, window):
+        """
+        Stops keeping the events of a window, if they are kept.
+        """
+        events = self._windows.pop(window, None)
+        if events is not None:
+            self._size -= len(events)
+            del self._stored_at[window]
+
+    def _expire(self, window):
+        """
+        Drops a window kept for max_age seconds or more, so that it is fetched again.
+        """
+        stored_at = self._stored_at.get(window)
+        if stored_at is not None and time.monotonic() - stored_at >= self.max_age:
+            self._drop(window)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                window = self._pending.popleft()
+                self._in_flight = window
+                self._in_flight_stale = False
+            events = None
+            try:
+                events = self._fetch(*window)
+            except Exception:
+                # The window is fetched again, and the error raised, when it is asked for
+                pass
+            with self._condition:
+                self._in_flight = None
+                if events is not None and not self._in_flight_stale:
+                    self._store(window, events)
+                    self.fetched += 1
+                self._condition.notify_all()
@@ -0,0 +1,210 @@
+# Local expansion of recurring events for the Calendar application.
+# Listing with singleEvents=True makes the API send every occurrence of a series, e.g.
+# about 1300 copies of a daily standup over five years. iter_expanded_events lists the
+# window with singleEvents=False instead, so that only the single events, the series
+# (their master events) and the instances that were changed are sent, then expands the
+# RRULE, RDATE and EXDATE lines of every series with dateutil.rrule. The instances are
+# generated lazily and merged with the single events in start time order, so memory and
+# the bytes downloaded grow with the number of series rather than of occurrences.
+#
+# Instances that were moved out of the window, or deleted without an EXDATE being added,
+# are only known to the API; the expansion matches singleEvents=True for everything
+# else, including instances moved into the window.
+
+import datetime
+import heapq
+import re
+
+from dateutil import rrule, tz
+
+import Calendar
+
+_UNTIL = re.compile(r'UNTIL=([0-9TZ]+)', re.IGNORECASE)
+
+# The fields needed to expand the series, on top of the ones the listings show.
+EXPAND_FIELDS = 'nextPageToken,items(id,status,summary,start,end,reminders,recurrence,recurringEventId,' \
+                'originalStartTime)'
+
+
+def _parse_time(event_time):
+    """
+    Returns the start or end of an event as a datetime: a naive one at midnight for an
+    all-day event, otherwise an aware one in the event's time zone if it has one.
+    """
+    if 'date' in event_time:
+        return datetime.datetime.fromisoformat(event_time['date'])
+    text = event_time['dateTime']
+    moment = datetime.datetime.fromisoformat(text[:-1] + '+00:00' if text.endswith('Z') else text)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    zone = tz.gettz(event_time['timeZone']) if event_time.get('timeZone') else None
+    return moment.astimezone(zone) if zone is not None else moment
+
+
+def _format_time(moment, like):
+    """
+    Returns the start or end field of an instance, in the same form as the master's.
+
+    :param moment: The time of the instance, as returned by _parse_time
+    :param like: The corresponding field of the master
+    """
+    if 'date' in like:
+        return {'date': moment.date().isoformat()}
+    if like['dateTime'].endswith('Z'):
+        field = {'dateTime': moment.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+    else:
+        field = {'dateTime': moment.isoformat()}
+    if 'timeZone' in like:
+        field['timeZone'] = like['timeZone']
+    return field
+
+
+def _instance_id(master_id, moment, all_day):
+    if all_day:
+        return master_id + '_' + moment.strftime('%Y%m%d')
+    return master_id + '_' + moment.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _parse_dates(line, dtstart):
+    """
+    Returns the times listed by an RDATE or EXDATE line, in the same form as dtstart.
+    """
+    name, _, values = line.partition(':')
+    params = dict(param.partition('=')[::2] for param in name.split(';')[1:])
+    zone = tz.gettz(params['TZID']) if 'TZID' in params else dtstart.tzinfo
+    moments = []
+    for value in values.split(','):
+        value = value.strip()
+        if not value or '/' in value:
+            # Periods are not used by the Calendar API
+            continue
+        if len(value) == 8:
+            moment = datetime.datetime.strptime(value, '%Y%m%d')
+            if dtstart.tzinfo is not None:
+                moment = moment.replace(hour=dtstart.hour, minute=dtstart.minute, second=dtstart.second)
+        elif value.endswith('Z'):
+            moment = datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+        else:
+            moment = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+        if dtstart.tzinfo is None:
+            moment = moment.replace(tzinfo=None) if moment.tzinfo is None else \
+                moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        elif moment.tzinfo is None:
+            moment = moment.replace(tzinfo=zone)
+        moments.append(moment)
+    return moments
+
+
+def _normalize_until(line, dtstart):
+    """
+    Returns an RRULE line with its UNTIL in the same form as dtstart, which rrulestr
+    requires: in UTC for a series with a time zone, and without one for an all-day series.
+    The API also accepts a date for a timed series, or a UTC time for an all-day one.
+    """
+    match = _UNTIL.search(line)
+    if match is None:
+        return line
+    until = _parse_dates('UNTIL:' + match.group(1), dtstart)[0]
+    if until.tzinfo is not None:
+        value = until.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    else:
+        value = until.strftime('%Y%m%dT%H%M%S')
+    return line[:match.start(1)] + value + line[match.end(1):]
+
+
+def build_ruleset(recurrence, dtstart):
+    """
+    Returns the dateutil rruleset of a series.
+
+    :param recurrence: The recurrence lines of the master event (RRULE, RDATE and EXDATE)
+    :param dtstart: The start of the first instance, as returned by _parse_time
+    """
+    ruleset = rrule.rruleset()
+    for line in recurrence:
+        name = line.split(':', 1)[0].split(';', 1)[0].upper()
+        if name == 'RRULE':
+            ruleset.rrule(rrule.rrulestr(_normalize_until(line, dtstart), dtstart=dtstart))
+        elif name == 'RDATE':
+            for moment in _parse_dates(line, dtstart):
+                ruleset.rdate(moment)
+        elif name == 'EXDATE':
+            for moment in _parse_dates(line, dtstart):
+                ruleset.exdate(moment)
+    return ruleset
+
+
+def _timestamp(moment):
+    # All-day events are taken to start at midnight UTC, like Calendar.get_event_timestamp does
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def expand_series(master, lower, upper, exceptions=frozenset()):
+    """
+    Yields the instances of a series that overlap the window between two timestamps, in
+    start time order, leaving out the ones in exceptions (which the API sends on their own).
+
+    :param master: The master event, with its recurrence
+    :param lower: The POSIX timestamp of the start of the window
+    :param upper: The POSIX timestamp of the end of the window
+    :param exceptions: The POSIX timestamps of the original starts of the changed instances
+    """
+    start = _parse_time(master['start'])
+    duration = _parse_time(master['end']) - start
+    all_day = 'date' in master['start']
+    ruleset = build_ruleset(master['recurrence'], start)
+    # The instances starting before lower - duration end before the window
+    first = datetime.datetime.fromtimestamp(lower, datetime.timezone.utc) - duration
+    first = first.replace(tzinfo=None) if all_day else first
+    template = {name: value for name, value in master.items() if name != 'recurrence'}
+    for moment in ruleset.xafter(first, inc=True):
+        timestamp = _timestamp(moment)
+        if timestamp >= upper:
+            return
+        if timestamp in exceptions or _timestamp(moment + duration) <= lower:
+            continue
+        instance = dict(template)
+        instance['id'] = _instance_id(master['id'], moment, all_day)
+        instance['start'] = _format_time(moment, master['start'])
+        instance['end'] = _format_time(moment + duration, master['end'])
+        instance['recurringEventId'] = master['id']
+        instance['originalStartTime'] = instance['start']
+        yield instance
+
+
+def iter_expanded_events(api, time_min, time_max, calendar_id='primary', page_size=Calendar.DEFAULT_PAGE_SIZE):
+    """
+    Streams the events of a window in start time order like a singleEvents=True listing,
+    but expands the recurring events locally from their masters (see the top of this
+    module). The listing of the masters, single events and changed instances is read
+    first, then the instances are generated as they are consumed.
+
+    :param api: API of the Google Calendar
+    :param time_min: The RFC3339 start of the window
+    :param time_max: The RFC3339 end of the window
+    :param calendar_id: The calendar to list the events of
+    :param page_size: The number of events requested per page
+    """
+    lower = Calendar.get_event_timestamp(time_min)
+    upper = Calendar.get_event_timestamp(time_max)
+    singles = []
+    masters = []
+    # The original start times of the changed or cancelled instances of every series
+    exceptions = {}
+    for event in Calendar.iter_events(api, calendar_id=calendar_id, page_size=page_size, timeMin=time_min,
+                                      timeMax=time_max, singleEvents=False, showDeleted=True, fields=EXPAND_FIELDS):
+        if event.get('recurringEventId') and event.get('originalStartTime'):
+            exceptions.setdefault(event['recurringEventId'], set()).add(
+                Calendar.get_event_timestamp(event['originalStartTime']))
+        if event.get('status') == 'cancelled':
+            continue
+        if event.get('recurrence'):
+            masters.append(event)
+        else:
+            singles.append(event)
+
+    singles.sort(key=lambda event: Calendar.get_event_timestamp(event['start']))
+    streams = [singles] + [expand_series(master, lower, upper, exceptions.get(master['id'], frozenset()))
+                           for master in masters]
+    return heapq.merge(*streams, key=lambda event: Calendar.get_event_timestamp(event['start']))
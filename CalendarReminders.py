@@ -0,0 +1,228 @@
+# Bulk reminder editing for the Calendar application, the general form of
+# delete_event_reminder.
+# edit_reminders goes through the chosen calendars once, picking the events that match a
+# keyword, a time range and any other predicate, works out each one's new reminders by
+# applying a list of operations (AddReminder, RemoveReminder, ReplaceReminders,
+# UseDefaultReminders) in order, and sends a patch with only the reminders for the events
+# that actually changed, in batches, while the listing is still going.
+
+import Calendar
+
+# The reminder methods the API accepts.
+REMINDER_METHODS = ('email', 'popup')
+
+# The longest time before an event a reminder can be set (4 weeks, in minutes).
+MAX_REMINDER_MINUTES = 40320
+
+# The most reminders an event can have besides the default ones.
+MAX_OVERRIDES = 5
+
+
+def _check_reminder(method, minutes):
+    if method not in REMINDER_METHODS:
+        raise ValueError("Reminder method must be one of " + ', '.join(REMINDER_METHODS) + ".")
+    if not 0 <= minutes <= MAX_REMINDER_MINUTES:
+        raise ValueError("Reminder minutes must be between 0 and " + str(MAX_REMINDER_MINUTES) + ".")
+    return {'method': method, 'minutes': minutes}
+
+
+class AddReminder:
+    """
+    Adds a reminder to the events, unless they already have it. An event that uses the
+    default reminders keeps them as overrides next to the new one.
+
+    :param minutes: The minutes before the event the reminder is sent
+    :param method: 'popup' or 'email'
+    """
+
+    materializes_defaults = True
+
+    def __init__(self, minutes, method='popup'):
+        self.reminder = _check_reminder(method, minutes)
+
+    def apply(self, overrides):
+        if self.reminder in overrides:
+            return overrides
+        return overrides + [self.reminder]
+
+
+class RemoveReminder:
+    """
+    Removes the reminders set the given number of minutes before the events, optionally
+    only those sent by the given method, or every reminder if minutes is None. An event
+    that uses the default reminders keeps the other default ones as overrides.
+
+    :param minutes: The minutes of the reminders to remove, None for all of them
+    :param method: The method of the reminders to remove, None for any method
+    """
+
+    materializes_defaults = True
+
+    def __init__(self, minutes=None, method=None):
+        if method is not None and method not in REMINDER_METHODS:
+            raise ValueError("Reminder method must be one of " + ', '.join(REMINDER_METHODS) + ".")
+        self.minutes = minutes
+        self.method = method
+
+    def apply(self, overrides):
+        return [reminder for reminder in overrides
+                if not ((self.minutes is None or reminder['minutes'] == self.minutes) and
+                        (self.method is None or reminder['method'] == self.method))]
+
+
+class ReplaceReminders:
+    """
+    Replaces the reminders of the events, default ones included, with the given ones.
+
+    :param reminders: (method, minutes) pairs, empty to leave the events without reminders
+    """
+
+    materializes_defaults = False
+
+    def __init__(self, reminders):
+        self.reminders = [_check_reminder(method, minutes) for method, minutes in reminders]
+        if len(self.reminders) > MAX_OVERRIDES:
+            raise ValueError("An event can have at most " + str(MAX_OVERRIDES) + " reminders.")
+
+    def apply(self, overrides):
+        return list(self.reminders)
+
+
+class UseDefaultReminders:
+    """
+    Makes the events use the calendar's default reminders again.
+    """
+
+    materializes_defaults = False
+
+    def apply(self, overrides):
+        return None
+
+
+def apply_operations(reminders, operations, defaults):
+    """
+    Returns the reminders of an event after applying the operations in order, in the
+    form the API expects in a patch body.
+
+    :param reminders: The event's current reminders, as listed by the API
+    :param operations: The operations to apply
+    :param defaults: A function returning the calendar's default reminders, only called
+    if an operation has to turn them into overrides
+    """
+    # None stands for the default reminders
+    overrides = None if reminders.get('useDefault', True) else list(reminders.get('overrides', []))
+    for operation in operations:
+        if overrides is None and operation.materializes_defaults:
+            overrides = list(defaults())
+        overrides = operation.apply(overrides if overrides is not None else [])
+    if overrides is None:
+        return {'useDefault': True}
+    if len(overrides) > MAX_OVERRIDES:
+        raise ValueError("An event can have at most " + str(MAX_OVERRIDES) + " reminders.")
+    return {'useDefault': False, 'overrides': overrides}
+
+
+def _normalized(reminders):
+    if reminders.get('useDefault', True):
+        return {'useDefault': True}
+    return {'useDefault': False, 'overrides': list(reminders.get('overrides', []))}
+
+
+def select_events(api, keyword=None, time_min=None, time_max=None, calendar_ids=None, predicate=None,
+                  page_size=Calendar.DEFAULT_PAGE_SIZE):
+    """
+    Streams the events matching every given condition as (calendar id, event) pairs, in
+    one pass over each calendar. Recurring events are listed as their instances.
+
+    :param api: API of the Google Calendar
+    :param keyword: A keyword the events' summaries contain (ignoring case), like search_event
+    :param time_min: The RFC3339 time the events end after
+    :param time_max: The RFC3339 time the events start before
+    :param calendar_ids: The ids of the calendars to go through, the primary one by default
+    :param predicate: A function choosing which events are kept
+    :param page_size: The number of events requested per page
+    """
+    keyword = keyword.lower() if keyword else None
+
+    def matches(event):
+        if keyword is not None and keyword not in event.get('summary', '').lower():
+            return False
+        return predicate is None or predicate(event)
+
+    bounds = {}
+    if time_min is not None:
+        bounds['timeMin'] = time_min
+    if time_max is not None:
+        bounds['timeMax'] = time_max
+    if calendar_ids is not None:
+        return Calendar.iter_calendars_events(api, calendar_ids, page_size=page_size, predicate=matches, **bounds)
+    events = Calendar.iter_events(api, singleEvents=True, orderBy='startTime', fields=Calendar.LIST_FIELDS,
+                                  page_size=page_size, **bounds)
+    return (('primary', event) for event in events if matches(event))
+
+
+def edit_reminders(api, operations, keyword=None, time_min=None, time_max=None, calendar_ids=None, predicate=None,
+                   batch_size=Calendar.BATCH_SIZE, page_size=Calendar.DEFAULT_PAGE_SIZE):
+    """
+    Applies reminder operations to every event matching the given conditions (see
+    select_events). Only the events whose reminders change are updated, with a patch
+    holding nothing but the new reminders, and the patches are sent in batches as soon as
+    enough of them are ready. Events the operations cannot be applied to (e.g. they would
+    end up with too many reminders) are reported in the errors.
+
+    Returns a (results, errors) pair of dicts keyed by (calendar id, event id), see
+    Calendar.execute_batch.
+
+    :param api: API of the Google Calendar
+    :param operations: The operations to apply in order, e.g. [RemoveReminder(10), AddReminder(30)]
+    :param keyword: A keyword the events' summaries contain (ignoring case)
+    :param time_min: The RFC3339 time the events end after
+    :param time_max: The RFC3339 time the events start before
+    :param calendar_ids: The ids of the calendars to edit, the primary one by default
+    :param predicate: A function choosing which events are edited
+    :param batch_size: The maximum number of updates per batch, at most Calendar.BATCH_SIZE
+    :param page_size: The number of events requested per page
+    """
+    if not operations:
+        raise ValueError("At least one reminder operation is needed.")
+    # Checked before any update is sent, rather than by the first batch
+    if batch_size <= 0 or batch_size > Calendar.BATCH_SIZE:
+        raise ValueError("Batch size must be between 1 and " + str(Calendar.BATCH_SIZE) + ".")
+
+    # The default reminders of every calendar, only fetched for the calendars that need them
+    default_reminders = {}
+
+    def defaults(calendar_id):
+        if calendar_id not in default_reminders:
+            entry = Calendar.execute_request(api.calendarList().get(calendarId=calendar_id,
+                                                                    fields='defaultReminders'))
+            default_reminders[calendar_id] = entry.get('defaultReminders', [])
+        return default_reminders[calendar_id]
+
+    results = {}
+    errors = {}
+    pending = []
+
+    def flush():
+        batch_results, batch_errors = Calendar.execute_batch(api, pending, batch_size)
+        results.update(batch_results)
+        errors.update(batch_errors)
+        del pending[:]
+
+    for calendar_id, event in select_events(api, keyword, time_min, time_max, calendar_ids, predicate, page_size):
+        current = event.get('reminders') or {'useDefault': True}
+        try:
+            reminders = apply_operations(current, operations, lambda: defaults(calendar_id))
+        except ValueError as error:
+            errors[calendar_id, event['id']] = error
+            continue
+        if reminders == _normalized(current):
+            continue
+        pending.append(((calendar_id, event['id']), api.events().patch,
+                        {'calendarId': calendar_id, 'eventId': event['id'], 'body': {'reminders': reminders},
+                         'fields': 'id'}))
+        if len(pending) >= batch_size:
+            flush()
+    if pending:
+        flush()
+    return results, errors
@@ -0,0 +1,315 @@
+# Request scheduling for the Calendar application.
+# Every request sent by Calendar.py goes through a RequestScheduler, which
+#  - paces the requests with a token bucket, so that a burst of calls stays under the
+#    quota instead of running into it,
+#  - retries the requests throttled by the API (403 rateLimitExceeded or
+#    userRateLimitExceeded, 429) or, if they are idempotent, failing with a server error
+#    (5xx), after an exponential backoff with full jitter, and
+#  - bounds the number of requests in flight (from sharded listings, batches or
+#    AsyncCalendar) with an AIMD limit: it grows by about one request per round of
+#    successes and halves whenever the API throttles, so that concurrent callers settle on
+#    the most throughput the quota allows.
+# https://developers.google.com/calendar/api/guides/quota
+
+import json
+import random
+import threading
+import time
+
+# Requests per second allowed by the token bucket, None for no limit. The Calendar API's
+# default quota is about 10 requests per second per user.
+DEFAULT_RATE = None
+
+# Number of requests that may be sent at once after a quiet period.
+DEFAULT_BURST = 20
+
+# Maximum number of requests in flight at the same time. It caps every concurrent caller
+# (sharded listings, the calendar fan-out, AsyncCalendar, freebusy queries), whatever
+# number of workers it asks for, so set_scheduler takes a larger one for more of them.
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Number of times a throttled or failing request is retried.
+DEFAULT_MAX_RETRIES = 5
+
+# Seconds to wait before the first retry, doubled on every retry up to DEFAULT_MAX_DELAY.
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 32.0
+
+# The HTTP methods of the requests that may be sent again after a server error, which can
+# come after the request took effect. A POST (e.g. events.insert or events.watch) would
+# create a second event or channel.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'PATCH', 'DELETE')
+
+# The reasons of the 403 errors that mean the request was throttled rather than forbidden.
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def error_status(error):
+    """
+    Returns the HTTP status of a failed request, or None if it has none.
+    """
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return int(status) if status is not None else None
+
+
+def error_reason(error):
+    """
+    Returns the reason given by the API for a failed request (e.g. 'rateLimitExceeded'),
+    or None if it gave none.
+    """
+    content = getattr(error, 'content', None)
+    if not content:
+        return None
+    try:
+        details = json.loads(content.decode() if isinstance(content, bytes) else content)
+        return details['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def is_throttled(error):
+    """
+    Checks whether a request failed because it went over the quota.
+
+    :param error: The exception the request failed with
+    """
+    status = error_status(error)
+    return status == 429 or (status == 403 and error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error, idempotent=True):
+    """
+    Checks whether a failed request may succeed if it is sent again later, i.e. it was
+    throttled (and so not carried out), or it is idempotent and failed with a server error.
+
+    :param error: The exception the request failed with
+    :param idempotent: Whether sending the request twice has the same effect as once
+    """
+    status = error_status(error)
+    return is_throttled(error) or (idempotent and status is not None and 500 <= status < 600)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket holding up to capacity tokens and refilled at rate tokens
+    per second. Taking a token blocks until one is available.
+
+    :param rate: The number of tokens added per second
+    :param capacity: The maximum number of tokens, i.e. the largest burst
+    :param clock: The monotonic clock to use
+    :param sleep: The function to wait with
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0 or capacity < 1:
+            raise ValueError("Rate must be positive and capacity at least 1.")
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(capacity)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes tokens if they are available and returns whether it did.
+
+        :param tokens: The number of tokens to take
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """
+        Takes tokens, waiting until they are available. Requests larger than the capacity
+        take the whole bucket and leave it in debt.
+
+        :param tokens: The number of tokens to take
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(tokens, self.capacity)
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                wait = (needed - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+class AdaptiveLimit:
+    """
+    A limit on the number of requests in flight that follows additive increase and
+    multiplicative decrease: every success raises it by 1/limit (about one more request per
+    round of successes), every throttled request halves it.
+
+    :param maximum: The largest limit
+    :param minimum: The smallest limit
+    :param decrease: The factor the limit is multiplied by when a request is throttled
+    """
+
+    def __init__(self, maximum=DEFAULT_MAX_CONCURRENCY, minimum=1, decrease=0.5):
+        if minimum < 1 or maximum < minimum:
+            raise ValueError("Concurrency must be at least 1.")
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits until a request may be sent.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        """
+        Takes note that a request is done, and whether it was throttled.
+
+        :param throttled: Whether the API throttled the request
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def throttle(self):
+        """
+        Lowers the limit after requests were throttled outside of acquire and release,
+        e.g. inside a batch.
+        """
+        with self._condition:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class RequestScheduler:
+    """
+    Sends requests under a rate limit and an adaptive concurrency limit, retrying the ones
+    that are throttled or fail with a server error.
+
+    :param rate: The requests per second allowed, None for no limit
+    :param burst: The number of requests that may be sent at once after a quiet period
+    :param max_concurrency: The maximum number of requests in flight
+    :param max_retries: The number of times a request is retried
+    :param base_delay: Seconds to wait before the first retry
+    :param max_delay: The longest wait between two attempts
+    :param sleep: The function to wait with
+    :param jitter: A function returning a random number in [0, 1)
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 sleep=time.sleep, jitter=random.random):
+        if max_retries < 0:
+            raise ValueError("Number of retries must be at least 0.")
+        self.bucket = TokenBucket(rate, burst, sleep=sleep) if rate is not None else None
+        self.concurrency = AdaptiveLimit(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+        self._jitter = jitter
+        self.retries = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt):
+        """
+        Returns the seconds to wait before the given retry (0 for the first): a random
+        time up to base_delay * 2 ** attempt, capped at max_delay.
+
+        :param attempt: The number of retries already made
+        """
+        return self._jitter() * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+    def wait(self, attempt, throttled=False):
+        """
+        Waits before retrying requests that failed inside a response that succeeded, i.e.
+        the failed requests of a batch, lowering the concurrency limit if they were throttled.
+
+        :param attempt: The number of retries already made
+        :param throttled: Whether the requests were throttled
+        """
+        if throttled:
+            self.concurrency.throttle()
+        self._wait(attempt, throttled)
+
+    def _wait(self, attempt, throttled):
+        with self._lock:
+            self.retries += 1
+            if throttled:
+                self.throttled += 1
+        self._sleep(self.backoff(attempt))
+
+    def execute(self, send, cost=1, idempotent=True):
+        """
+        Sends a request and returns its response, retrying it if it is throttled or, if it
+        is idempotent, fails with a server error, and raising its last error if every
+        attempt fails.
+
+        :param send: A function sending the request and returning its response
+        :param cost: The number of requests it counts as against the rate limit, e.g. the
+        size of a batch
+        :param idempotent: Whether the request may be sent again after a server error
+        """
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire(cost)
+            self.concurrency.acquire()
+            throttled = False
+            try:
+                return send()
+            except Exception as error:
+                throttled = is_throttled(error)
+                if attempt >= self.max_retries or not is_retryable(error, idempotent):
+                    raise
+            finally:
+                self.concurrency.release(throttled)
+            self._wait(attempt, throttled)
+            attempt += 1
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Returns the scheduler shared by every request of the application, creating it with
+    the default settings on the first call.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def set_scheduler(scheduler):
+    """
+    Replaces the scheduler shared by every request of the application, e.g. to set a rate.
+
+    :param scheduler: The new RequestScheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
@@ -0,0 +1,155 @@
+# Keyword search for the Calendar application.
+# search_events pushes the keyword down to the API's full text search (the q parameter)
+# together with optional time bounds, instead of listing the whole calendar and scanning
+# it in Python. When the events are already available locally, a SearchIndex built over
+# them answers repeated searches without going through every event.
+
+import itertools
+import re
+
+import Calendar
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """
+    Splits a text into its lowercased word tokens.
+
+    :param text: The text to split, may be None
+    """
+    return _TOKEN.findall(text.lower()) if text else []
+
+
+def _searchable_text(event):
+    """
+    Returns the lowercased text of an event that keywords are matched against, which is
+    its summary and its description if it has one.
+    """
+    return (event.get('summary', '') + '\n' + event.get('description', '')).lower()
+
+
+class SearchIndex:
+    """
+    An inverted index from the word tokens of the events' summaries and descriptions to
+    the events containing them. A keyword is looked up by scanning the vocabulary (which
+    is much smaller than the number of events) for the tokens that contain it, so that
+    searching for part of a word works the same way as search_event does.
+    """
+
+    def __init__(self, events=()):
+        self._events = {}
+        self._postings = {}
+        for event in events:
+            self.add(event)
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, event):
+        """
+        Adds an event to the index, replacing any earlier version of it.
+
+        :param event: The event to add
+        """
+        self.remove(event['id'])
+        self._events[event['id']] = event
+        for token in set(tokenize(_searchable_text(event))):
+            self._postings.setdefault(token, set()).add(event['id'])
+
+    def remove(self, event_id):
+        """
+        Removes an event from the index if it is in it.
+
+        :param event_id: The id of the event to remove
+        """
+        event = self._events.pop(event_id, None)
+        if event is None:
+            return
+        for token in set(tokenize(_searchable_text(event))):
+            postings = self._postings.get(token)
+            postings.discard(event_id)
+            if not postings:
+                del self._postings[token]
+
+    def _candidates(self, word):
+        """
+        Returns the ids of the events having a token that contains the word.
+        """
+        ids = set()
+        for token, postings in self._postings.items():
+            if word in token:
+                ids |= postings
+        return ids
+
+    def search(self, keyword, time_min=None, time_max=None):
+        """
+        Returns the indexed events whose summary or description contains the keyword
+        (ignoring case), ordered by start time.
+
+        :param keyword: The keyword of the event that we want to search for
+        :param time_min: Optional RFC3339 lower bound (exclusive) for the event's end time
+        :param time_max: Optional RFC3339 upper bound (exclusive) for the event's start time
+        """
+        keyword = keyword.lower()
+        words = tokenize(keyword)
+        if words:
+            ids = None
+            for word in words:
+                candidates = self._candidates(word)
+                ids = candidates if ids is None else ids & candidates
+        else:
+            # The keyword has no word characters (e.g. '__' is a word, but '-' is not)
+            ids = self._events.keys()
+
+        results = []
+        lower = Calendar.get_event_timestamp(time_min) if time_min is not None else None
+        upper = Calendar.get_event_timestamp(time_max) if time_max is not None else None
+        for event_id in ids:
+            event = self._events[event_id]
+            # The candidates only share the words, the keyword itself must still be in the text
+            if keyword not in _searchable_text(event):
+                continue
+            if lower is not None and Calendar.get_event_timestamp(event['end']) <= lower:
+                continue
+            if upper is not None and Calendar.get_event_timestamp(event['start']) >= upper:
+                continue
+            results.append(event)
+        results.sort(key=lambda event: (Calendar.get_event_timestamp(event['start']), event['id']))
+        return results
+
+
+def search_events(api, keyword, time_min=None, time_max=None, max_results=None, index=None,
+                  calendar_id='primary', page_size=Calendar.DEFAULT_PAGE_SIZE):
+    """
+    Searches the calendar for events matching the keyword within optional time bounds.
+    If an index is given the search is answered locally, otherwise the keyword and the
+    bounds are sent to the API so that only the matching events are downloaded. Note that
+    the API matches whole words (and other fields such as the location), while the local
+    index matches any part of the summary or description.
+
+    :param api: API of the Google Calendar
+    :param keyword: The keyword of the event that we want to search for
+    :param time_min: Optional RFC3339 lower bound for the event's end time
+    :param time_max: Optional RFC3339 upper bound for the event's start time
+    :param max_results: The maximum number of events to return
+    :param index: An optional SearchIndex holding the events of the calendar
+    :param calendar_id: The calendar to search through
+    :param page_size: The number of events requested per page
+    """
+    if max_results is not None and max_results <= 0:
+        raise ValueError("Number of events must be at least 1.")
+
+    if index is not None:
+        return index.search(keyword, time_min, time_max)[:max_results]
+
+    bounds = {}
+    if time_min is not None:
+        bounds['timeMin'] = time_min
+    if time_max is not None:
+        bounds['timeMax'] = time_max
+    if max_results is not None:
+        page_size = min(page_size, max_results)
+    events = Calendar.iter_events(api, calendar_id=calendar_id, page_size=page_size, q=keyword,
+                                  singleEvents=True, orderBy='startTime', **bounds)
+    return list(itertools.islice(events, max_results))
@@ -3,9 +3,37 @@ import unittest
 from io import StringIO
 from unittest.mock import Mock, patch
 import Calendar
+import CalendarAnalytics
+import CalendarAsync
+import CalendarAvailability
+import CalendarBenchmark
+import CalendarCache
+import CalendarFakeServer
+import CalendarIndex
+import CalendarMetrics
+import CalendarPrefetch
+import CalendarRecurrence
+import CalendarReminders
+import CalendarScheduler
+import CalendarSearch
+import CalendarTransport
+import CalendarWatch
 
 # Add other imports here if needed
+import asyncio
 import datetime
+import itertools
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dateutil.relativedelta import relativedelta
 
 
@@ -477,7 +505,7 @@ class CalendarTest(unittest.TestCase):
         # Deletes the created event
         Calendar.delete_event_by_name(api, '__testing__')
 
-    @patch('Calendar.search_event')
+    @patch('Calendar.iter_search_event')
     def test_delete_event_by_name_mock(self, mock_delete_event_by_name_search):
         # When deleting events, the function search_event is called to look for the event
         # to be deleted, we mock the return of the search_event to be a sample return
@@ -561,6 +589,1426 @@ class CalendarTest(unittest.TestCase):
 
         Calendar.delete_event_by_name(api, '__test1__')
 
+    def test_iter_events_paging_mock(self):
+        # Three pages of results, linked together with nextPageToken
+        pages = [{'items': [{'id': '1', 'summary': 'john'}, {'id': '2', 'summary': 'test'}], 'nextPageToken': 'a'},
+                 {'items': [{'id': '3', 'summary': 'johnny'}], 'nextPageToken': 'b'},
+                 {'items': [{'id': '4', 'summary': 'test'}]}]
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.side_effect = pages
+
+        # Every page is followed and the events are yielded in order
+        events = list(Calendar.iter_events(mock_api, page_size=2))
+        self.assertEqual([event['id'] for event in events], ['1', '2', '3', '4'])
+        list_calls = mock_api.events.return_value.list.call_args_list
+        self.assertEqual(len(list_calls), 3)
+        self.assertEqual(list_calls[0][1]['maxResults'], 2)
+        self.assertNotIn('pageToken', list_calls[0][1])
+        self.assertEqual(list_calls[2][1]['pageToken'], 'b')
+
+        # Stopping early does not request the remaining pages
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.side_effect = pages
+        events = Calendar.iter_upcoming_events(mock_api, "2020-08-03T00:00:00.000000Z", 2)
+        self.assertEqual(len(list(events)), 2)
+        self.assertEqual(mock_api.events.return_value.list.return_value.execute.call_count, 1)
+
+        # The search variant filters over every page
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.side_effect = pages
+        self.assertEqual([event['id'] for event in Calendar.iter_search_event(mock_api, 'JOHN')], ['1', '3'])
+
+        # The window checks of the list functions are kept
+        with self.assertRaises(ValueError):
+            Calendar.iter_year_past_events(Mock(), "2020-08-03T00:00:00.000000Z", 4)
+        with self.assertRaises(ValueError):
+            Calendar.iter_year_future_events(Mock(), "2020-08-03T00:00:00.000000Z", 1)
+        with self.assertRaises(ValueError):
+            Calendar.iter_specific_time_events(Mock(), 2020, 13)
+        with self.assertRaises(ValueError):
+            Calendar.iter_events(Mock(), page_size=0)
+
+    def test_event_store_sync_mock(self):
+        store = CalendarCache.EventStore(':memory:', sync_interval=0)
+        first_sync = [{'items': [{'id': '1', 'summary': 'John', 'start': {'dateTime': '2020-07-15T08:00:00+08:00'},
+                                  'end': {'dateTime': '2020-07-15T09:00:00+08:00'}}], 'nextPageToken': 'a'},
+                      {'items': [{'id': '2', 'summary': 'test', 'start': {'date': '2021-01-01'},
+                                  'end': {'date': '2021-01-02'}}], 'nextSyncToken': 'sync1'}]
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.side_effect = first_sync
+
+        # The first query downloads every event and stores the sync token
+        self.assertEqual(len(Calendar.get_specific_time_events(mock_api, 2020, store=store)), 1)
+        self.assertEqual(store.get_sync_token(), 'sync1')
+        self.assertNotIn('syncToken', mock_api.events.return_value.list.call_args_list[0][1])
+
+        # The next query only asks for the changes since the last sync, here the deletion of event 1
+        mock_api.events.return_value.list.return_value.execute.side_effect = [
+            {'items': [{'id': '1', 'status': 'cancelled'}], 'nextSyncToken': 'sync2'},
+            {'items': [], 'nextSyncToken': 'sync3'}]
+        self.assertEqual(Calendar.get_specific_time_events(mock_api, 2020, store=store), [])
+        self.assertEqual(mock_api.events.return_value.list.call_args_list[-1][1]['syncToken'], 'sync1')
+        self.assertEqual([event['id'] for event in Calendar.search_event(mock_api, 'TEST', store=store)], ['2'])
+
+        # An expired sync token (410 Gone) falls back to a full sync
+        gone = Exception('Gone')
+        gone.resp = Mock(status=410)
+        mock_api.events.return_value.list.return_value.execute.side_effect = [gone] + first_sync
+        store.sync(mock_api)
+        self.assertEqual(len(store.query()), 2)
+        self.assertEqual(store.get_sync_token(), 'sync1')
+
+        # While the store is fresh, queries do not contact the API
+        store.sync_interval = 60
+        mock_api = Mock()
+        self.assertEqual(len(Calendar.get_specific_time_events(mock_api, 2020, 7, 15, store=store)), 1)
+        self.assertEqual(mock_api.events.return_value.list.return_value.execute.call_count, 0)
+        store.close()
+
+    def test_search_events_mock(self):
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.return_value = {'items': [{'id': '1'}]}
+
+        # The keyword and the time bounds are sent to the API
+        self.assertEqual(CalendarSearch.search_events(mock_api, 'john', time_min="2020-01-01T00:00:00Z",
+                                                      max_results=5), [{'id': '1'}])
+        args, kwargs = mock_api.events.return_value.list.call_args_list[0]
+        self.assertEqual(kwargs['q'], 'john')
+        self.assertEqual(kwargs['timeMin'], "2020-01-01T00:00:00Z")
+        self.assertEqual(kwargs['maxResults'], 5)
+        self.assertNotIn('timeMax', kwargs)
+
+        # Summaries are matched regardless of their case as well
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.return_value.get.return_value = [
+            {'id': '1', 'summary': 'John'}]
+        self.assertEqual(len(Calendar.search_event(mock_api, 'jOHN')), 1)
+
+    def test_search_index(self):
+        events = [{'id': '1', 'summary': 'Meeting with John', 'start': {'dateTime': '2020-07-15T08:00:00+08:00'},
+                   'end': {'dateTime': '2020-07-15T09:00:00+08:00'}},
+                  {'id': '2', 'summary': '__testing__', 'description': 'ask JOHNNY', 'start': {'date': '2020-01-01'},
+                   'end': {'date': '2020-01-02'}},
+                  {'id': '3', 'summary': 'testing', 'start': {'date': '2021-01-01'}, 'end': {'date': '2021-01-02'}}]
+        index = CalendarSearch.SearchIndex(events)
+
+        # Parts of words, descriptions and any case are matched, ordered by start time
+        self.assertEqual([event['id'] for event in index.search('john')], ['2', '1'])
+        self.assertEqual([event['id'] for event in index.search('STING')], ['2', '3'])
+        self.assertEqual([event['id'] for event in index.search('with john')], ['1'])
+        self.assertEqual(index.search('john with'), [])
+        self.assertEqual([event['id'] for event in index.search('__')], ['2'])
+
+        # Time bounds are applied
+        self.assertEqual([event['id'] for event in index.search('testing', time_min="2020-06-01T00:00:00Z")], ['3'])
+
+        # Removed events are no longer found, and the index answers search_events without the API
+        index.remove('2')
+        mock_api = Mock()
+        self.assertEqual([event['id'] for event in CalendarSearch.search_events(mock_api, 'john', index=index)], ['1'])
+        self.assertEqual(mock_api.events.return_value.list.call_count, 0)
+
+    def test_execute_batch_mock(self):
+        # A stand-in for the client's batch requests. Every request is a (key, failures) pair,
+        # and fails with the given statuses before succeeding
+        batches = []
+
+        class FakeRequest(tuple):
+            method = 'GET'
+
+        class FakeInsert(FakeRequest):
+            method = 'POST'
+
+        class FakeBatch:
+            def __init__(self, callback):
+                self.callback = callback
+                self.requests = []
+                batches.append(self)
+
+            def add(self, request, request_id):
+                self.requests.append((request_id, request))
+
+            def execute(self):
+                for request_id, (key, failures) in self.requests:
+                    if failures:
+                        error = Exception('HTTP error')
+                        error.resp = Mock(status=failures.pop(0))
+                        self.callback(request_id, None, error)
+                    else:
+                        self.callback(request_id, {'id': key}, None)
+
+        mock_api = Mock()
+        mock_api.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback)
+        failures = {'3': [503], '4': [404], '60': [429, 429, 429]}
+
+        def make_request(eventId):
+            return FakeRequest((eventId, failures.get(eventId, [])))
+
+        operations = [(str(i), make_request, {'eventId': str(i)}) for i in range(100)]
+        results, errors = Calendar.execute_batch(mock_api, operations)
+
+        # The requests are sent 50 at a time, and only the ones that failed with a retryable
+        # status are sent again
+        self.assertEqual([len(batch.requests) for batch in batches], [50, 50, 2, 1])
+        self.assertEqual(len(results), 98)
+        self.assertEqual(sorted(errors), ['4', '60'])
+        self.assertEqual(errors['4'].resp.status, 404)
+
+        # An insert may have taken effect before a server error, so it is only sent again
+        # when it was throttled
+        del batches[:]
+        failures.update({'i1': [503], 'i2': [429]})
+        operations = [(key, lambda eventId: FakeInsert((eventId, failures.get(eventId, []))), {'eventId': key})
+                      for key in ('i1', 'i2')]
+        results, errors = Calendar.execute_batch(mock_api, operations)
+        self.assertEqual([len(batch.requests) for batch in batches], [2, 1])
+        self.assertEqual(sorted(results), ['i2'])
+        self.assertEqual(errors['i1'].resp.status, 503)
+
+        with self.assertRaises(ValueError):
+            Calendar.execute_batch(mock_api, operations, batch_size=51)
+
+    @patch('Calendar.iter_search_event')
+    def test_bulk_delete_mock(self, mock_search_event):
+        mock_search_event.return_value = [
+            {'id': '1', 'summary': 'testing', 'reminders': {'useDefault': False, 'overrides': [
+                {'method': 'popup', 'minutes': 20}, {'method': 'popup', 'minutes': 30}]}},
+            {'id': '2', 'summary': 'testing', 'reminders': {'useDefault': True}},
+            {'id': '3', 'summary': 'testing', 'reminders': {'useDefault': False, 'overrides': [
+                {'method': 'popup', 'minutes': 30}]}}]
+        mock_api = Mock()
+        mock_batch = mock_api.new_batch_http_request.return_value
+        mock_batch.execute.side_effect = lambda: [
+            mock_api.new_batch_http_request.call_args[1]['callback'](call[1]['request_id'], {}, None)
+            for call in mock_batch.add.call_args_list]
+
+        # Every matching event is deleted in a single batch
+        results, errors = Calendar.delete_events_by_name(mock_api, 'testing')
+        self.assertEqual(sorted(results), ['1', '2', '3'])
+        self.assertEqual(errors, {})
+        self.assertEqual(mock_batch.execute.call_count, 1)
+
+        # Events without the reminder are reported instead of stopping the other updates
+        mock_batch.add.reset_mock()
+        results, errors = Calendar.delete_events_reminder(mock_api, 'testing', 20)
+        self.assertEqual(sorted(results), ['1', '2'])
+        self.assertIsInstance(errors['3'], ProcessLookupError)
+        updated = mock_api.events.return_value.patch.call_args_list[0][1]['body']
+        self.assertEqual(updated, {'reminders': {'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 30}]}})
+
+        mock_search_event.return_value = []
+        with self.assertRaises(ProcessLookupError):
+            Calendar.delete_events_by_name(mock_api, 'testing')
+
+    def test_bulk_delete_every_page(self):
+        # The matching events are spread over many pages of the calendar
+        calendar = CalendarFakeServer.FakeCalendar.generate(2000, '2020-01-01T00:00:00Z', '2021-01-01T00:00:00Z',
+                                                            seed=14, recurring=0)
+        with CalendarFakeServer.FakeCalendarServer(calendar) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            dentist = [event['id'] for event in Calendar.iter_search_event(api, 'dentist')]
+            self.assertGreater(len(dentist), 2 * len(Calendar.search_event(api, 'dentist')))
+            results, errors = Calendar.delete_events_by_name(api, 'DENTIST')
+            self.assertEqual(sorted(results), sorted(dentist))
+            self.assertEqual(errors, {})
+            self.assertEqual(list(Calendar.iter_search_event(api, 'dentist')), [])
+
+            retro = list(Calendar.iter_search_event(api, 'retro'))
+            results, errors = Calendar.delete_events_reminder(api, 'retro')
+            self.assertEqual(len(results) + len(errors), len(retro))
+            self.assertTrue(all(not event['reminders'].get('overrides')
+                                for event in Calendar.iter_search_event(api, 'retro')))
+
+            # The single event variants reach the events beyond the first page as well, and
+            # the index counts them like the search listing does
+            gym = [event['id'] for event in Calendar.iter_search_event(api, 'gym')]
+            self.assertGreater(len(gym), 2 * len(Calendar.search_event(api, 'gym')))
+            Calendar.delete_event_reminder(api, 'gym', len(gym) - 1)
+            reminders = Calendar.get_event_details(api, gym[-1], fields=None)['reminders']
+            self.assertFalse(reminders['useDefault'] or reminders.get('overrides'))
+            Calendar.delete_event_by_name(api, 'gym')
+            self.assertEqual(list(Calendar.iter_search_event(api, 'gym')), [])
+
+    @patch('Calendar._load_credentials')
+    @patch('googleapiclient.discovery.build')
+    def test_get_calendar_api_cached_mock(self, mock_build, mock_load_credentials):
+        # The API object is only built once and uses the bundled discovery document
+        api = Calendar.get_calendar_api(rebuild=True)
+        self.assertIs(Calendar.get_calendar_api(), api)
+        self.assertEqual(mock_build.call_count, 1)
+        self.assertEqual(mock_load_credentials.call_count, 1)
+        self.assertTrue(mock_build.call_args[1]['static_discovery'])
+
+        # Until it is explicitly rebuilt
+        api = Calendar.get_calendar_api(rebuild=True)
+        self.assertEqual(mock_build.call_count, 2)
+
+        # An object built on a transport is the caller's own, the shared one is kept
+        mock_build.side_effect = lambda *args, **kwargs: Mock()
+        transport = Mock()
+        pooled = Calendar.get_calendar_api(transport=transport)
+        self.assertIsNot(pooled, api)
+        self.assertIs(mock_build.call_args[1]['http'], transport)
+        self.assertIs(Calendar.get_calendar_api(), api)
+        self.assertEqual(mock_build.call_count, 3)
+        Calendar._calendar_api = None
+
+    def test_connection_pool(self):
+        # A local stand-in for the API that records which client connections it is sent requests on
+        client_ports = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                client_ports.append(self.client_address[1])
+                body = json.dumps({'items': [{'id': '1', 'summary': 'test'}]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = CalendarTransport.ConnectionPool(size=2, timeout=5)
+        api = CalendarTransport.build_api(pool, 'http://127.0.0.1:' + str(server.server_address[1]) + '/calendar/v3/')
+
+        # Many requests from many threads share the open connections of the pool
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(
+                lambda i: Calendar.get_upcoming_events(api, "2020-08-03T00:00:00.000000Z", 1), range(20)))
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+        self.assertEqual(results, [[{'id': '1', 'summary': 'test'}]] * 20)
+        self.assertEqual(len(client_ports), 20)
+        self.assertLessEqual(pool.created, 2)
+        self.assertLessEqual(len(set(client_ports)), 2)
+
+        with self.assertRaises(ValueError):
+            CalendarTransport.ConnectionPool(size=0)
+
+    def test_async_calendar_mock(self):
+        # Every list call takes a while, and the number of calls running at once is recorded
+        running = [0]
+        most_running = []
+        lock = threading.Lock()
+
+        def execute():
+            with lock:
+                running[0] += 1
+                most_running.append(running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return {'items': [{'id': '1', 'summary': 'test'}]}
+
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.side_effect = execute
+        calendar = CalendarAsync.AsyncCalendar(mock_api, max_concurrency=3)
+
+        async def dashboard():
+            return await asyncio.gather(*[calendar.get_specific_time_events(2020, month) for month in range(1, 10)],
+                                        calendar.search_event('TEST'))
+
+        results = asyncio.run(dashboard())
+
+        # Every query is answered, with at most 3 of them running at the same time
+        self.assertEqual(len(results), 10)
+        self.assertEqual(results[-1], [{'id': '1', 'summary': 'test'}])
+        self.assertLessEqual(max(most_running), 3)
+        self.assertGreater(max(most_running), 1)
+
+        # The calendar can be used again from another event loop
+        del most_running[:]
+        self.assertEqual(len(asyncio.run(dashboard())), 10)
+        self.assertLessEqual(max(most_running), 3)
+        calendar.close()
+
+        # Errors are raised from the coroutines
+        calendar = CalendarAsync.AsyncCalendar(Mock())
+        with self.assertRaises(ValueError):
+            asyncio.run(calendar.get_year_past_events("2020-08-03T00:00:00.000000Z", 1))
+        calendar.close()
+
+    def test_iter_events_sharded_mock(self):
+        # Synthetic calendar: an event every 10 days, and one that spans two months
+        start = datetime.datetime(2014, 1, 1)
+        events = [{'id': str(i), 'start': {'dateTime': (start + relativedelta(days=+10 * i)).isoformat() + 'Z'},
+                   'end': {'dateTime': (start + relativedelta(days=+10 * i, hours=+1)).isoformat() + 'Z'}}
+                  for i in range(150)]
+        events.append({'id': 'long', 'start': {'dateTime': '2014-03-31T12:00:00Z'},
+                       'end': {'dateTime': '2014-05-02T12:00:00Z'}})
+        events.sort(key=lambda event: Calendar.get_event_timestamp(event['start']))
+
+        def list_events(**kwargs):
+            # Answers a list call like the API, with the events overlapping the window
+            lower = Calendar.get_event_timestamp(kwargs['timeMin'])
+            upper = Calendar.get_event_timestamp(kwargs['timeMax'])
+            items = [event for event in events if Calendar.get_event_timestamp(event['end']) > lower and
+                     Calendar.get_event_timestamp(event['start']) < upper]
+            return Mock(execute=Mock(return_value={'items': items}))
+
+        mock_api = Mock()
+        mock_api.events.return_value.list.side_effect = list_events
+        time_now = "2018-02-01T00:00:00.000000Z"
+        expected = [event['id'] for event in events
+                    if Calendar.get_event_timestamp(event['end']) > Calendar.get_event_timestamp("2013-02-01T00:00:00Z")]
+
+        # The shards together give every event of the window once, in start time order
+        for shard in ('month', 'quarter'):
+            sharded = Calendar.iter_year_past_events(mock_api, time_now, 5, shard=shard, workers=3)
+            self.assertEqual([event['id'] for event in sharded], expected)
+
+        # Each shard is a separate list call
+        mock_api.events.return_value.list.reset_mock()
+        self.assertEqual(len(list(Calendar.iter_year_future_events(mock_api, time_now, 2, shard='quarter'))), 0)
+        self.assertEqual(mock_api.events.return_value.list.call_count, 8)
+
+        with self.assertRaises(ValueError):
+            Calendar.iter_year_past_events(mock_api, time_now, 5, shard='week')
+        with self.assertRaises(ValueError):
+            Calendar.iter_year_past_events(mock_api, time_now, 5, shard='month', workers=0)
+
+    def test_iter_calendars_events_mock(self):
+        # Three calendars with events on interleaved days, two per page
+        def make_event(calendar_id, day):
+            return {'id': calendar_id + str(day), 'summary': 'standup' if day % 2 else 'review',
+                    'start': {'dateTime': '2020-07-%02dT09:00:00Z' % day}, 'end': {'dateTime': '2020-07-%02dT10:00:00Z' % day}}
+
+        calendars = {'a': [1, 4, 7, 10], 'b': [2, 5, 8], 'c': [3, 6, 9, 11, 12]}
+
+        def list_events(calendarId, maxResults, pageToken=None, **kwargs):
+            position = int(pageToken or 0)
+            days = calendars[calendarId][position:position + maxResults]
+            page = {'items': [make_event(calendarId, day) for day in days]}
+            if position + maxResults < len(calendars[calendarId]):
+                page['nextPageToken'] = str(position + maxResults)
+            return Mock(execute=Mock(return_value=page))
+
+        mock_api = Mock()
+        mock_api.events.return_value.list.side_effect = list_events
+
+        # The calendars are merged into one stream ordered by start time
+        merged = list(Calendar.iter_specific_time_events(mock_api, 2020, 7, page_size=2, calendar_ids=['a', 'b', 'c']))
+        self.assertEqual([event['id'] for calendar_id, event in merged],
+                         ['a1', 'b2', 'c3', 'a4', 'b5', 'c6', 'a7', 'b8', 'c9', 'a10', 'c11', 'c12'])
+        self.assertEqual(merged[0][0], 'a')
+
+        # Each calendar can be limited, and searches apply the limit to the matching events
+        limited = Calendar.iter_specific_time_events(mock_api, 2020, 7, page_size=2, calendar_ids=['a', 'c'],
+                                                     per_calendar_limit=2)
+        self.assertEqual([event['id'] for calendar_id, event in limited], ['a1', 'c3', 'a4', 'c6'])
+        found = Calendar.iter_search_event(mock_api, 'STANDUP', page_size=2, calendar_ids=['a', 'b', 'c'],
+                                           per_calendar_limit=1)
+        self.assertEqual([event['id'] for calendar_id, event in found], ['a1', 'c3', 'b5'])
+
+        # Stopping early is possible, and errors of a calendar are raised to the caller
+        self.assertEqual(len(list(itertools.islice(Calendar.iter_year_future_events(
+            mock_api, "2020-08-03T00:00:00.000000Z", 2, page_size=1, calendar_ids=['a', 'b', 'c']), 2))), 2)
+        with self.assertRaises(KeyError):
+            list(Calendar.iter_specific_time_events(mock_api, 2020, calendar_ids=['a', 'unknown']))
+        with self.assertRaises(ValueError):
+            Calendar.iter_year_past_events(mock_api, "2020-08-03T00:00:00.000000Z", 5, shard='month',
+                                           calendar_ids=['a'])
+
+    def test_field_projection_mock(self):
+        listed = {'id': '1', 'summary': '__testing__', 'start': {'date': '2100-07-15'}, 'end': {'date': '2100-07-16'},
+                  'reminders': {'useDefault': True}}
+        details = dict(listed, kind='calendar#event', status='confirmed', htmlLink='link', created='2020',
+                       updated='2020', creator={'email': 'me'}, organizer={'email': 'me'})
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.return_value.get.return_value = [listed]
+        mock_api.events.return_value.get.return_value.execute.return_value = details
+
+        # The listing only asks for the fields it shows, and the details are fetched when an event is picked
+        old_stdout = sys.stdout
+        suppress_text = StringIO()
+        sys.stdout = suppress_text
+        sys.stdin = StringIO("1\n2100\n1\n4")
+        Calendar.navigate_calendar(mock_api)
+        sys.stdin = sys.__stdin__
+        sys.stdout = old_stdout
+
+        self.assertEqual(mock_api.events.return_value.list.call_args[1]['fields'], Calendar.LIST_FIELDS)
+        args, kwargs = mock_api.events.return_value.get.call_args
+        self.assertEqual((kwargs['eventId'], kwargs['fields']), ('1', Calendar.DETAIL_FIELDS))
+        self.assertIn("Summary: __testing__\nCreator: me", suppress_text.getvalue())
+        self.assertIn("Start: 2100-07-15", suppress_text.getvalue())
+
+    @patch('Calendar.iter_search_event')
+    def test_delete_event_reminder_mock(self, mock_search_event):
+        mock_search_event.return_value = [{'id': '1', 'summary': 'testing', 'reminders': {
+            'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 20}, {'method': 'email', 'minutes': 30}]}}]
+        mock_api = Mock()
+
+        # Only the remaining reminders are sent
+        self.assertTrue(Calendar.delete_event_reminder(mock_api, 'testing', 0, 20))
+        args, kwargs = mock_api.events.return_value.patch.call_args
+        self.assertEqual(kwargs['body'], {'reminders': {'useDefault': False,
+                                                        'overrides': [{'method': 'email', 'minutes': 30}]}})
+        self.assertEqual(kwargs['eventId'], '1')
+
+    def test_event_model(self):
+        timed = {'id': '1', 'summary': 'john', 'start': {'dateTime': '2020-10-08T10:00:00+08:00'},
+                 'end': {'dateTime': '2020-10-08T10:30:00+08:00'},
+                 'reminders': {'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 10}]}}
+        all_day = {'id': '2', 'summary': 'john', 'start': {'date': '2020-10-07'}, 'end': {'date': '2020-10-08'},
+                   'reminders': {'useDefault': True}}
+        events = Calendar.to_events([timed, all_day])
+
+        # Times are stored as timestamps and shown the way the API gives them
+        self.assertEqual(events[0].start, 1602122400)
+        self.assertEqual(events[0].duration, 30 * 60)
+        self.assertEqual(events[0].start_text, '2020-10-08T10:00:00+08:00')
+        self.assertEqual(events[1].start_text, '2020-10-07')
+        self.assertEqual(events[1].end_text, '2020-10-08')
+        self.assertEqual(events[0].reminders, ((10, 'popup'),))
+        self.assertTrue(events[1].default_reminders)
+
+        # Events are compact: no per-instance dict, shared summaries and no raw payload unless asked for
+        self.assertFalse(hasattr(events[0], '__dict__'))
+        self.assertIs(events[0].summary, events[1].summary)
+        self.assertIsNone(events[0].raw)
+        self.assertIs(Calendar.Event.from_dict(timed, keep_raw=True).raw, timed)
+        self.assertEqual([event.id for event in sorted(events, key=lambda event: event.start)], ['2', '1'])
+
+        # The query functions can return them instead of dicts
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.return_value.get.return_value = [timed]
+        events = Calendar.get_specific_time_events(mock_api, 2020, 10, as_events=True)
+        self.assertIsInstance(events[0], Calendar.Event)
+
+    def test_event_table(self):
+        def make_event(event_id, start, end, minutes=()):
+            return {'id': event_id, 'summary': 'test', 'start': {'dateTime': start}, 'end': {'dateTime': end},
+                    'reminders': {'useDefault': not minutes,
+                                  'overrides': [{'method': 'popup', 'minutes': m} for m in minutes]}}
+
+        # Monday 2020-08-03: 9-11 and 10-12 overlap, then an event from 23:00 to 01:00 the next day
+        table = CalendarAnalytics.EventTable.from_events(iter([
+            make_event('a', '2020-08-03T09:00:00Z', '2020-08-03T11:00:00Z', (10, 30)),
+            make_event('b', '2020-08-03T10:00:00Z', '2020-08-03T12:00:00Z'),
+            make_event('c', '2020-08-03T23:00:00Z', '2020-08-04T01:00:00Z', (5,)),
+            make_event('d', '2020-08-10T09:00:00+08:00', '2020-08-10T10:00:00+08:00')]))
+
+        self.assertEqual(len(table), 4)
+        self.assertEqual(list(table.duration), [7200, 7200, 7200, 3600])
+        self.assertEqual(str(table.start[3]), '2020-08-10T01:00:00')
+
+        # Overlapping events are counted once, and events past midnight are split between the days
+        days, hours = table.busy_hours()
+        self.assertEqual([str(day) for day in days], ['2020-08-03', '2020-08-04', '2020-08-10'])
+        self.assertEqual(list(hours), [4.0, 1.0, 1.0])
+        weeks, hours = table.busy_hours('week')
+        self.assertEqual([str(week) for week in weeks], ['2020-08-03', '2020-08-10'])
+        self.assertEqual(list(hours), [5.0, 1.0])
+
+        self.assertEqual(table.overlaps().tolist(), [[0, 1]])
+
+        stats = table.reminder_stats()
+        self.assertEqual((stats['events_with_reminders'], stats['events_with_default_reminders']), (2, 2))
+        self.assertEqual((stats['reminders'], stats['min_minutes'], stats['max_minutes']), (3, 5, 30))
+        self.assertEqual(list(table.reminder_minutes[table.reminder_offsets[0]:table.reminder_offsets[1]]), [10, 30])
+
+        with self.assertRaises(ValueError):
+            table.busy_hours('month')
+        empty = CalendarAnalytics.EventTable.from_events([])
+        self.assertEqual(len(empty.busy_hours()[0]), 0)
+        self.assertEqual(empty.overlaps().shape[0], 0)
+
+    def test_interval_index(self):
+        # Random events over 2020, some of them lasting for weeks
+        rng = random.Random(4)
+        start = datetime.datetime(2020, 1, 1)
+        events = []
+        for i in range(300):
+            event_start = start + relativedelta(hours=+rng.randrange(24 * 365))
+            event_end = event_start + relativedelta(hours=+rng.choice([1, 2, 24, 24 * 20]))
+            events.append({'id': str(i), 'summary': 'test', 'start': {'dateTime': event_start.isoformat() + 'Z'},
+                           'end': {'dateTime': event_end.isoformat() + 'Z'}, 'reminders': {'useDefault': True}})
+        index = CalendarIndex.IntervalIndex(events, "2020-01-01T00:00:00Z", "2021-01-01T00:00:00Z")
+
+        # Every window gives the same events as scanning all of them
+        def scan(time_min, time_max):
+            lower = Calendar.get_event_timestamp(time_min)
+            upper = Calendar.get_event_timestamp(time_max)
+            found = [event for event in events if Calendar.get_event_timestamp(event['end']) > lower and
+                     Calendar.get_event_timestamp(event['start']) < upper]
+            return sorted(event['id'] for event in found)
+
+        for month in range(1, 13):
+            window = Calendar.get_specific_time_window(2020, month)
+            found = index.query(*window)
+            self.assertEqual(sorted(event['id'] for event in found), scan(*window))
+            starts = [Calendar.get_event_timestamp(event['start']) for event in found]
+            self.assertEqual(starts, sorted(starts))
+        self.assertEqual(sorted(event['id'] for event in index.query_date(2020, 3, 14)),
+                         scan(*Calendar.get_specific_time_window(2020, 3, 14)))
+
+        self.assertTrue(index.covers(*Calendar.get_specific_time_window(2020, 7)))
+        self.assertFalse(index.covers(*Calendar.get_specific_time_window(2021, 1)))
+
+        # navigate_calendar answers the windows covered by the index without the API
+        mock_api = Mock()
+        old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        sys.stdin = StringIO("3\n2020\n3\n14\n0\n4")
+        Calendar.navigate_calendar(mock_api, index=index)
+        sys.stdin = sys.__stdin__
+        sys.stdout = old_stdout
+        self.assertEqual(mock_api.events.return_value.list.call_count, 0)
+
+        # including an index of compact Event objects, whose details are fetched by id
+        index = CalendarIndex.IntervalIndex([Calendar.Event.from_dict(event) for event in events],
+                                            "2020-01-01T00:00:00Z", "2021-01-01T00:00:00Z")
+        shown = index.query_date(2020, 3, 14)[0]
+        mock_api.events.return_value.get.return_value.execute.return_value = {
+            'kind': 'calendar#event', 'id': shown.id, 'status': 'confirmed', 'htmlLink': 'https://example.com',
+            'created': '2020-01-01T00:00:00Z', 'updated': '2020-01-01T00:00:00Z', 'summary': 'test',
+            'creator': {'email': 'owner@example.com'}, 'organizer': {'email': 'owner@example.com'},
+            'start': {'dateTime': '2020-03-14T10:00:00Z'}, 'end': {'dateTime': '2020-03-14T11:00:00Z'}}
+        sys.stdout = StringIO()
+        sys.stdin = StringIO("3\n2020\n3\n14\n1\n4")
+        Calendar.navigate_calendar(mock_api, index=index)
+        output = sys.stdout.getvalue()
+        sys.stdin = sys.__stdin__
+        sys.stdout = old_stdout
+        self.assertEqual(mock_api.events.return_value.get.call_args[1]['eventId'], shown.id)
+        self.assertIn("Id: " + shown.id, output)
+        self.assertEqual(mock_api.events.return_value.list.call_count, 0)
+
+        # Without an index, navigate_calendar indexes the year it fetched, and drilling down
+        # to a month and a day of it fetches nothing more
+        calendar = CalendarFakeServer.FakeCalendar.generate(400, '2020-01-01T00:00:00Z', '2021-01-01T00:00:00Z',
+                                                            seed=21)
+        with CalendarFakeServer.FakeCalendarServer(calendar) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            lists = server.calls['list']
+            Calendar.get_specific_time_events(api, 2020)
+            year_lists = server.calls['list'] - lists
+            day = Calendar.get_specific_time_events(api, 2020, 3)[0]['start']
+            day = int(day.get('dateTime', day.get('date'))[8:10])
+            expected = StringIO()
+            Calendar.print_events(Calendar.get_specific_time_events(api, 2020, 3, day), numbered=True,
+                                  stream=expected)
+            sys.stdout = StringIO()
+            sys.stdin = StringIO("1\n2020\n0\n2\n2020\n3\n0\n3\n2020\n3\n{}\n0\n4".format(day))
+            lists = server.calls['list']
+            Calendar.navigate_calendar(api)
+            output = sys.stdout.getvalue()
+            sys.stdin = sys.__stdin__
+            sys.stdout = old_stdout
+            self.assertEqual(server.calls['list'] - lists, year_lists)
+            self.assertIn(expected.getvalue(), output)
+
+    def test_format_events(self):
+        events = [{'id': '1', 'summary': 'john, again', 'start': {'dateTime': '2020-10-08T10:00:00+08:00'},
+                   'end': {'dateTime': '2020-10-08T10:30:00+08:00'}, 'reminders': {'useDefault': False, 'overrides': [
+                       {'method': 'popup', 'minutes': 10}, {'method': 'email', 'minutes': 50}]}},
+                  {'id': '2', 'summary': 'test', 'start': {'date': '2020-10-09'}, 'end': {'date': '2020-10-10'},
+                   'reminders': {'useDefault': True}}]
+
+        # The text listing is the one printed by main and navigate_calendar
+        self.assertEqual(Calendar.format_events(events, numbered=True),
+                         "1 : 2020-10-08T10:00:00+08:00 john, again | Reminders ->  {Time: 10 minutes before, "
+                         "Method: popup}{Time: 50 minutes before, Method: email}\n"
+                         "2 : 2020-10-09 test | Reminders ->  {Time: 10 minutes before, Method: pop-up}\n")
+        self.assertEqual(Calendar.format_events([]), "No events found.\n")
+        # Event objects are listed the same way
+        self.assertEqual(Calendar.format_events(Calendar.to_events(events)), Calendar.format_events(events))
+
+        # Machine readable formats
+        lines = Calendar.format_events(iter(events), 'jsonl').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], events)
+        self.assertEqual(Calendar.format_events(events, 'csv').splitlines(),
+                         ['id,start,end,summary,reminders,default_reminders',
+                          '1,2020-10-08T10:00:00+08:00,2020-10-08T10:30:00+08:00,"john, again",10:popup;50:email,False',
+                          '2,2020-10-09,2020-10-10,test,,True'])
+
+        # Large listings are written in a few large chunks
+        stream = Mock()
+        Calendar.print_events(events * 5000, stream=stream)
+        self.assertEqual(stream.write.call_count, 3)
+
+        with self.assertRaises(ValueError):
+            Calendar.print_events(events, 'xml')
+
+    def test_main_cli_mock(self):
+        events = [{'id': '1', 'summary': 'john', 'start': {'dateTime': '2020-10-08T10:00:00+08:00'},
+                   'end': {'dateTime': '2020-10-08T10:30:00+08:00'}},
+                  {'id': '2', 'summary': 'test', 'start': {'date': '2020-10-09'}, 'end': {'date': '2020-10-10'}}]
+        mock_api = Mock()
+        mock_api.events.return_value.list.return_value.execute.return_value = {'items': events}
+
+        with patch('Calendar.get_calendar_api', return_value=mock_api) as get_api:
+            # The help is printed without building the API
+            with patch('sys.stdout', new=StringIO()) as output, self.assertRaises(SystemExit):
+                Calendar.main(['--help'])
+            self.assertIn('delete-reminder', output.getvalue())
+            get_api.assert_not_called()
+
+            with patch('sys.stdout', new=StringIO()) as output:
+                self.assertEqual(Calendar.main(['--format', 'jsonl', 'date', '2020', '10']), 0)
+            self.assertEqual([json.loads(line) for line in output.getvalue().splitlines()], events)
+            list_kwargs = mock_api.events.return_value.list.call_args[1]
+            self.assertEqual((list_kwargs['timeMin'], list_kwargs['timeMax']),
+                             Calendar.get_specific_time_window(2020, 10))
+
+            with patch('sys.stdout', new=StringIO()) as output:
+                self.assertEqual(Calendar.main(['--format', 'csv', 'search', 'OH']), 0)
+            self.assertEqual(output.getvalue().splitlines()[1:],
+                             ['1,2020-10-08T10:00:00+08:00,2020-10-08T10:30:00+08:00,john,,False'])
+            # Any part of the names is matched, so the keyword is not sent to the API, which
+            # only matches whole words, and only the listed fields are downloaded
+            list_kwargs = mock_api.events.return_value.list.call_args[1]
+            self.assertNotIn('q', list_kwargs)
+            self.assertEqual(list_kwargs['fields'], Calendar.LIST_FIELDS)
+            self.assertIsNone(get_api.call_args[1]['transport'])
+
+            # Commands sending requests from several threads get their own connections
+            with patch('sys.stdout', new=StringIO()):
+                self.assertEqual(Calendar.main(['future', '--years', '2', '--shard', 'quarter', '--workers', '4']), 0)
+            self.assertIsInstance(get_api.call_args[1]['transport'], CalendarTransport.ConnectionPool)
+
+            # The scheduler lets every worker have a request in flight, or as many as asked for
+            try:
+                with patch('sys.stdout', new=StringIO()):
+                    self.assertEqual(Calendar.main(['future', '--years', '2', '--shard', 'month',
+                                                    '--workers', '16']), 0)
+                self.assertEqual(CalendarScheduler.get_scheduler().concurrency.maximum, 16)
+                with patch('sys.stdout', new=StringIO()):
+                    self.assertEqual(Calendar.main(['--concurrency', '24', 'upcoming', '-n', '5']), 0)
+                self.assertEqual(CalendarScheduler.get_scheduler().concurrency.maximum, 24)
+            finally:
+                CalendarScheduler.set_scheduler(None)
+
+            # Invalid input is reported on stderr with a non-zero exit status
+            with patch('sys.stderr', new=StringIO()) as errors:
+                self.assertEqual(Calendar.main(['upcoming', '-n', '0']), 1)
+            self.assertIn('Error:', errors.getvalue())
+            with patch('sys.stderr', new=StringIO()) as errors:
+                self.assertEqual(Calendar.main(['--concurrency', '0', 'upcoming']), 1)
+            self.assertIn('Concurrency', errors.getvalue())
+
+    def test_import_time(self):
+        self.assertEqual(CalendarBenchmark.parse_importtime(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       100 |        100 |   json.decoder\n"
+            "import time:       250 |        350 | json\n"), {'json.decoder': (100, 100), 'json': (250, 350)})
+
+        # Importing Calendar does not load the Google client libraries, they are only
+        # imported when the API object is built
+        median, modules = CalendarBenchmark.measure_import('Calendar', runs=1)
+        self.assertIn('Calendar', modules)
+        for name in CalendarBenchmark.LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_fake_calendar_server(self):
+        calendar = CalendarFakeServer.FakeCalendar.generate(600, '2020-01-01T00:00:00Z', '2021-01-01T00:00:00Z', seed=3)
+        self.assertEqual(len(calendar), 600)
+        with CalendarFakeServer.FakeCalendarServer(calendar) as server:
+            pool = CalendarTransport.ConnectionPool(size=2)
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url, pool))
+
+            # Every event is listed once across the pages, in start order
+            events = list(Calendar.iter_events(api, page_size=100, singleEvents=True, orderBy='startTime'))
+            self.assertEqual(len(events), 600)
+            self.assertEqual(len({event['id'] for event in events}), 600)
+            starts = [Calendar.get_event_timestamp(event['start']) for event in events]
+            self.assertEqual(starts, sorted(starts))
+            self.assertGreaterEqual(server.calls['list'], 6)
+            self.assertTrue(any('recurringEventId' in event for event in events))
+            masters = list(Calendar.iter_events(api, singleEvents=False))
+            self.assertTrue(any('recurrence' in event for event in masters))
+
+            # Field masks and time bounds are applied by the server
+            page = api.events().list(calendarId='primary', timeMin='2020-06-01T00:00:00Z', maxResults=5,
+                                     singleEvents=True, fields='items(id,start)').execute()
+            self.assertEqual(set(page), {'items'})
+            self.assertEqual(set(page['items'][0]), {'id', 'start'})
+
+            # Batched deletes show up in the next incremental sync
+            store = CalendarCache.EventStore(':memory:', sync_interval=0)
+            store.sync(api)
+            results, errors = Calendar.execute_batch(
+                api, [(event['id'], api.events().delete, {'calendarId': 'primary', 'eventId': event['id']})
+                      for event in events[:3]])
+            self.assertEqual((len(results), errors), (3, {}))
+            store.sync(api)
+            self.assertEqual(len(store.query()), 597)
+            self.assertEqual(server.calls['delete'], 3)
+
+            # Expired sync tokens fail with 410 Gone, which makes the store sync fully again
+            calendar.expire_sync_tokens()
+            store.sync(api)
+            self.assertEqual(len(store.query()), 597)
+
+            # The benchmarks report percentiles, throughput and memory for every function
+            results = CalendarBenchmark.run_benchmarks(api, runs=2, only='^(get_upcoming_events|delete_events_by_name)$')
+            self.assertEqual([result['name'] for result in results], ['get_upcoming_events', 'delete_events_by_name'])
+            self.assertGreater(results[1]['events_per_s'], 0)
+            self.assertLessEqual(results[0]['p50_ms'], results[0]['p99_ms'])
+            self.assertEqual(CalendarBenchmark.compare(results, results), [])
+            pool.close()
+
+    def test_metrics(self):
+        calendar = CalendarFakeServer.FakeCalendar.generate(200, '2020-01-01T00:00:00Z', '2020-03-01T00:00:00Z')
+        with CalendarFakeServer.FakeCalendarServer(calendar) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            names = sorted({event['summary'] for event in Calendar.search_event(api, '')
+                            if '(' not in event['summary'] and 'ohn' not in event['summary']})
+            with CalendarMetrics.collect() as stats:
+                Calendar.delete_event_by_name(api, names[0])
+                deleted = server.calls['delete']
+                Calendar.delete_events_by_name(api, names[1])
+                with self.assertRaises(Exception):
+                    Calendar.get_event_details(api, 'missing')
+                store = CalendarCache.EventStore(':memory:')
+                Calendar.search_event(api, 'test', store=store)
+                Calendar.search_event(api, 'test', store=store)
+
+            # Every request is counted with its status, size and duration, batched ones included
+            self.assertEqual(stats.calls['events.delete'], server.calls['delete'])
+            self.assertEqual(stats.calls['batch'], server.calls['batch'])
+            self.assertEqual(sum(stats.histograms['events.delete']), deleted)
+            self.assertGreater(stats.bytes['events.list'], 0)
+            self.assertEqual(stats.statuses['events.get', 404], 1)
+            self.assertEqual(stats.errors['events.get'], 1)
+            self.assertEqual(stats.hit_rate('event_store'), 0.5)
+            self.assertLessEqual(stats.percentile('events.list', 0.5), stats.percentile('events.list', 0.99))
+            self.assertIn('events.delete:', stats.format())
+            self.assertIn('calendar_api_requests_total{operation="events.list",status="200"}', stats.to_prometheus())
+
+            # Nothing is recorded once the sink is removed
+            calls = sum(stats.calls.values())
+            Calendar.get_upcoming_events(api, '2020-01-01T00:00:00Z', 1)
+            self.assertEqual(sum(stats.calls.values()), calls)
+
+            # Other sinks log every call or write a Prometheus text file
+            path = os.path.join(tempfile.mkdtemp(), 'calendar.prom')
+            sinks = [CalendarMetrics.LogSink(), CalendarMetrics.PrometheusFileSink(path)]
+            for sink in sinks:
+                CalendarMetrics.add_sink(sink)
+            with self.assertLogs('Calendar', 'DEBUG') as logs:
+                Calendar.get_upcoming_events(api, '2020-01-01T00:00:00Z', 1)
+            for sink in sinks:
+                CalendarMetrics.remove_sink(sink)
+            sinks[1].write()
+            self.assertIn('events.list -> 200', logs.output[0])
+            with open(path) as metrics:
+                self.assertIn('calendar_api_request_seconds_count{operation="events.list"} 1', metrics.read())
+
+        output = StringIO()
+        with CalendarMetrics.profile(stream=output):
+            Calendar.format_events([{'id': '1', 'summary': 'test', 'start': {'date': '2020-10-09'}}])
+        self.assertIn('function calls', output.getvalue())
+
+    def test_request_scheduler(self):
+        def api_error(status, reason=None):
+            error = Exception('HTTP error')
+            error.resp = Mock(status=status)
+            error.content = json.dumps({'error': {'errors': [{'reason': reason}]}}).encode() if reason else b''
+            return error
+
+        self.assertTrue(CalendarScheduler.is_throttled(api_error(403, 'rateLimitExceeded')))
+        self.assertTrue(CalendarScheduler.is_throttled(api_error(429)))
+        self.assertFalse(CalendarScheduler.is_retryable(api_error(403, 'forbidden')))
+        self.assertTrue(CalendarScheduler.is_retryable(api_error(503)))
+        self.assertFalse(CalendarScheduler.is_retryable(api_error(503), idempotent=False))
+        self.assertTrue(CalendarScheduler.is_retryable(api_error(429), idempotent=False))
+        self.assertFalse(CalendarScheduler.is_retryable(api_error(404)))
+
+        # The token bucket lets a burst through, then one request per 1/rate seconds
+        now = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+
+        bucket = CalendarScheduler.TokenBucket(2, 2, clock=lambda: now[0], sleep=sleep)
+        for _ in range(4):
+            bucket.acquire()
+        self.assertEqual(waits, [0.5, 0.5])
+        self.assertFalse(bucket.try_acquire())
+        now[0] += 0.5
+        self.assertTrue(bucket.try_acquire())
+
+        # Throttled requests are retried after an exponential backoff, and halve the concurrency
+        delays = []
+        scheduler = CalendarScheduler.RequestScheduler(max_concurrency=8, max_retries=3, base_delay=1,
+                                                       sleep=delays.append, jitter=lambda: 1.0)
+        responses = [api_error(403, 'rateLimitExceeded'), api_error(429), api_error(500), {'items': []}]
+
+        def send():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEqual(scheduler.execute(send), {'items': []})
+        self.assertEqual(delays, [1, 2, 4])
+        self.assertEqual((scheduler.retries, scheduler.throttled), (3, 2))
+        self.assertLess(scheduler.concurrency.limit, 3)
+        # and the limit grows back with the successes
+        limit = scheduler.concurrency.limit
+        scheduler.execute(lambda: None)
+        self.assertGreater(scheduler.concurrency.limit, limit)
+
+        # Other errors, and errors outlasting the retries, are raised
+        responses[:] = [api_error(403, 'forbidden')]
+        with self.assertRaises(Exception):
+            scheduler.execute(send)
+        responses[:] = [api_error(503)] * 4
+        with self.assertRaises(Exception):
+            scheduler.execute(send)
+        self.assertEqual(responses, [])
+        # and a request which is not idempotent is not sent again after a server error
+        responses[:] = [api_error(503), None]
+        with self.assertRaises(Exception):
+            scheduler.execute(send, idempotent=False)
+        self.assertEqual(responses, [None])
+
+        # Against the fake API, every call of Calendar.py goes through the scheduler
+        calendar = CalendarFakeServer.FakeCalendar.generate(300, '2020-01-01T00:00:00Z', '2020-03-01T00:00:00Z')
+        CalendarScheduler.set_scheduler(CalendarScheduler.RequestScheduler(max_retries=8, base_delay=0.2))
+        try:
+            with CalendarFakeServer.FakeCalendarServer(calendar, quota=15) as server:
+                api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(
+                    server.url, CalendarTransport.ConnectionPool()))
+                server.inject_errors([(429, 'rateLimitExceeded'), (503, 'backendError')])
+                self.assertEqual(len(Calendar.get_upcoming_events(api, '2020-01-01T00:00:00Z', 5)), 5)
+                events = list(Calendar.iter_events_sharded(api, '2020-01-01T00:00:00Z', '2022-01-01T00:00:00Z',
+                                                           page_size=20))
+                self.assertEqual(len(events), 300)
+                self.assertGreater(server.calls['refused'], 2)
+                self.assertGreater(CalendarScheduler.get_scheduler().throttled, 0)
+
+                # An insert failing with a server error is not sent again, which could create
+                # the event twice, while a GET is
+                body = {'summary': 'once', 'start': {'dateTime': '2020-01-02T10:00:00Z'},
+                        'end': {'dateTime': '2020-01-02T11:00:00Z'}}
+                server.inject_errors([(503, 'backendError')])
+                with self.assertRaises(Exception):
+                    Calendar.execute_request(api.events().insert(calendarId='primary', body=body))
+                self.assertEqual(server.calls['insert'], 0)
+                server.inject_errors([(503, 'backendError')])
+                self.assertEqual(len(Calendar.get_upcoming_events(api, '2020-01-01T00:00:00Z', 5)), 5)
+        finally:
+            CalendarScheduler.set_scheduler(None)
+
+    def test_edit_reminders(self):
+        # Operations are applied in order, the default reminders becoming overrides when needed
+        defaults = lambda: [{'method': 'popup', 'minutes': 10}]
+        default = {'useDefault': True}
+        edited = CalendarReminders.apply_operations(default, [CalendarReminders.AddReminder(30, 'email')], defaults)
+        self.assertEqual(edited, {'useDefault': False, 'overrides': [{'method': 'popup', 'minutes': 10},
+                                                                    {'method': 'email', 'minutes': 30}]})
+        self.assertEqual(CalendarReminders.apply_operations(
+            edited, [CalendarReminders.RemoveReminder(10), CalendarReminders.RemoveReminder(method='email')],
+            defaults), {'useDefault': False, 'overrides': []})
+        self.assertEqual(CalendarReminders.apply_operations(edited, [CalendarReminders.UseDefaultReminders()],
+                                                            defaults), default)
+        with self.assertRaises(ValueError):
+            CalendarReminders.AddReminder(30, 'sms')
+        with self.assertRaises(ValueError):
+            CalendarReminders.apply_operations(default, [CalendarReminders.AddReminder(minutes) for minutes in
+                                                         range(1, 7)], defaults)
+
+        calendars = {'primary': CalendarFakeServer.FakeCalendar.generate(120, '2020-01-01T00:00:00Z',
+                                                                          '2021-01-01T00:00:00Z', seed=5),
+                     'work': CalendarFakeServer.FakeCalendar.generate(80, '2020-01-01T00:00:00Z',
+                                                                       '2021-01-01T00:00:00Z', seed=6)}
+        with CalendarFakeServer.FakeCalendarServer(calendars) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            window = ('2020-03-01T00:00:00Z', '2020-09-01T00:00:00Z')
+            selected = list(CalendarReminders.select_events(api, 'e', *window, calendar_ids=['primary', 'work']))
+            self.assertTrue(selected)
+            changing = [(calendar_id, event['id']) for calendar_id, event in selected
+                        if {'method': 'email', 'minutes': 60} not in event['reminders'].get('overrides', [])]
+            sent = []
+            original = Calendar.execute_batch
+
+            def execute_batch(api, operations, batch_size, retries=2):
+                sent.extend(kwargs['body'] for key, method, kwargs in operations)
+                return original(api, operations, batch_size, retries)
+
+            with patch('Calendar.execute_batch', side_effect=execute_batch):
+                results, errors = CalendarReminders.edit_reminders(
+                    api, [CalendarReminders.AddReminder(60, 'email')], 'e', *window,
+                    calendar_ids=['primary', 'work'], batch_size=7)
+            self.assertEqual(errors, {})
+            self.assertEqual(sorted(results), sorted(changing))
+            # The patches only hold the reminders, and unchanged events are not sent
+            self.assertTrue(all(list(body) == ['reminders'] for body in sent))
+            self.assertEqual(len(sent), len(changing))
+            self.assertEqual(server.calls['batch'], -(-len(changing) // 7))
+            for calendar_id, event_id in changing:
+                event = calendars[calendar_id].get(event_id)
+                self.assertIn({'method': 'email', 'minutes': 60}, event['reminders']['overrides'])
+            # Running it again changes nothing
+            results, errors = CalendarReminders.edit_reminders(
+                api, [CalendarReminders.AddReminder(60, 'email')], 'e', *window, calendar_ids=['primary', 'work'])
+            self.assertEqual((results, errors), ({}, {}))
+            # A batch too large for the API is refused before anything is read or sent
+            calls = sum(server.calls.values())
+            with self.assertRaises(ValueError):
+                CalendarReminders.edit_reminders(api, [CalendarReminders.AddReminder(90)], 'e', *window,
+                                                 batch_size=Calendar.BATCH_SIZE + 1)
+            self.assertEqual(sum(server.calls.values()), calls)
+
+    def test_availability(self):
+        # The sweep line merges overlapping and touching periods, or keeps where enough calendars are busy
+        busy = [[(0, 10), (20, 30)], [(5, 15), (30, 40)], [(8, 12)]]
+        self.assertEqual(CalendarAvailability.merge_busy(busy), [(0, 15), (20, 40)])
+        self.assertEqual(CalendarAvailability.merge_busy(busy, 2), [(5, 12)])
+        self.assertEqual(CalendarAvailability.merge_busy(busy, 3), [(8, 10)])
+        self.assertEqual(CalendarAvailability.free_slots([(0, 15), (20, 40)], -10, 60, 6), [(-10, 0), (40, 60)])
+        self.assertEqual(CalendarAvailability.free_slots([(0, 15), (20, 40)], 5, 30), [(15, 20)])
+
+        # 60 calendars over 90 days take two chunks of calendars times two parts of the window
+        time_min, time_max = '2021-01-01T00:00:00Z', '2021-04-01T00:00:00Z'
+        calendars = {'person' + str(number): CalendarFakeServer.FakeCalendar.generate(
+            8, time_min, time_max, seed=number, recurring=0) for number in range(60)}
+        lower, upper = Calendar.get_event_timestamp(time_min), Calendar.get_event_timestamp(time_max)
+        events = [(Calendar.get_event_timestamp(event['start']), Calendar.get_event_timestamp(event['end']))
+                  for calendar in calendars.values()
+                  for event in calendar.list({'singleEvents': 'true', 'timeMin': time_min, 'timeMax': time_max,
+                                              'maxResults': '2500'})['items']]
+        with CalendarFakeServer.FakeCalendarServer(calendars) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            slots, errors = CalendarAvailability.find_free_slots(api, list(calendars) + ['nobody'], time_min,
+                                                                 time_max, minutes=60)
+            self.assertEqual(server.calls['freebusy'], 4)
+            self.assertEqual(errors, {'nobody': 'notFound'})
+            self.assertTrue(slots)
+            slots = [(Calendar.get_event_timestamp(start), Calendar.get_event_timestamp(end)) for start, end in slots]
+            # The slots are long enough, overlap no event, and every free hour is in one of them
+            for start, end in slots:
+                self.assertGreaterEqual(end - start, 3600)
+                self.assertFalse([event for event in events if event[0] < end and start < event[1]])
+            for hour in range(int(lower), int(upper), 3600):
+                if not [event for event in events if event[0] < hour + 3600 and hour < event[1]]:
+                    self.assertTrue([slot for slot in slots if slot[0] <= hour and hour + 3600 <= slot[1]])
+
+            # A short list of calendars over a short window takes a single request
+            CalendarAvailability.find_free_slots(api, ['person1', 'person2'], time_min, '2021-01-08T00:00:00Z')
+            self.assertEqual(server.calls['freebusy'], 5)
+
+    def test_local_recurrence(self):
+        # Series keep their wall clock time across daylight saving time, and skip their EXDATEs
+        master = {'id': 'standup', 'summary': 'Standup', 'recurrence': [
+            'RRULE:FREQ=WEEKLY;UNTIL=20200401T000000Z', 'EXDATE;TZID=America/New_York:20200318T090000',
+            'RDATE;TZID=America/New_York:20200320T120000'],
+                  'start': {'dateTime': '2020-03-04T09:00:00-05:00', 'timeZone': 'America/New_York'},
+                  'end': {'dateTime': '2020-03-04T09:15:00-05:00', 'timeZone': 'America/New_York'}}
+        lower, upper = Calendar.get_event_timestamp('2020-03-01T00:00:00Z'), Calendar.get_event_timestamp(
+            '2020-04-01T00:00:00Z')
+        instances = list(CalendarRecurrence.expand_series(master, lower, upper))
+        self.assertEqual([instance['start']['dateTime'] for instance in instances],
+                         ['2020-03-04T09:00:00-05:00', '2020-03-11T09:00:00-04:00', '2020-03-20T12:00:00-04:00',
+                          '2020-03-25T09:00:00-04:00'])
+        self.assertEqual(instances[1]['id'], 'standup_20200311T130000Z')
+        self.assertEqual(instances[1]['end']['dateTime'], '2020-03-11T09:15:00-04:00')
+        # as do all-day series, and changed instances are left to the API
+        holiday = {'id': 'holiday', 'recurrence': ['RRULE:FREQ=DAILY;COUNT=4', 'EXDATE;VALUE=DATE:20200302'],
+                   'start': {'date': '2020-03-01'}, 'end': {'date': '2020-03-02'}}
+        self.assertEqual([instance['id'] for instance in CalendarRecurrence.expand_series(
+            holiday, lower, upper, {Calendar.get_event_timestamp('2020-03-03T00:00:00Z')})], ['holiday_20200301',
+                                                                                              'holiday_20200304'])
+        # UNTIL is read in the form of the start, a UTC time for an all-day series
+        holiday['recurrence'] = ['RRULE:FREQ=DAILY;UNTIL=20200303T000000Z']
+        self.assertEqual([instance['id'] for instance in CalendarRecurrence.expand_series(holiday, lower, upper)],
+                         ['holiday_20200301', 'holiday_20200302', 'holiday_20200303'])
+        # and a date for a timed series in a time zone, which includes that day
+        master['recurrence'] = ['RRULE:FREQ=WEEKLY;UNTIL=20200318']
+        self.assertEqual([instance['start']['dateTime'] for instance in CalendarRecurrence.expand_series(
+            master, lower, upper)], ['2020-03-04T09:00:00-05:00', '2020-03-11T09:00:00-04:00',
+                                     '2020-03-18T09:00:00-04:00'])
+
+        # Against the API, the expansion lists the same events as singleEvents=True, with fewer bytes
+        calendar = CalendarFakeServer.FakeCalendar.generate(600, '2019-01-01T00:00:00Z', '2021-01-01T00:00:00Z',
+                                                            seed=9, recurring=0.9)
+        with CalendarFakeServer.FakeCalendarServer(calendar) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            time_min, time_max = '2019-06-01T00:00:00Z', '2020-06-01T00:00:00Z'
+            with CalendarMetrics.collect() as server_stats:
+                expected = list(Calendar.iter_events(api, timeMin=time_min, timeMax=time_max, singleEvents=True,
+                                                     orderBy='startTime', fields=Calendar.LIST_FIELDS))
+            with CalendarMetrics.collect() as local_stats:
+                expanded = CalendarRecurrence.iter_expanded_events(api, time_min, time_max)
+                first = next(expanded)
+                found = [first] + list(expanded)
+
+            def summary(event):
+                return event['id'], event['start'], event['end'], event['summary'], event['reminders']
+            self.assertEqual(sorted(map(summary, found), key=repr), sorted(map(summary, expected), key=repr))
+            starts = [Calendar.get_event_timestamp(event['start']) for event in found]
+            self.assertEqual(starts, sorted(starts))
+            self.assertLess(local_stats.bytes['events.list'] * 3, server_stats.bytes['events.list'])
+
+            # The listing functions can expand locally too
+            self.assertEqual([event['id'] for event in Calendar.iter_specific_time_events(api, 2020, 3,
+                                                                                         expand_locally=True)],
+                             [event['id'] for event in CalendarRecurrence.iter_expanded_events(
+                                 api, *Calendar.get_specific_time_window(2020, 3))])
+
+    def test_date_count_index(self):
+        # A calendar over ten years, with all-day events and events spanning midnight
+        calendar = CalendarFakeServer.FakeCalendar.generate(1500, '2011-01-01T00:00:00Z', '2021-01-01T00:00:00Z',
+                                                            seed=11, all_day=0.2)
+        with CalendarFakeServer.FakeCalendarServer(calendar) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            counts = CalendarIndex.DateCountIndex.build(api)
+            self.assertEqual(len(counts), len(calendar))
+
+            # Every count is the number of events get_specific_time_events lists for that window
+            def listed(year, month=0, day=0):
+                return len(list(Calendar.iter_specific_time_events(api, year, month, day)))
+
+            self.assertEqual([year for year, count in counts.buckets()], list(range(2011, 2022)))
+            for year, count in counts.buckets()[:3]:
+                self.assertEqual(count, listed(year))
+            for month, count in counts.buckets(2015):
+                self.assertEqual(count, listed(2015, month))
+            busiest = max(counts.buckets(2015, 6), key=lambda bucket: bucket[1])[0]
+            self.assertEqual(counts.count(2015, 6, busiest), listed(2015, 6, busiest))
+
+            # The index follows the changes of the calendar with an incremental sync
+            event = Calendar.execute_request(api.events().insert(calendarId='primary', body={
+                'summary': 'Offsite', 'start': {'date': '2015-06-30'}, 'end': {'date': '2015-07-02'}}))
+            removed = next(Calendar.iter_specific_time_events(api, 2016, 2))
+            Calendar.execute_request(api.events().delete(calendarId='primary', eventId=removed['id']))
+            before = (counts.count(2015, 6, 30), counts.count(2015, 7), counts.count(2016, 2))
+            lists = server.calls['list']
+            changed = counts.sync(api)
+            self.assertEqual(server.calls['list'], lists + 1)
+            # and tells the days the changed events were or are now in
+            self.assertTrue({datetime.date(2015, 6, 30), datetime.date(2015, 7, 1)} <= changed)
+            self.assertTrue(any((day.year, day.month) == (2016, 2) for day in changed))
+            self.assertFalse(any(day.year == 2017 for day in changed))
+            self.assertEqual((counts.count(2015, 6, 30), counts.count(2015, 7), counts.count(2016, 2)),
+                             (before[0] + 1, before[1] + 1, before[2] - 1))
+            counts.remove(event['id'])
+            self.assertEqual(counts.count(2015, 7), before[1])
+            # An expired sync token rebuilds the index
+            calendar.expire_sync_tokens()
+            counts.sync(api)
+            self.assertEqual(counts.count(2015, 7), before[1] + 1)
+
+            # A window only covers its own buckets
+            window = CalendarIndex.DateCountIndex.build(api, '2015-01-01T00:00:00Z', '2016-01-01T00:00:00Z')
+            self.assertIsNone(window.sync_token)
+            self.assertEqual(window.count(2015), counts.count(2015))
+            self.assertTrue(window.covers(2015, 3))
+            self.assertFalse(window.covers(2016))
+
+        # navigate_calendar shows the counts, and does not fetch the empty buckets
+        counts = CalendarIndex.DateCountIndex([
+            {'id': 'a', 'start': {'dateTime': '2020-03-14T10:00:00Z'}, 'end': {'dateTime': '2020-03-14T11:00:00Z'}},
+            {'id': 'b', 'start': {'date': '2020-03-31'}, 'end': {'date': '2020-04-02'}}])
+        self.assertEqual(counts.buckets(2020), [(3, 2), (4, 1)])
+        mock_api = Mock()
+        old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        sys.stdin = StringIO("3\n2020\n3\n15\n4")
+        Calendar.navigate_calendar(mock_api, counts=counts)
+        output = sys.stdout.getvalue()
+        sys.stdin = sys.__stdin__
+        sys.stdout = old_stdout
+        self.assertIn("Events per year: 2020 (2)", output)
+        self.assertIn("Events per month: 2020-03 (2), 2020-04 (1)", output)
+        self.assertIn("Events per day: 2020-03-14 (1), 2020-03-31 (1)", output)
+        self.assertIn("No events found.", output)
+        self.assertEqual(mock_api.events.return_value.list.call_count, 0)
+
+        # Counts that are too old, or whose store changed, are brought up to date before a
+        # window they have as empty is skipped
+        with CalendarFakeServer.FakeCalendarServer(CalendarFakeServer.FakeCalendar()) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            counts = CalendarIndex.DateCountIndex.build(api)
+            store = CalendarCache.EventStore(':memory:', sync_interval=0)
+            self.addCleanup(store.close)
+            store_counts = CalendarIndex.DateCountIndex()
+            counted = Calendar._refresh_counts(api, store_counts, store)
+            Calendar.execute_request(api.events().insert(calendarId='primary', body={
+                'summary': 'Offsite', 'start': {'date': '2030-02-03'}, 'end': {'date': '2030-02-04'}}))
+            self.assertEqual(Calendar._find_events(api, 2030, 2, 3, counts=counts), [])
+            counts.synced_at -= Calendar.COUNTS_MAX_AGE
+            Calendar._refresh_counts(api, counts)
+            self.assertEqual(len(Calendar._find_events(api, 2030, 2, 3, counts=counts)), 1)
+            Calendar._refresh_counts(api, store_counts, store, counted)
+            self.assertEqual(store_counts.count(2030, 2, 3), 1)
+            self.assertEqual(len(Calendar._find_events(api, 2030, 2, 3, store=store, counts=store_counts)), 1)
+
+    def test_window_prefetcher(self):
+        self.assertEqual(CalendarPrefetch.neighbours(2020, 12), [(2021, 1, 0), (2020, 11, 0)])
+        self.assertEqual(CalendarPrefetch.neighbours(2020, 3, 1, depth=2),
+                         [(2020, 3, 2), (2020, 2, 29), (2020, 3, 3), (2020, 2, 28)])
+
+        # Every fetch tells which window it started and is held back until released, so the
+        # background thread is only ever where the test lets it be
+        fetched = []
+        started = queue.Queue()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def fetch(year, month, day):
+            started.put((year, month, day))
+            release.wait()
+            fetched.append((year, month, day))
+            return [{'id': str((year, month, day)) + str(number)} for number in range(3)]
+
+        def next_started():
+            return started.get(timeout=5)
+
+        with CalendarPrefetch.WindowPrefetcher(None, fetch, depth=2, max_pending=3, max_events=10) as prefetcher:
+            prefetcher.visit(2020, 3)
+            self.assertEqual(next_started(), (2020, 4, 0))
+            # Moving elsewhere cancels the windows that are no longer next to the one viewed:
+            # the queue held February and May, the farthest window was left out
+            prefetcher.visit(2020, 8, 0, events=[])
+            self.assertEqual(prefetcher.cancelled, 2)
+            release.set()
+            self.assertEqual([next_started() for _ in range(3)], [(2020, 9, 0), (2020, 7, 0), (2020, 10, 0)])
+            # A window being fetched is waited for
+            self.assertEqual(len(prefetcher.get(2020, 10)), 3)
+            self.assertEqual(fetched, [(2020, 4, 0), (2020, 9, 0), (2020, 7, 0), (2020, 10, 0)])
+            self.assertEqual(prefetcher.fetched, 4)
+            self.assertTrue(started.empty())
+            # The least recently used windows are evicted to stay under the memory cap
+            self.assertEqual((len(prefetcher), prefetcher.evicted), (9, 2))
+            self.assertEqual(len(prefetcher.get(2020, 9)), 3)
+            self.assertIsNone(prefetcher.get(2020, 4))
+            self.assertEqual((prefetcher.hits, prefetcher.misses), (2, 1))
+
+        # A window being fetched is waited for instead of being fetched twice
+        release.clear()
+        with CalendarPrefetch.WindowPrefetcher(None, fetch, depth=1) as prefetcher:
+            prefetcher.visit(2021, 1, 1)
+            self.assertEqual(next_started(), (2021, 1, 2))
+            answers = []
+            getter = threading.Thread(target=lambda: answers.append(prefetcher.get(2021, 1, 2)))
+            getter.start()
+            release.set()
+            getter.join(5)
+            self.assertEqual(len(answers[0]), 3)
+            self.assertEqual(fetched.count((2021, 1, 2)), 1)
+            self.assertEqual((prefetcher.hits, prefetcher.misses), (1, 0))
+
+        # An invalidated window is dropped, and so are its events if it is being fetched
+        while not started.empty():
+            started.get()
+        release.clear()
+        with CalendarPrefetch.WindowPrefetcher(None, fetch, depth=1) as prefetcher:
+            prefetcher.visit(2022, 5, events=[{'id': 'kept'}, {'id': 'changed'}])
+            self.assertEqual(next_started(), (2022, 6, 0))
+            prefetcher.invalidate(2022, 6)
+            prefetcher.invalidate(2022, 5)
+            self.assertEqual(len(prefetcher), 0)
+            release.set()
+            self.assertEqual(next_started(), (2022, 4, 0))
+            self.assertEqual(len(prefetcher.get(2022, 4)), 3)
+            self.assertIsNone(prefetcher.get(2022, 6))
+            self.assertIsNone(prefetcher.get(2022, 5))
+            self.assertEqual((prefetcher.fetched, len(prefetcher)), (1, 3))
+
+        # The windows expire after max_age seconds, the ones given to visit as well
+        with CalendarPrefetch.WindowPrefetcher(None, lambda *window: [], max_age=0) as prefetcher:
+            prefetcher.visit(2023, 1, events=[{'id': 'old'}])
+            self.assertIsNone(prefetcher.get(2023, 1))
+            self.assertEqual((prefetcher.hits, prefetcher.misses), (0, 1))
+        with CalendarPrefetch.WindowPrefetcher(None, lambda *window: []) as prefetcher:
+            prefetcher.visit(2023, 1, events=[{'id': 'new'}])
+            self.assertEqual(prefetcher.get(2023, 1), [{'id': 'new'}])
+
+        # navigate_calendar answers the next month from the prefetched window
+        calendar = CalendarFakeServer.FakeCalendar.generate(300, '2020-01-01T00:00:00Z', '2021-01-01T00:00:00Z',
+                                                            seed=12)
+        with CalendarFakeServer.FakeCalendarServer(calendar) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            expected = StringIO()
+            Calendar.print_events(Calendar.get_specific_time_events(api, 2020, 4), numbered=True, stream=expected)
+            old_stdout = sys.stdout
+            sys.stdout = StringIO()
+            prefetcher = CalendarPrefetch.WindowPrefetcher(api)
+
+            # The user reads March until February and April are fetched, and April until May is:
+            # the number of windows fetched in the background before every answer
+            fetched_before = [0, 0, 0, 0, 2, 2, 2, 2, 3]
+
+            class ReadingInput(StringIO):
+                def readline(self, *args):
+                    deadline = time.monotonic() + 5
+                    while prefetcher.fetched < fetched_before[0] and time.monotonic() < deadline:
+                        time.sleep(0.01)
+                    fetched_before.pop(0)
+                    return super().readline(*args)
+
+            sys.stdin = ReadingInput("2\n2020\n3\n0\n2\n2020\n4\n0\n4")
+            with prefetcher:
+                lists = server.calls['list']
+                Calendar.navigate_calendar(api, prefetcher=prefetcher)
+                hits = prefetcher.hits
+            output = sys.stdout.getvalue()
+            sys.stdin = sys.__stdin__
+            sys.stdout = old_stdout
+            self.assertEqual(hits, 1)
+            self.assertIn(expected.getvalue(), output)
+            # March was fetched by navigate_calendar, then February, April and May in the background
+            self.assertEqual(server.calls['list'] - lists, 4)
+
+            # navigate_calendar invalidates the windows of the events it finds changed: when the
+            # counts sync brings them
+            counts = CalendarIndex.DateCountIndex.build(api)
+            with CalendarPrefetch.WindowPrefetcher(None, lambda *window: []) as prefetcher:
+                listed = Calendar.get_specific_time_events(api, 2020, 6)
+                for window in ((2020, 6, 0), (2020, 0, 0), (2020, 8, 0)):
+                    prefetcher.visit(*window, events=listed)
+                prefetcher.cancel()
+                moved = listed[0]
+                Calendar.execute_request(api.events().patch(calendarId='primary', eventId=moved['id'], body={
+                    'start': {'dateTime': '2020-06-15T09:00:00Z'}, 'end': {'dateTime': '2020-06-15T10:00:00Z'}}))
+                counts.synced_at = 0
+                Calendar._refresh_counts(api, counts, prefetcher=prefetcher)
+                self.assertIsNone(prefetcher.get(2020, 6))
+                self.assertIsNone(prefetcher.get(2020))
+                self.assertEqual(prefetcher.get(2020, 8), listed)
+
+        # and when the details of an event differ from the prefetched listing
+        listed = {'id': 'moved', 'status': 'confirmed', 'summary': 'test',
+                  'start': {'dateTime': '2020-08-14T10:00:00Z'}, 'end': {'dateTime': '2020-08-14T11:00:00Z'}}
+        mock_api = Mock()
+        mock_api.events.return_value.get.return_value.execute.return_value = dict(
+            listed, kind='calendar#event', htmlLink='https://example.com', created='2020-01-01T00:00:00Z',
+            updated='2020-02-01T00:00:00Z', creator={'email': 'owner@example.com'},
+            organizer={'email': 'owner@example.com'}, start={'dateTime': '2020-08-15T10:00:00Z'},
+            end={'dateTime': '2020-08-15T11:00:00Z'})
+        with CalendarPrefetch.WindowPrefetcher(None, lambda *window: []) as prefetcher:
+            prefetcher.visit(2020, 8, events=[listed])
+            sys.stdout = StringIO()
+            sys.stdin = StringIO("2\n2020\n8\n1\n4")
+            Calendar.navigate_calendar(mock_api, prefetcher=prefetcher)
+            sys.stdin = sys.__stdin__
+            sys.stdout = old_stdout
+            self.assertEqual(prefetcher.hits, 1)
+            self.assertIsNone(prefetcher.get(2020, 8))
+            # but an Event of the index which only gives its id is not taken for a changed one
+            index = CalendarIndex.IntervalIndex([Calendar.Event.from_dict(listed)], '2020-08-01T00:00:00Z',
+                                                '2020-09-01T00:00:00Z')
+            sys.stdout = StringIO()
+            sys.stdin = StringIO("2\n2020\n8\n1\n4")
+            Calendar.navigate_calendar(mock_api, index=index, prefetcher=prefetcher)
+            sys.stdin = sys.__stdin__
+            sys.stdout = old_stdout
+            self.assertEqual(len(prefetcher.get(2020, 8)), 1)
+        self.assertEqual(mock_api.events.return_value.list.call_count, 0)
+
+    def test_push_notifications(self):
+        calendars = {'primary': CalendarFakeServer.FakeCalendar.generate(200, seed=12),
+                     'team': CalendarFakeServer.FakeCalendar.generate(200, seed=13)}
+
+        def wait_until(condition):
+            deadline = time.monotonic() + 5
+            while not condition():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+        with CalendarFakeServer.FakeCalendarServer(calendars) as server:
+            api = CalendarTransport.build_api(CalendarFakeServer.LocalTransport(server.url,
+                                                                                CalendarTransport.ConnectionPool()))
+            # Without notifications, a store with no sync interval polls on every query
+            store = CalendarCache.EventStore(':memory:', sync_interval=0)
+            self.addCleanup(store.close)
+            with CalendarWatch.WatchManager(api, check_interval=3600) as manager:
+                manager.keep_synced(store, ['primary', 'team'])
+                self.assertEqual(server.calls['watch'], 2)
+                self.assertEqual(sorted(manager.watched()), ['primary', 'team'])
+                self.assertEqual(len(store.query(calendar_id='team')), len(calendars['team']))
+                # The channels are confirmed with a 'sync' notification, which resyncs nothing
+                wait_until(lambda: manager.notifications == 2)
+                self.assertTrue(manager.wait_idle(5))
+                self.assertEqual(manager.resyncs, 0)
+
+                # While the calendars are watched, the store does not poll
+                lists = server.calls['list']
+                store.sync(api)
+                store.sync(api, 'team')
+                self.assertEqual(server.calls['list'], lists)
+
+                # A change resyncs only the calendar it was made in, incrementally
+                Calendar.execute_request(api.events().insert(calendarId='team', body={
+                    'summary': 'Offsite', 'start': {'dateTime': '2030-01-01T10:00:00Z'},
+                    'end': {'dateTime': '2030-01-01T11:00:00Z'}}))
+                wait_until(lambda: store.search('Offsite', 'team'))
+                self.assertTrue(manager.wait_idle(5))
+                self.assertEqual(server.calls['list'], lists + 1)
+                self.assertEqual(store.search('Offsite'), [])
+
+                # So does a fake notification after changing a calendar directly
+                calendars['primary'].insert({'summary': 'Board meeting', 'start': {'date': '2030-02-01'},
+                                             'end': {'date': '2030-02-02'}})
+                server.notify('primary')
+                wait_until(lambda: store.search('Board meeting'))
+
+                # A calendar whose resync fails is polled until a later resync succeeds
+                calendars['team'].insert({'summary': 'Hackathon', 'start': {'date': '2030-03-01'},
+                                          'end': {'date': '2030-03-02'}})
+                server.inject_errors([(400, 'badRequest')])
+                server.notify('team')
+                wait_until(lambda: 'team' not in store.watched)
+                self.assertTrue(manager.wait_idle(5))
+                self.assertEqual(manager.failures, 1)
+                server.notify('team')
+                wait_until(lambda: store.search('Hackathon', 'team'))
+                wait_until(lambda: 'team' in store.watched)
+
+                # Notifications of unknown channels or with the wrong token are refused
+                def post(headers):
+                    request = urllib.request.Request(manager.receiver.url, data=b'', headers=headers, method='POST')
+                    try:
+                        with urllib.request.urlopen(request, timeout=5) as response:
+                            return response.status
+                    except urllib.error.HTTPError as error:
+                        return error.code
+                channel = manager.channel('team')
+                self.assertEqual(post({'X-Goog-Channel-ID': 'unknown', 'X-Goog-Resource-State': 'exists'}), 404)
+                self.assertEqual(post({'X-Goog-Channel-ID': channel.id, 'X-Goog-Resource-ID': channel.resource_id,
+                                       'X-Goog-Channel-Token': 'forged', 'X-Goog-Resource-State': 'exists'}), 401)
+                self.assertEqual(manager.rejected, 2)
+
+                # Channels close to expiring are replaced, and the old ones stopped
+                self.assertEqual(manager.renew(now=channel.expiration - CalendarWatch.DEFAULT_RENEW_BEFORE - 60), [])
+                self.assertEqual(sorted(manager.renew(now=channel.expiration)), ['primary', 'team'])
+                self.assertEqual(server.calls['channels.stop'], 2)
+                self.assertNotEqual(manager.channel('team').id, channel.id)
+                self.assertNotIn(channel.id, server.channels)
+                Calendar.execute_request(api.events().delete(calendarId='team', eventId=store.search('Offsite',
+                                                                                                     'team')[0]['id']))
+                wait_until(lambda: not store.search('Offsite', 'team'))
+
+            # Closing the manager stops the channels, and the store polls again
+            self.assertEqual(server.channels, {})
+            self.assertEqual(store.watched, set())
+            lists = server.calls['list']
+            store.sync(api, 'team')
+            self.assertEqual(server.calls['list'], lists + 1)
+
 
 def main():
     # Create the test suite from the cases above.
@@ -0,0 +1,110 @@
+# HTTP transport for the Calendar application.
+# By default the API object sends every request through a single httplib2 connection,
+# which cannot be shared between threads. The ConnectionPool below keeps a bounded number
+# of keep-alive connections that are handed out to one request at a time, so that bursts
+# of list/delete/update calls, from one or many threads, reuse open connections instead
+# of setting up a new TCP and TLS connection each time.
+
+import contextlib
+import queue
+import threading
+
+import google_auth_httplib2
+import httplib2
+
+import Calendar
+
+# Maximum number of connections kept open by a pool.
+DEFAULT_POOL_SIZE = 10
+
+# Number of seconds to wait on a socket before giving up on a request.
+DEFAULT_TIMEOUT = 60
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of keep-alive HTTP connections that can be passed as the
+    http object of the API, e.g. Calendar.get_calendar_api(transport=ConnectionPool()).
+
+    :param credentials: The credentials to authorize the requests with, None to send them as is
+    :param size: The maximum number of connections open at the same time
+    :param timeout: The socket timeout of the connections in seconds
+    :param acquire_timeout: Seconds to wait for a free connection, None to wait as long as needed
+    """
+
+    def __init__(self, credentials=None, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, acquire_timeout=None):
+        if size <= 0:
+            raise ValueError("Pool size must be at least 1.")
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.created = 0
+        self._slots = threading.BoundedSemaphore(size)
+        # The most recently used connection is handed out first, since it is the most
+        # likely to still be open
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        http = httplib2.Http(timeout=self.timeout)
+        # Like googleapiclient's own transport, 308 is not treated as a redirect
+        http.redirect_codes = http.redirect_codes - {308}
+        with self._lock:
+            self.created += 1
+        if self.credentials is not None:
+            return google_auth_httplib2.AuthorizedHttp(self.credentials, http=http)
+        return http
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of the with block, opening a
+        new one if none is idle and the pool is not full.
+        """
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError("No connection became free within " + str(self.acquire_timeout) + " seconds.")
+        try:
+            try:
+                http = self._idle.get_nowait()
+            except queue.Empty:
+                http = self._new_connection()
+            try:
+                yield http
+            except Exception:
+                # The connection may be left in an unknown state, so it is not reused
+                http.close()
+                raise
+            self._idle.put(http)
+        finally:
+            self._slots.release()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        """
+        Sends a request through one of the pooled connections. Has the same signature as
+        httplib2.Http.request, which is what the API object calls.
+        """
+        with self.connection() as http:
+            return http.request(uri, method=method, body=body, headers=headers, **kwargs)
+
+    def close(self):
+        """
+        Closes the idle connections of the pool.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def build_api(transport, api_endpoint=None):
+    """
+    Builds a Calendar API object that sends its requests through the given transport,
+    optionally to another endpoint than Google's, such as a local stand-in of the API.
+
+    :param transport: The http object to send the requests through, e.g. a ConnectionPool
+    :param api_endpoint: The base URL of the API, e.g. 'http://127.0.0.1:8080/calendar/v3/'
+    """
+    client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+    return Calendar._build_service(http=transport, client_options=client_options)
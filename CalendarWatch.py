@@ -0,0 +1,418 @@
+# Push notifications for the Calendar application.
+# Instead of polling the API to find out whether a local copy of the events is stale, a
+# WatchManager opens an events.watch channel per calendar, and the API posts a
+# notification to the manager's embedded NotificationReceiver whenever the events of the
+# calendar change. Every notification triggers an incremental resync of only the calendar
+# it is about, on a background thread, and the channels are renewed before they expire.
+# A CalendarCache.EventStore kept up to date this way never polls while it is warm, e.g.
+#     with WatchManager(api, address='https://example.com/notifications', port=8081) as manager:
+#         manager.keep_synced(store)
+# https://developers.google.com/calendar/v3/push
+#
+# The API only posts to HTTPS addresses with a valid certificate, so in production the
+# receiver (which speaks plain HTTP) sits behind a reverse proxy or tunnel forwarding the
+# public address to it. CalendarFakeServer posts its notifications to the receiver directly.
+#
+# The default http object of the API cannot be shared between threads, so the API should
+# be built on a CalendarTransport.ConnectionPool.
+
+import logging
+import secrets
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Calendar
+
+# Seconds a channel is asked to live for, the API may give it a shorter life.
+DEFAULT_TTL = 7 * 24 * 3600
+
+# Seconds before a channel expires that it is replaced with a new one.
+DEFAULT_RENEW_BEFORE = 3600
+
+# Seconds between two checks for channels that need to be renewed.
+DEFAULT_CHECK_INTERVAL = 60
+
+# The path the receiver accepts notifications on.
+DEFAULT_PATH = '/notifications'
+
+_logger = logging.getLogger('Calendar')
+
+
+class Channel:
+    """
+    A notification channel open on the events of one calendar.
+
+    :param calendar_id: The calendar the channel watches
+    :param channel_id: The id the channel was opened with
+    :param resource_id: The id the API gave the watched resource, needed to stop the channel
+    (None until the API has answered)
+    :param token: The secret the API sends back with every notification of the channel
+    :param expiration: The POSIX timestamp the channel expires at
+    """
+
+    def __init__(self, calendar_id, channel_id, resource_id, token, expiration):
+        self.calendar_id = calendar_id
+        self.id = channel_id
+        self.resource_id = resource_id
+        self.token = token
+        self.expiration = expiration
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        # The notifications of the events resource have no body worth reading
+        if length:
+            self.rfile.read(length)
+        if urllib.parse.urlsplit(self.path).path != self.server.receiver.path:
+            status = 404
+        else:
+            status = self.server.receiver.dispatch(self.headers)
+        self._reply(status)
+
+    def do_GET(self):
+        self._reply(405)
+
+    do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class NotificationReceiver:
+    """
+    A small HTTP server receiving the notifications the API posts to a channel's address,
+    and handing their headers to a function that answers with the status to reply with.
+
+    :param dispatch: The function called with the headers of every notification
+    :param host: The address to listen on
+    :param port: The port to listen on, 0 for any free port
+    :param path: The path notifications are accepted on, other paths are answered with 404
+    """
+
+    def __init__(self, dispatch, host='127.0.0.1', port=0, path=DEFAULT_PATH):
+        self.dispatch = dispatch
+        self.path = path
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.receiver = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://' + host + ':' + str(port) + self.path
+
+    def start(self):
+        """
+        Starts receiving on a background thread and returns the receiver.
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class WatchManager:
+    """
+    Opens and renews a notification channel per watched calendar, and runs the hooks of a
+    calendar on a background thread whenever the API notifies that its events changed.
+    Notifications arriving while the hooks of a calendar are queued or running are
+    coalesced, so a burst of changes costs at most two resyncs.
+
+    :param api: API of the Google Calendar, built on a CalendarTransport.ConnectionPool
+    :param address: The HTTPS address the API posts the notifications to, which should be
+    forwarded to the receiver, the receiver's own URL by default (for local testing)
+    :param host: The address the receiver listens on
+    :param port: The port the receiver listens on, 0 for any free port
+    :param path: The path the receiver accepts notifications on
+    :param ttl: Seconds the channels are asked to live for
+    :param renew_before: Seconds before its expiration that a channel is renewed
+    :param check_interval: Seconds between two checks for channels to renew
+    """
+
+    def __init__(self, api, address=None, host='127.0.0.1', port=0, path=DEFAULT_PATH, ttl=DEFAULT_TTL,
+                 renew_before=DEFAULT_RENEW_BEFORE, check_interval=DEFAULT_CHECK_INTERVAL):
+        if ttl <= 0 or renew_before < 0 or check_interval <= 0:
+            raise ValueError("Channel lifetimes and intervals must be positive.")
+        self.api = api
+        self.receiver = NotificationReceiver(self._dispatch, host, port, path)
+        self.address = address or self.receiver.url
+        self.ttl = ttl
+        self.renew_before = renew_before
+        self.check_interval = check_interval
+        # The open channels by id, and the current channel of every watched calendar
+        self._channels = {}
+        self._watched = {}
+        self._hooks = []
+        # The calendars of every store kept up to date, see keep_synced
+        self._stores = {}
+        # The calendars whose hooks are waiting to run, in the order they were notified
+        self._dirty = []
+        self._running = None
+        self._condition = threading.Condition()
+        self._closed = threading.Event()
+        self._threads = []
+        self.notifications = 0
+        self.rejected = 0
+        self.resyncs = 0
+        self.renewed = 0
+        self.failures = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """
+        Starts the receiver, the thread running the hooks and the one renewing the
+        channels, and returns the manager.
+        """
+        self.receiver.start()
+        for target in (self._run, self._renew_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self):
+        """
+        Stops every channel, so that the API stops posting, then the receiver and the
+        background threads. The stores kept up to date go back to polling.
+        """
+        for calendar_id in list(self._watched):
+            try:
+                self.unwatch(calendar_id)
+            except Exception as error:
+                _logger.warning("Could not stop the channel of %s: %s", calendar_id, error)
+        self._closed.set()
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.receiver.stop()
+
+    def add_hook(self, hook):
+        """
+        Adds a function called with the id of a watched calendar after its events changed,
+        e.g. to resync a cache of them.
+
+        :param hook: The function to call, on the manager's background thread
+        """
+        self._hooks.append(hook)
+
+    def watched(self):
+        """
+        Returns the ids of the calendars being watched.
+        """
+        with self._condition:
+            return list(self._watched)
+
+    def channel(self, calendar_id):
+        """
+        Returns the current Channel of a watched calendar, or None.
+        """
+        with self._condition:
+            return self._watched.get(calendar_id)
+
+    def watch(self, calendar_id='primary'):
+        """
+        Opens a channel on the events of a calendar, replacing the one it had (which is
+        only stopped once the new one is open, so that no change is missed). Returns the
+        new Channel.
+
+        :param calendar_id: The calendar to watch
+        """
+        channel = Channel(calendar_id, str(uuid.uuid4()), None, secrets.token_urlsafe(16), time.time() + self.ttl)
+        body = {'id': channel.id, 'type': 'web_hook', 'address': self.address, 'token': channel.token,
+                'params': {'ttl': str(int(self.ttl))}}
+        # The 'sync' notification may arrive before the response, so the channel is known first
+        with self._condition:
+            self._channels[channel.id] = channel
+        try:
+            response = Calendar.execute_request(self.api.events().watch(calendarId=calendar_id, body=body))
+        except Exception:
+            with self._condition:
+                self._channels.pop(channel.id, None)
+            raise
+        with self._condition:
+            channel.resource_id = response['resourceId']
+            if response.get('expiration'):
+                channel.expiration = int(response['expiration']) / 1000
+            previous = self._watched.get(calendar_id)
+            self._watched[calendar_id] = channel
+        if previous is not None:
+            self._stop(previous)
+        return channel
+
+    def unwatch(self, calendar_id='primary'):
+        """
+        Stops the channel of a calendar, the stores kept up to date go back to polling it.
+
+        :param calendar_id: The calendar to stop watching
+        """
+        with self._condition:
+            channel = self._watched.pop(calendar_id, None)
+            stores = list(self._stores.items())
+        for store, calendar_ids in stores:
+            calendar_ids.discard(calendar_id)
+            store.watched.discard(calendar_id)
+        if channel is not None:
+            self._stop(channel)
+
+    def _stop(self, channel):
+        with self._condition:
+            self._channels.pop(channel.id, None)
+        try:
+            Calendar.execute_request(self.api.channels().stop(body={'id': channel.id,
+                                                                    'resourceId': channel.resource_id}))
+        except Exception as error:
+            # The channel expires on its own anyway
+            if Calendar.get_error_status(error) != 404:
+                raise
+
+    def keep_synced(self, store, calendar_ids=('primary',)):
+        """
+        Keeps a CalendarCache.EventStore up to date from the notifications: the calendars
+        are watched, synced once, and from then on only resynced (incrementally) when they
+        change, so that queries on the store never poll the API while the channels are open.
+        A calendar whose resync fails is polled again until a later resync succeeds.
+
+        :param store: The CalendarCache.EventStore to keep up to date
+        :param calendar_ids: The calendars of the store to watch
+        """
+        with self._condition:
+            if store not in self._stores:
+                synced = self._stores[store] = set()
+
+                def resync(calendar_id):
+                    if calendar_id not in synced or self.channel(calendar_id) is None:
+                        return
+                    try:
+                        store.sync(self.api, calendar_id, force=True)
+                    except Exception:
+                        # The store polls the calendar until a notification resyncs it
+                        store.watched.discard(calendar_id)
+                        raise
+                    store.watched.add(calendar_id)
+                self.add_hook(resync)
+            synced = self._stores[store]
+        for calendar_id in calendar_ids:
+            if self.channel(calendar_id) is None:
+                self.watch(calendar_id)
+            # Watched before the sync, so that a notification arriving during it resyncs
+            # the calendar again instead of being missed
+            synced.add(calendar_id)
+            store.watched.add(calendar_id)
+            try:
+                store.sync(self.api, calendar_id, force=True)
+            except Exception:
+                store.watched.discard(calendar_id)
+                raise
+
+    def renew(self, now=None):
+        """
+        Replaces the channels expiring within renew_before seconds with new ones, and
+        returns the calendars whose channels were renewed. A calendar whose channel
+        expired without being renewed stops being watched, and its stores go back to
+        polling it.
+
+        :param now: The current POSIX timestamp, the time of the call by default
+        """
+        now = time.time() if now is None else now
+        with self._condition:
+            due = [channel for channel in self._watched.values() if channel.expiration - self.renew_before <= now]
+        renewed = []
+        for channel in due:
+            try:
+                self.watch(channel.calendar_id)
+            except Exception as error:
+                self.failures += 1
+                _logger.warning("Could not renew the channel of %s: %s", channel.calendar_id, error)
+                if channel.expiration <= now:
+                    self.unwatch(channel.calendar_id)
+                continue
+            self.renewed += 1
+            renewed.append(channel.calendar_id)
+        return renewed
+
+    def wait_idle(self, timeout=None):
+        """
+        Waits until no hooks are waiting to run or running, and returns whether they
+        finished within the timeout.
+
+        :param timeout: The most seconds to wait, None to wait for as long as it takes
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._dirty and self._running is None, timeout)
+
+    def _dispatch(self, headers):
+        """
+        Handles the headers of a notification and returns the status to answer with.
+        """
+        with self._condition:
+            channel = self._channels.get(headers.get('X-Goog-Channel-ID'))
+            if channel is None or channel.resource_id not in (None, headers.get('X-Goog-Resource-ID')):
+                self.rejected += 1
+                # The API stops posting to a channel answered with 404
+                return 404
+            if not secrets.compare_digest(headers.get('X-Goog-Channel-Token') or '', channel.token):
+                self.rejected += 1
+                return 401
+            self.notifications += 1
+            # 'sync' only confirms the channel was opened, nothing changed
+            if headers.get('X-Goog-Resource-State') == 'sync':
+                return 200
+            if channel.calendar_id not in self._dirty and self._watched.get(channel.calendar_id) is not None:
+                self._dirty.append(channel.calendar_id)
+                self._condition.notify_all()
+        return 200
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._dirty and not self._closed.is_set():
+                    self._condition.wait()
+                if self._closed.is_set():
+                    return
+                calendar_id = self._running = self._dirty.pop(0)
+            for hook in list(self._hooks):
+                try:
+                    hook(calendar_id)
+                except Exception as error:
+                    # The next notification tries again
+                    self.failures += 1
+                    _logger.warning("Could not resync %s: %s", calendar_id, error)
+            with self._condition:
+                self._running = None
+                self.resyncs += 1
+                self._condition.notify_all()
+
+    def _renew_loop(self):
+        while not self._closed.wait(self.check_interval):
+            try:
+                self.renew()
+            except Exception as error:
+                _logger.warning("Could not renew the channels: %s", error)